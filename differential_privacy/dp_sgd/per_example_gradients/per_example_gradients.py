@@ -279,6 +279,80 @@ class Conv2DPXG(object):
 pxg_registry.Register("Conv2D", Conv2DPXG)
 
 
+class BatchedConv2DPXG(object):
+  """Per-example gradient rule of Conv2d op, for all examples at once.
+
+  Same interface as MatMulPXG. Folding the examples of the minibatch into
+  the channels turns the convolution into a grouped convolution with one
+  group per example, whose filter gradient holds every per-example gradient.
+  Unlike Conv2DPXG, the size of the graph does not grow with the batch size.
+  Convolutions with dilated filters or in NCHW format fall back to
+  Conv2DPXG.
+
+  Grouped convolutions are not supported by the Conv2D kernels of older
+  TensorFlow releases, so this rule is not registered by default. To use it:
+
+    pxg_registry.Register("Conv2D", BatchedConv2DPXG)
+  """
+
+  def __init__(self, op,
+               colocate_gradients_with_ops=False,
+               gate_gradients=False):
+
+    assert op.node_def.op == "Conv2D"
+    self.op = op
+    self.colocate_gradients_with_ops = colocate_gradients_with_ops
+    self.gate_gradients = gate_gradients
+
+  def _IsSupported(self):
+    if tf.compat.as_str(self.op.get_attr("data_format")) != "NHWC":
+      return False
+    try:
+      dilations = self.op.get_attr("dilations")
+    except ValueError:
+      # Conv2D ops from before dilations were supported.
+      return True
+    return all(d == 1 for d in dilations)
+
+  def __call__(self, w, z_grads):
+    idx = list(self.op.inputs).index(w)
+    # Make sure that `op` was actually applied to `w`
+    assert idx != -1
+    assert len(z_grads) == len(self.op.outputs)
+    assert idx == 1  # We expect convolution weights to be arg 1
+
+    if not self._IsSupported():
+      return Conv2DPXG(self.op,
+                       self.colocate_gradients_with_ops,
+                       self.gate_gradients)(w, z_grads)
+
+    images, filters = self.op.inputs
+    strides = self.op.get_attr("strides")
+    padding = self.op.get_attr("padding")
+    z_grads, = z_grads
+
+    rows, columns, in_channels, out_channels = [
+        int(e) for e in filters.get_shape()]
+    batch_size = tf.shape(images)[0]
+
+    # [batch_size, height, width, channels] -> [1, height, width,
+    # batch_size * channels], with the channels of each example contiguous.
+    def FoldExamples(t):
+      t_shape = tf.shape(t)
+      return tf.reshape(tf.transpose(t, [1, 2, 0, 3]),
+                        [1, t_shape[1], t_shape[2], -1])
+
+    w_grads = tf.nn.conv2d_backprop_filter(
+        FoldExamples(images),
+        tf.stack([rows, columns, in_channels, batch_size * out_channels]),
+        FoldExamples(z_grads),
+        strides=strides,
+        padding=padding)
+    w_grads = tf.reshape(w_grads,
+                         [rows, columns, in_channels, -1, out_channels])
+    return tf.transpose(w_grads, [3, 0, 1, 2, 4])
+
+
 class AddPXG(object):
   """Per-example gradient rule for Add op.
 
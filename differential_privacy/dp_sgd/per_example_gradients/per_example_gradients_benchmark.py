@@ -0,0 +1,87 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Benchmarks of the per-example gradient rules of Conv2D.
+
+Times the per-example filter gradients of the two convolutions of dp_mnist,
+with the rule that runs one convolution per example (Conv2DPXG) and with the
+batched one (BatchedConv2DPXG), and reports the number of ops each rule adds
+to the graph. Run with:
+
+  python per_example_gradients_benchmark.py --benchmarks=.
+"""
+
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from differential_privacy.dp_sgd.per_example_gradients import per_example_gradients
+
+
+class Conv2DPXGBenchmark(tf.test.Benchmark):
+
+  def _RunRule(self, name, rule_class, batch_size, image_size, in_channels,
+               out_channels):
+    with tf.Graph().as_default() as graph:
+      rng = np.random.RandomState(0)
+      images = tf.constant(
+          rng.randn(batch_size, image_size, image_size, in_channels),
+          dtype=tf.float32)
+      filters = tf.constant(rng.randn(5, 5, in_channels, out_channels),
+                            dtype=tf.float32)
+      conv = tf.nn.conv2d(images, filters, strides=[1, 1, 1, 1],
+                          padding="SAME")
+      z_grads = tf.gradients(tf.reduce_sum(tf.square(conv)), conv)
+
+      num_ops = len(graph.get_operations())
+      start = time.time()
+      px_grads = rule_class(conv.op)(filters, z_grads)
+      build_time = time.time() - start
+      num_ops = len(graph.get_operations()) - num_ops
+
+      with tf.Session() as sess:
+        try:
+          sess.run(px_grads.op)  # warm up
+        except tf.errors.InvalidArgumentError:
+          sys.stderr.write("%s: grouped convolutions are not supported\n"
+                           % name)
+          return
+        self.run_op_benchmark(sess, px_grads.op, min_iters=10, name=name,
+                              extras={"num_ops": num_ops,
+                                      "build_time": build_time})
+
+  def _RunRules(self, batch_size, image_size, in_channels, out_channels):
+    for rule_name, rule_class in [
+        ("sliced", per_example_gradients.Conv2DPXG),
+        ("batched", per_example_gradients.BatchedConv2DPXG)]:
+      name = "conv_%dx%dx%d_%d_batch_%d_%s" % (
+          image_size, image_size, in_channels, out_channels, batch_size,
+          rule_name)
+      self._RunRule(name, rule_class, batch_size, image_size, in_channels,
+                    out_channels)
+
+  def benchmarkConv1(self):
+    for batch_size in [16, 64, 256]:
+      self._RunRules(batch_size, 28, 1, 128)
+
+  def benchmarkConv2(self):
+    for batch_size in [16, 64]:
+      self._RunRules(batch_size, 14, 128, 128)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -0,0 +1,76 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the per-example gradient rules of Conv2D."""
+
+import numpy as np
+import tensorflow as tf
+
+from differential_privacy.dp_sgd.per_example_gradients import per_example_gradients
+
+
+class Conv2DPXGTest(tf.test.TestCase):
+
+  def _CheckConv2D(self, image_shape, filter_shape, strides, padding):
+    rng = np.random.RandomState(0)
+    images = tf.constant(rng.randn(*image_shape), dtype=tf.float32)
+    filters = tf.constant(rng.randn(*filter_shape), dtype=tf.float32)
+    conv = tf.nn.conv2d(images, filters, strides=strides, padding=padding)
+    # A cost that is additive across examples, with a different gradient on
+    # every output.
+    loss = tf.reduce_sum(
+        conv * tf.constant(rng.randn(*conv.get_shape().as_list()),
+                           dtype=tf.float32))
+
+    px_grads, = per_example_gradients.PerExampleGradients(loss, [filters])
+    z_grads = tf.gradients(loss, conv)
+    batched_px_grads = per_example_gradients.BatchedConv2DPXG(conv.op)(
+        filters, z_grads)
+    # The sum over examples must be the gradient of the whole minibatch.
+    grads, = tf.gradients(loss, filters)
+
+    with self.test_session() as sess:
+      px_grads, grads = sess.run([px_grads, grads])
+      try:
+        batched_px_grads = sess.run(batched_px_grads)
+      except tf.errors.InvalidArgumentError:
+        batched_px_grads = None
+    self.assertEqual((image_shape[0],) + filter_shape, px_grads.shape)
+    self.assertAllClose(grads, px_grads.sum(axis=0), rtol=1e-4, atol=1e-4)
+    if batched_px_grads is None:
+      self.skipTest("This TensorFlow does not support grouped convolutions.")
+    self.assertAllClose(px_grads, batched_px_grads, rtol=1e-4, atol=1e-4)
+
+  def testConv2DValid(self):
+    self._CheckConv2D((4, 9, 9, 3), (3, 3, 3, 5), [1, 1, 1, 1], "VALID")
+
+  def testConv2DSame(self):
+    self._CheckConv2D((4, 9, 9, 3), (5, 5, 3, 5), [1, 1, 1, 1], "SAME")
+
+  def testConv2DStrided(self):
+    self._CheckConv2D((3, 10, 11, 2), (4, 3, 2, 6), [1, 2, 3, 1], "VALID")
+    self._CheckConv2D((3, 10, 11, 2), (4, 3, 2, 6), [1, 2, 3, 1], "SAME")
+
+  def testRegistry(self):
+    images = tf.zeros([2, 5, 5, 1])
+    filters = tf.zeros([3, 3, 1, 2])
+    conv = tf.nn.conv2d(images, filters, strides=[1, 1, 1, 1],
+                        padding="SAME")
+    self.assertIsInstance(per_example_gradients.pxg_registry(conv.op),
+                          per_example_gradients.Conv2DPXG)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -39,6 +39,22 @@ def labels_from_probs(probs):
   return np.asarray(labels, dtype=np.int32)
 
 
+def vote_counts(labels, nb_labels):
+  """
+  Helper function: counts the votes of an ensemble of models for each class
+  :param labels: 2d array (model id, sample id) of labels
+  :param nb_labels: number of classes
+  :return: 2d array (sample id, class) of vote counts
+  """
+  nb_samples = np.shape(labels)[1]
+
+  # Give each (sample, class) pair its own bin, and count all votes at once
+  bins = np.asarray(labels) + nb_labels * np.arange(nb_samples)
+  counts = np.bincount(bins.ravel(), minlength=nb_samples * nb_labels)
+
+  return counts.reshape((nb_samples, nb_labels))
+
+
 def noisy_max(logits, lap_scale, return_clean_votes=False):
   """
   This aggregation mechanism takes the softmax/logit output of several models
@@ -60,31 +76,20 @@ def noisy_max(logits, lap_scale, return_clean_votes=False):
   labels_shape = np.shape(labels)
   labels = labels.reshape((labels_shape[0], labels_shape[1]))
 
-  # Initialize array to hold final labels
-  result = np.zeros(int(labels_shape[1]))
+  # Count number of votes assigned to each class, for all samples at once
+  label_counts = vote_counts(labels, np.shape(logits)[-1])
 
   if return_clean_votes:
-    # Initialize array to hold clean votes for each sample
-    clean_votes = np.zeros((int(labels_shape[1]), 10))
-
-  # Parse each sample
-  for i in xrange(int(labels_shape[1])):
-    # Count number of votes assigned to each class
-    label_counts = np.bincount(labels[:, i], minlength=10)
+    # Store vote counts for export
+    clean_votes = np.asarray(label_counts, dtype=np.float64)
 
-    if return_clean_votes:
-      # Store vote counts for export
-      clean_votes[i] = label_counts
+  # Sample independent Laplacian noise for each sample and class, in the same
+  # order as drawing it class by class for each sample in turn
+  noisy_counts = np.asarray(label_counts, dtype=np.float32) + np.random.laplace(
+      loc=0.0, scale=float(lap_scale), size=label_counts.shape)
 
-    # Cast in float32 to prepare before addition of Laplacian noise
-    label_counts = np.asarray(label_counts, dtype=np.float32)
-
-    # Sample independent Laplacian noise for each class
-    for item in xrange(10):
-      label_counts[item] += np.random.laplace(loc=0.0, scale=float(lap_scale))
-
-    # Result is the most frequent label
-    result[i] = np.argmax(label_counts)
+  # Result is the most frequent label
+  result = np.argmax(noisy_counts, axis=1)
 
   # Cast labels to np.int32 for compatibility with deep_cnn.py feed dictionaries
   result = np.asarray(result, dtype=np.int32)
@@ -113,19 +118,10 @@ def aggregation_most_frequent(logits):
   labels_shape = np.shape(labels)
   labels = labels.reshape((labels_shape[0], labels_shape[1]))
 
-  # Initialize array to hold final labels
-  result = np.zeros(int(labels_shape[1]))
-
-  # Parse each sample
-  for i in xrange(int(labels_shape[1])):
-    # Count number of votes assigned to each class
-    label_counts = np.bincount(labels[:, i], minlength=10)
+  # Count number of votes assigned to each class, for all samples at once
+  label_counts = vote_counts(labels, np.shape(logits)[-1])
 
-    label_counts = np.asarray(label_counts, dtype=np.int32)
-
-    # Result is the most frequent label
-    result[i] = np.argmax(label_counts)
+  # Result is the most frequent label
+  result = np.argmax(label_counts, axis=1)
 
   return np.asarray(result, dtype=np.int32)
-
-
@@ -0,0 +1,74 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for the vectorized aggregation mechanisms."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from differential_privacy.multiple_teachers import aggregation
+
+
+def _noisy_max_per_sample(logits, lap_scale):
+  """The per-sample implementation of noisy_max, for reference."""
+  labels = aggregation.labels_from_probs(logits)
+  nb_labels = np.shape(logits)[-1]
+  result = np.zeros(labels.shape[1], dtype=np.int32)
+  clean_votes = np.zeros((labels.shape[1], nb_labels))
+  for i in range(labels.shape[1]):
+    label_counts = np.bincount(labels[:, i], minlength=nb_labels)
+    clean_votes[i] = label_counts
+    label_counts = np.asarray(label_counts, dtype=np.float32)
+    for item in range(nb_labels):
+      label_counts[item] += np.random.laplace(loc=0.0, scale=float(lap_scale))
+    result[i] = np.argmax(label_counts)
+  return result, clean_votes, labels
+
+
+class AggregationTest(tf.test.TestCase):
+
+  def _random_logits(self, nb_teachers, nb_samples, nb_labels):
+    return np.random.RandomState(0).randn(nb_teachers, nb_samples, nb_labels)
+
+  def testVoteCounts(self):
+    labels = np.array([[0, 1, 2], [0, 2, 2]])
+    self.assertAllEqual([[2, 0, 0], [0, 1, 1], [0, 0, 2]],
+                        aggregation.vote_counts(labels, 3))
+
+  def testNoisyMaxMatchesPerSample(self):
+    for nb_labels in [2, 10, 17]:
+      logits = self._random_logits(50, 200, nb_labels)
+
+      np.random.seed(1)
+      expected = _noisy_max_per_sample(logits, 10)
+      np.random.seed(1)
+      result = aggregation.noisy_max(logits, 10, return_clean_votes=True)
+
+      for expected_array, array in zip(expected, result):
+        self.assertAllEqual(expected_array, array)
+      self.assertEqual(np.int32, result[0].dtype)
+
+  def testMostFrequent(self):
+    logits = self._random_logits(50, 200, 7)
+    counts = aggregation.vote_counts(aggregation.labels_from_probs(logits), 7)
+    self.assertAllEqual(np.argmax(counts, axis=1),
+                        aggregation.aggregation_most_frequent(logits))
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -62,6 +62,8 @@ tf.flags.DEFINE_integer("max_examples",1000,
     " or indices_file to do the privacy cost estimate")
 tf.flags.DEFINE_float("too_small", 1e-10, "Small threshold to avoid log of 0")
 tf.flags.DEFINE_bool("input_is_counts", False, "False if labels, True if counts")
+tf.flags.DEFINE_integer("nb_labels", 10,
+    "Number of classes, used when the input is labels")
 
 FLAGS = tf.flags.FLAGS
 
@@ -211,6 +213,133 @@ def smoothed_sens(counts, noise_eps, l, beta):
   return smoothed_sensitivity
 
 
+# The functions below compute the same values as the ones above, for all the
+# rows of a (examples, classes) count matrix at once.
+
+
+def compute_q_noisy_max_batch(counts, noise_eps):
+  """returns ~ Pr[outcome != winner] for each row of counts.
+
+  Args:
+    counts: an array of scores, with classes on the last axis
+    noise_eps: privacy parameter for noisy_max
+  Returns:
+    q: array of the probabilities that outcome is different from true winner.
+  """
+  counts = np.asarray(counts, dtype=np.float64)
+  gaps = -noise_eps * (counts - np.max(counts, axis=-1, keepdims=True))
+  terms = (gaps + 2.0) / (4.0 * np.exp(gaps))
+  # Leave out the term of the winner only, the first maximum as in
+  # compute_q_noisy_max, so that small q do not cancel.
+  winner = np.argmax(counts, axis=-1)
+  is_winner = np.arange(counts.shape[-1]) == winner[..., None]
+  q = np.sum(np.where(is_winner, 0.0, terms), axis=-1)
+  return np.minimum(q, 1.0 - (1.0/counts.shape[-1]))
+
+
+def logmgf_exact_batch(q, priv_eps, l):
+  """Computes logmgf_exact for an array of q.
+
+  Args:
+    q: array of pr of non-optimal outcome
+    priv_eps: eps parameter for DP
+    l: moment to compute.
+  Returns:
+    Array of upper bounds on logmgf
+  """
+  q = np.asarray(q, dtype=np.float64)
+  with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+    t_one = (1-q) * np.power((1-q) / (1 - math.exp(priv_eps) * q), l)
+    t_two = q * math.exp(priv_eps * l)
+    t = t_one + t_two
+    # Fall back to the privacy guarantee where the log is not defined, as
+    # logmgf_exact does on ValueError.
+    log_t = np.where((q < 0.5) & (t > 0), np.log(t), priv_eps * l)
+
+  return np.minimum(np.minimum(0.5 * priv_eps * priv_eps * l * (l + 1), log_t),
+                    priv_eps * l)
+
+
+def logmgf_from_counts_batch(counts, noise_eps, l):
+  """logmgf_from_counts for each row of counts."""
+  q = compute_q_noisy_max_batch(counts, noise_eps)
+  return logmgf_exact_batch(q, 2.0 * noise_eps, l)
+
+
+def sens_at_k_batch(counts, noise_eps, l, k):
+  """Return sensitivity at distance k for each row of counts.
+
+  Args:
+    counts: an array of scores, with classes on the last axis
+    noise_eps: noise parameter used
+    l: moment whose sensitivity is being computed
+    k: distances, broadcastable with the rows of counts
+  Returns:
+    sensitivity: array of sensitivities at distance k
+  """
+  counts = np.asarray(counts, dtype=np.float64)
+  k = np.asarray(k, dtype=np.float64)
+  shape = np.broadcast(counts[..., 0], k).shape
+  if 0.5 * noise_eps * l > 1:
+    print "l too large to compute sensitivity"
+    return np.zeros(shape)
+
+  # Move k (and k + 1) votes from the top count to the second one.
+  counts_sorted = -np.sort(-counts, axis=-1)
+  move = np.zeros(counts.shape[-1])
+  move[0] = -1
+  move[1] = 1
+  k = k[..., np.newaxis]
+  val = logmgf_from_counts_batch(counts_sorted + k * move, noise_eps, l)
+  val_changed = logmgf_from_counts_batch(counts_sorted + (k + 1) * move,
+                                         noise_eps, l)
+
+  # As in sens_at_k, the gap is checked on the first two unsorted counts.
+  gap_closed = counts[..., 0] < counts[..., 1] + k[..., 0]
+  return np.where(gap_closed, 0.0, val_changed - val)
+
+
+def smoothed_sens_batch(counts, noise_eps, l, beta, max_block_size=2**22):
+  """Compute beta-smooth sensitivity for each row of counts.
+
+  Args:
+    counts: 2-d array of scores, one row per example
+    noise_eps: noise parameter
+    l: moment of interest
+    beta: smoothness parameter
+    max_block_size: bound on the number of counts processed at once
+  Returns:
+    smooth_sensitivity: array of beta smooth upper bounds
+  """
+  counts = np.asarray(counts, dtype=np.float64)
+  nb_examples, nb_classes = counts.shape
+
+  # smoothed_sens stops after max(counts), or at the first distance k > 0
+  # with zero sensitivity. That is at the latest when the gap is closed.
+  max_k = np.minimum(np.ceil(np.max(counts, axis=1)),
+                     np.maximum(counts[:, 0] - counts[:, 1], 0) + 1)
+  max_k = int(np.max(max_k)) if nb_examples else 0
+  ks = np.arange(max_k + 1)
+
+  result = np.zeros(nb_examples)
+  block_size = max(1, max_block_size // ((max_k + 1) * nb_classes))
+  for start in xrange(0, nb_examples, block_size):
+    block = counts[start:start + block_size]
+    sens = sens_at_k_batch(block[:, np.newaxis, :], noise_eps, l, ks)
+
+    # Keep distances up to the first zero sensitivity after k = 0, and up to
+    # max(counts).
+    is_zero = (sens == 0.0) & (ks > 0)
+    first_zero = np.where(is_zero.any(axis=1), np.argmax(is_zero, axis=1),
+                          max_k)
+    last_k = np.minimum(first_zero, np.ceil(np.max(block, axis=1)))
+    smoothed = np.exp(-beta * ks) * sens
+    smoothed[ks > last_k[:, np.newaxis]] = -np.inf
+    result[start:start + block_size] = np.max(smoothed, axis=1)
+
+  return result
+
+
 def main(unused_argv):
   ##################################################################
   # If we are reproducing results from paper https://arxiv.org/abs/1610.05755,
@@ -236,10 +365,9 @@ def main(unused_argv):
   else:
     # In this case, the input is the raw predictions. Transform
     num_teachers, n = input_mat.shape
-    counts_mat = np.zeros((n, 10)).astype(np.int32)
-    for i in range(n):
-      for j in range(num_teachers):
-        counts_mat[i, input_mat[j, i]] += 1
+    bins = input_mat + FLAGS.nb_labels * np.arange(n)
+    counts_mat = np.bincount(bins.ravel(), minlength=n * FLAGS.nb_labels)
+    counts_mat = counts_mat.reshape((n, FLAGS.nb_labels)).astype(np.int32)
   n = counts_mat.shape[0]
   num_examples = min(n, FLAGS.max_examples)
 
@@ -251,17 +379,15 @@ def main(unused_argv):
 
   l_list = 1.0 + np.array(xrange(FLAGS.moments))
   beta = FLAGS.beta
-  total_log_mgf_nm = np.array([0.0 for _ in l_list])
-  total_ss_nm = np.array([0.0 for _ in l_list])
   noise_eps = FLAGS.noise_eps
-  
-  for i in indices:
-    total_log_mgf_nm += np.array(
-        [logmgf_from_counts(counts_mat[i], noise_eps, l)
-         for l in l_list])
-    total_ss_nm += np.array(
-        [smoothed_sens(counts_mat[i], noise_eps, l, beta)
-         for l in l_list])
+
+  counts_used = counts_mat[indices]
+  total_log_mgf_nm = np.array(
+      [np.sum(logmgf_from_counts_batch(counts_used, noise_eps, l))
+       for l in l_list])
+  total_ss_nm = np.array(
+      [np.sum(smoothed_sens_batch(counts_used, noise_eps, l, beta))
+       for l in l_list])
   delta = FLAGS.delta
 
   # We want delta = exp(alpha - eps l).
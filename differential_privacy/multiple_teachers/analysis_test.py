@@ -0,0 +1,85 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests that the batched privacy analysis matches the per-example one."""
+
+import numpy as np
+import tensorflow as tf
+
+from differential_privacy.multiple_teachers import analysis
+
+
+class AnalysisTest(tf.test.TestCase):
+
+  def _random_counts(self, nb_examples, nb_teachers, nb_labels):
+    # Skewed votes, so that some examples have large gaps and some small ones.
+    rng = np.random.RandomState(0)
+    probs = rng.dirichlet(0.3 * np.ones(nb_labels), size=nb_examples)
+    return np.array([rng.multinomial(nb_teachers, p) for p in probs])
+
+  def testComputeQNoisyMax(self):
+    for nb_labels in [2, 10, 17]:
+      counts = self._random_counts(100, 250, nb_labels)
+      expected = [analysis.compute_q_noisy_max(c, 0.1) for c in counts]
+      self.assertAllClose(expected,
+                          analysis.compute_q_noisy_max_batch(counts, 0.1))
+
+  def testComputeQNoisyMaxLargeGaps(self):
+    # Confident votes give q far below the float64 precision of 0.5.
+    rng = np.random.RandomState(1)
+    counts = np.array([rng.multinomial(250, p) for p in
+                       rng.dirichlet(0.05 * np.ones(10), size=300)])
+    counts[:3] = [[250] + [0] * 9, [125, 125] + [0] * 8, [0] * 9 + [250]]
+    expected = [analysis.compute_q_noisy_max(c, 0.3) for c in counts]
+    self.assertLess(min(expected), 1e-20)
+    self.assertAllClose(expected,
+                        analysis.compute_q_noisy_max_batch(counts, 0.3),
+                        rtol=1e-12, atol=0)
+    for l in 1.0 + np.arange(8):
+      expected = [analysis.smoothed_sens(c, 0.3, l, 0.09) for c in counts]
+      self.assertAllClose(
+          expected,
+          analysis.smoothed_sens_batch(counts, 0.3, l, 0.09,
+                                       max_block_size=10000),
+          rtol=1e-9, atol=0)
+
+  def testLogmgfFromCounts(self):
+    counts = self._random_counts(100, 250, 10)
+    for l in 1.0 + np.arange(8):
+      expected = [analysis.logmgf_from_counts(c, 0.1, l) for c in counts]
+      self.assertAllClose(
+          expected, analysis.logmgf_from_counts_batch(counts, 0.1, l))
+
+  def testSensAtK(self):
+    counts = self._random_counts(100, 250, 10)
+    for k in [0, 1, 10, 100]:
+      expected = [analysis.sens_at_k(c, 0.1, 8.0, k) for c in counts]
+      self.assertAllClose(expected,
+                          analysis.sens_at_k_batch(counts, 0.1, 8.0, k))
+
+  def testSmoothedSens(self):
+    counts = self._random_counts(100, 250, 10)
+    # A noise_eps of 0.3 makes the larger moments too large to compute.
+    for noise_eps in [0.1, 0.3]:
+      for l in 1.0 + np.arange(8):
+        expected = [analysis.smoothed_sens(c, noise_eps, l, 0.09)
+                    for c in counts]
+        self.assertAllClose(
+            expected,
+            analysis.smoothed_sens_batch(counts, noise_eps, l, 0.09,
+                                         max_block_size=10000))
+
+
+if __name__ == '__main__':
+  tf.test.main()
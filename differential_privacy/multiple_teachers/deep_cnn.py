@@ -552,6 +552,20 @@ def softmax_preds(images, ckpt_path, return_logits=False):
   :param logits: if set to True, return logits instead of probabilities
   :return: probabilities (or logits if logits is set to True)
   """
+  return list(softmax_preds_many(images, [ckpt_path], return_logits))[0]
+
+
+def softmax_preds_many(images, ckpt_paths, return_logits=False):
+  """
+  Compute softmax activations (probabilities) with each of several models
+  sharing the same architecture, such as an ensemble of teachers. The graph
+  is built once, and the weights of each checkpoint are restored into it in
+  turn, instead of rebuilding the graph for each model.
+  :param images: a np array of images
+  :param ckpt_paths: a list of TF model checkpoints
+  :param return_logits: if set to True, yield logits instead of probabilities
+  :return: generator of probabilities (or logits), one array per checkpoint
+  """
   # Compute nb samples and deduce nb of batches
   data_length = len(images)
   nb_batches = math.ceil(len(images) / FLAGS.batch_size)
@@ -577,28 +591,30 @@ def softmax_preds(images, ckpt_path, return_logits=False):
   variables_to_restore = variable_averages.variables_to_restore()
   saver = tf.train.Saver(variables_to_restore)
 
-  # Will hold the result
-  preds = np.zeros((data_length, FLAGS.nb_labels), dtype=np.float32)
-
   # Create TF session
   with tf.Session() as sess:
-    # Restore TF session from checkpoint file
-    saver.restore(sess, ckpt_path)
+    for ckpt_path in ckpt_paths:
+      # Restore TF session from checkpoint file
+      saver.restore(sess, ckpt_path)
 
-    # Parse data by batch
-    for batch_nb in xrange(0, int(nb_batches+1)):
-      # Compute batch start and end indices
-      start, end = utils.batch_indices(batch_nb, data_length, FLAGS.batch_size)
+      # Will hold the result
+      preds = np.zeros((data_length, FLAGS.nb_labels), dtype=np.float32)
+
+      # Parse data by batch
+      for batch_nb in xrange(0, int(nb_batches+1)):
+        # Compute batch start and end indices
+        start, end = utils.batch_indices(batch_nb, data_length,
+                                         FLAGS.batch_size)
 
-      # Prepare feed dictionary
-      feed_dict = {train_data_node: images[start:end]}
+        # Prepare feed dictionary
+        feed_dict = {train_data_node: images[start:end]}
 
-      # Run session ([0] because run returns a batch with len 1st dim == 1)
-      preds[start:end, :] = sess.run([output], feed_dict=feed_dict)[0]
+        # Run session ([0] because run returns a batch with len 1st dim == 1)
+        preds[start:end, :] = sess.run([output], feed_dict=feed_dict)[0]
+
+      yield preds
 
   # Reset graph to allow multiple calls
   tf.reset_default_graph()
 
-  return preds
-
 
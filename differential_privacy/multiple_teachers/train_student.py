@@ -66,19 +66,54 @@ def ensemble_preds(dataset, nb_teachers, stdnt_data):
   # teacher, for each training point, and each output class
   result_shape = (nb_teachers, len(stdnt_data), FLAGS.nb_labels)
 
-  # Create array that will hold result
-  result = np.zeros(result_shape, dtype=np.float32)
+  # Predictions are streamed into a memory-mapped file, and the checkpoints
+  # of the teachers done so far are recorded next to it, so that an
+  # interrupted run resumes with the next teacher
+  if FLAGS.deeper:
+    filepath = FLAGS.data_dir + '/' + str(dataset) + '_' + str(nb_teachers) + '_teachers_preds_' + str(FLAGS.teachers_max_steps) + '_deep.npy' #NOLINT(long-line)
+  else:
+    filepath = FLAGS.data_dir + '/' + str(dataset) + '_' + str(nb_teachers) + '_teachers_preds_' + str(FLAGS.teachers_max_steps) + '.npy'  # NOLINT(long-line)
+  progress_filepath = filepath + '.progress'
 
-  # Get predictions from each teacher
+  # Compute paths of checkpoint files for all teacher models
+  ckpt_paths = []
   for teacher_id in xrange(nb_teachers):
-    # Compute path of checkpoint file for teacher model with ID teacher_id
     if FLAGS.deeper:
       ckpt_path = FLAGS.teachers_dir + '/' + str(dataset) + '_' + str(nb_teachers) + '_teachers_' + str(teacher_id) + '_deep.ckpt-' + str(FLAGS.teachers_max_steps - 1) #NOLINT(long-line)
     else:
       ckpt_path = FLAGS.teachers_dir + '/' + str(dataset) + '_' + str(nb_teachers) + '_teachers_' + str(teacher_id) + '.ckpt-' + str(FLAGS.teachers_max_steps - 1)  # NOLINT(long-line)
-
-    # Get predictions on our training data and store in result array
-    result[teacher_id] = deep_cnn.softmax_preds(stdnt_data, ckpt_path)
+    ckpt_paths.append(ckpt_path)
+
+  # Create array that will hold result, or reopen a partially written one.
+  # Teachers are only skipped if their checkpoint is the one (same path and
+  # modification time) that produced the stored predictions
+  nb_done = 0
+  if tf.gfile.Exists(filepath) and tf.gfile.Exists(progress_filepath):
+    result = np.lib.format.open_memmap(filepath, mode='r+')
+    if result.shape == result_shape:
+      with tf.gfile.Open(progress_filepath) as file_obj:
+        done_ckpts = file_obj.read().splitlines()
+      for ckpt_path, done_ckpt in zip(ckpt_paths, done_ckpts):
+        if done_ckpt != _ckpt_record(ckpt_path):
+          break
+        nb_done += 1
+      print("Resuming after " + str(nb_done) + " teachers")
+  if nb_done == 0:
+    result = np.lib.format.open_memmap(filepath, mode='w+', dtype=np.float32,
+                                       shape=result_shape)
+  _write_progress(progress_filepath, ckpt_paths[:nb_done])
+
+  if nb_done == nb_teachers:
+    return result
+
+  # Get predictions from each teacher, restoring its weights into one graph
+  preds = deep_cnn.softmax_preds_many(stdnt_data, ckpt_paths[nb_done:])
+  for teacher_id, teacher_preds in enumerate(preds, nb_done):
+    # Store predictions on our training data in result array, and make sure
+    # they are on disk before recording the teacher as done
+    result[teacher_id] = teacher_preds
+    result.flush()
+    _write_progress(progress_filepath, ckpt_paths[:teacher_id + 1])
 
     # This can take a while when there are a lot of teachers so output status
     print("Computed Teacher " + str(teacher_id) + " softmax predictions")
@@ -86,6 +121,36 @@ def ensemble_preds(dataset, nb_teachers, stdnt_data):
   return result
 
 
+def _ckpt_record(ckpt_path):
+  """
+  Identifies a teacher checkpoint by its path and modification time, for the
+  progress file of ensemble_preds().
+  :param ckpt_path: path of a TF model checkpoint
+  :return: one line string with the path and modification time
+  """
+  # V2 checkpoints are a set of files named after the checkpoint prefix
+  ckpt_file = ckpt_path + '.index'
+  if not tf.gfile.Exists(ckpt_file):
+    ckpt_file = ckpt_path
+  if not tf.gfile.Exists(ckpt_file):
+    return ckpt_path + '\t'
+  return ckpt_path + '\t' + str(tf.gfile.Stat(ckpt_file).mtime_nsec)
+
+
+def _write_progress(progress_filepath, ckpt_paths):
+  """
+  Atomically records the checkpoints of the teachers whose predictions are
+  stored by ensemble_preds().
+  :param progress_filepath: path of the progress file
+  :param ckpt_paths: checkpoints of the teachers done so far, in order
+  """
+  tmp_filepath = progress_filepath + '.tmp'
+  with tf.gfile.Open(tmp_filepath, 'w') as file_obj:
+    file_obj.write(''.join(_ckpt_record(ckpt_path) + '\n'
+                           for ckpt_path in ckpt_paths))
+  tf.gfile.Rename(tmp_filepath, progress_filepath, overwrite=True)
+
+
 def prepare_student_data(dataset, nb_teachers, save=False):
   """
   Takes a dataset name and the size of the teacher ensemble and prepares
@@ -36,11 +36,20 @@ delta. The example code would be:
     log_moments.append((lmbd, log_moment))
   eps, delta = get_privacy_spent(log_moments, target_delta=delta)
 
+compute_log_moments(q, sigma, steps, lmbds) computes the log moments for all
+orders and step counts of a phase at once, and can reuse the moments kept in a
+LogMomentCache, so the loops above reduce to summing its rows over the phases.
+For a single (q, sigma), get_privacy_spent_for_steps(q, sigma, steps,
+target_delta=delta, cache_file=...) gives the (eps, delta) pairs after each of
+the given step counts in one call.
+
 To verify that the I1 >= I2 (see comments in GaussianMomentsAccountant in
 accountant.py for the context), run the same loop above with verify=True
 passed to compute_log_moment.
 """
+import cPickle
 import math
+import os
 import sys
 
 import numpy as np
@@ -115,6 +124,49 @@ def compute_a(sigma, q, lmbd, verbose=False):
   return _to_np_float64(a_lambda_exact)
 
 
+def compute_a_batch(sigma, q, lmbds):
+  """Vectorized compute_a over an array of moment orders.
+
+  Evaluates the same binomial expansion as compute_a, with the terms summed
+  in the same order, so each entry equals compute_a(sigma, q, lmbd).
+
+  Args:
+    sigma: the noise sigma.
+    q: the sampling ratio.
+    lmbds: array of moment orders.
+  Returns:
+    np.float64 array of the moments, with np.inf where they overflow.
+  """
+  lmbd_ints = np.ceil(np.asarray(lmbds, dtype=np.float64)).astype(np.int64)
+  max_lmbd = max(int(np.max(lmbd_ints)), 0) if lmbd_ints.size else 0
+  orders = np.arange(max_lmbd + 1)
+
+  # s1[i] and s2[i] are the inner sums of compute_a for every i at once,
+  # accumulated over increasing j as the scalar loop does.
+  s1 = np.zeros(max_lmbd + 1)
+  s2 = np.zeros(max_lmbd + 1)
+  with np.errstate(over="ignore", invalid="ignore"):
+    for j in xrange(max_lmbd + 1):
+      rows = orders[j:]
+      coef_j = (scipy.special.binom(rows, j) *
+                np.where((rows - j) % 2, -1.0, 1.0))
+      s1[j:] += coef_j * np.exp((j * j - j) / (2.0 * (sigma ** 2)))
+      s2[j:] += coef_j * np.exp((j * j + j) / (2.0 * (sigma ** 2)))
+
+    first_term = np.zeros(lmbd_ints.shape)
+    second_term = np.zeros(lmbd_ints.shape)
+    for i in xrange(max_lmbd + 1):
+      used = lmbd_ints >= i
+      coef_i = scipy.special.binom(lmbd_ints[used], i) * (q ** i)
+      first_term[used] += coef_i * s1[i]
+      second_term[used] += coef_i * s2[i]
+
+    a_lambda = (1.0 - q) * first_term + q * second_term
+  a_lambda[~np.isfinite(a_lambda)] = np.inf
+  a_lambda[lmbd_ints == 0] = 1.0
+  return a_lambda
+
+
 def compute_b(sigma, q, lmbd, verbose=False):
   mu0, _, mu = distributions(sigma, q)
 
@@ -142,7 +194,6 @@ def compute_b(sigma, q, lmbd, verbose=False):
   if verbose:
     print "B: by numerical integration", b_lambda
     print "B must be no more than     ", b_bound
-  print b_lambda, b_bound
   return _to_np_float64(b_lambda)
 
 
@@ -289,9 +340,13 @@ def compute_log_moment(q, sigma, steps, lmbd, verify=False, verbose=False):
   """
   moment = compute_a(sigma, q, lmbd, verbose=verbose)
   if verify:
+    old_dps = mp.dps
     mp.dps = 50
-    moment_a_mp = compute_a_mp(sigma, q, lmbd, verbose=verbose)
-    moment_b_mp = compute_b_mp(sigma, q, lmbd, verbose=verbose)
+    try:
+      moment_a_mp = compute_a_mp(sigma, q, lmbd, verbose=verbose)
+      moment_b_mp = compute_b_mp(sigma, q, lmbd, verbose=verbose)
+    finally:
+      mp.dps = old_dps
     np.testing.assert_allclose(moment, moment_a_mp, rtol=1e-10)
     if not np.isinf(moment_a_mp):
       # The following test fails for (1, np.inf)!
@@ -302,6 +357,117 @@ def compute_log_moment(q, sigma, steps, lmbd, verify=False, verbose=False):
     return np.log(moment) * steps
 
 
+class LogMomentCache(object):
+  """A persistent cache of moments, keyed by (q, sigma, lmbd, precision).
+
+  The moments are stored before taking the log and multiplying by the number
+  of steps, so one entry serves every step count. The cache is kept in a
+  single pickle file, which save() merges with any entries written to it by
+  other processes and replaces atomically.
+  """
+
+  def __init__(self, filename=None):
+    self._filename = filename
+    self._moments = {}
+    self._dirty = False
+    if filename is not None and os.path.exists(filename):
+      self._moments = self._load(filename)
+
+  @staticmethod
+  def _load(filename):
+    with open(filename, "rb") as f:
+      return cPickle.load(f)
+
+  @staticmethod
+  def key(q, sigma, lmbd, precision):
+    return float(q), float(sigma), float(lmbd), precision
+
+  def get(self, q, sigma, lmbd, precision):
+    return self._moments.get(self.key(q, sigma, lmbd, precision))
+
+  def put(self, q, sigma, lmbd, precision, moment):
+    self._moments[self.key(q, sigma, lmbd, precision)] = np.float64(moment)
+    self._dirty = True
+
+  def save(self):
+    if self._filename is None or not self._dirty:
+      return
+    moments = {}
+    if os.path.exists(self._filename):
+      moments = self._load(self._filename)
+    moments.update(self._moments)
+    tmp_filename = "%s.tmp%d" % (self._filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+      cPickle.dump(moments, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, self._filename)
+    self._moments = moments
+    self._dirty = False
+
+
+def compute_moments(q, sigma, lmbds, precision=None, cache=None):
+  """Compute the moments of the Gaussian mechanism for many orders at once.
+
+  Args:
+    q: the sampling ratio.
+    sigma: the noise sigma.
+    lmbds: array of moment orders.
+    precision: if None, use the float64 binomial expansion of compute_a.
+      Otherwise the number of decimal digits used to compute the moments by
+      numerical integration with compute_a_mp.
+    cache: an optional LogMomentCache to read from and add to.
+  Returns:
+    np.float64 array of the moments, could contain np.inf.
+  """
+  lmbds = np.asarray(lmbds, dtype=np.float64)
+  moments = np.empty(lmbds.shape)
+  missing = np.ones(lmbds.shape, dtype=bool)
+  if cache is not None:
+    for idx, lmbd in np.ndenumerate(lmbds):
+      moment = cache.get(q, sigma, lmbd, precision)
+      if moment is not None:
+        moments[idx] = moment
+        missing[idx] = False
+
+  if np.any(missing):
+    if precision is None:
+      moments[missing] = compute_a_batch(sigma, q, lmbds[missing])
+    else:
+      old_dps = mp.dps
+      mp.dps = precision
+      try:
+        moments[missing] = [compute_a_mp(sigma, q, lmbd)
+                            for lmbd in lmbds[missing]]
+      finally:
+        mp.dps = old_dps
+    if cache is not None:
+      for idx in zip(*np.nonzero(missing)):
+        cache.put(q, sigma, lmbds[idx], precision, moments[idx])
+      cache.save()
+  return moments
+
+
+def compute_log_moments(q, sigma, steps, lmbds, precision=None, cache=None):
+  """Compute the log moments for many orders and step counts at once.
+
+  Args:
+    q: the sampling ratio.
+    sigma: the noise sigma.
+    steps: array of step counts.
+    lmbds: array of moment orders.
+    precision: see compute_moments.
+    cache: an optional LogMomentCache.
+  Returns:
+    np.float64 array of shape [len(steps), len(lmbds)], in which entry (i, j)
+    equals compute_log_moment(q, sigma, steps[i], lmbds[j]).
+  """
+  moments = compute_moments(q, sigma, lmbds, precision=precision, cache=cache)
+  with np.errstate(divide="ignore"):
+    log_moments = np.log(moments)
+  log_moments = np.outer(np.asarray(steps, dtype=np.float64), log_moments)
+  log_moments[:, np.isinf(moments)] = np.inf
+  return log_moments
+
+
 def get_privacy_spent(log_moments, target_eps=None, target_delta=None):
   """Compute delta (or eps) for given eps (or delta) from log moments.
 
@@ -321,3 +487,57 @@ def get_privacy_spent(log_moments, target_eps=None, target_delta=None):
     return (target_eps, _compute_delta(log_moments, target_eps))
   else:
     return (_compute_eps(log_moments, target_delta), target_delta)
+
+
+def get_privacy_spent_for_steps(q, sigma, steps, lmbds=None, target_eps=None,
+                                target_delta=None, precision=None,
+                                cache_file=None):
+  """Compute delta (or eps) after each of many step counts in one call.
+
+  Args:
+    q: the sampling ratio.
+    sigma: the noise sigma.
+    steps: array of step counts.
+    lmbds: the moment orders to optimize over, 1 to 32 if None.
+    target_eps: if not None, the epsilon for which we would like to compute
+      corresponding delta values.
+    target_delta: if not None, the delta for which we would like to compute
+      corresponding epsilon values. Exactly one of target_eps and target_delta
+      is None.
+    precision: see compute_moments.
+    cache_file: if not None, a file in which to cache the moments between
+      calls and processes.
+  Returns:
+    a list of eps, delta pairs, one per step count, equal to what
+    get_privacy_spent gives for the log moments after that many steps.
+  """
+  assert (target_eps is None) ^ (target_delta is None)
+  if lmbds is None:
+    lmbds = range(1, 33)
+  lmbds = np.asarray(lmbds, dtype=np.float64)
+  steps = np.asarray(steps)
+  log_moments = compute_log_moments(q, sigma, steps, lmbds,
+                                    precision=precision,
+                                    cache=LogMomentCache(cache_file))
+
+  used = lmbds != 0
+  for moment_order in lmbds[used & np.isinf(log_moments).any(axis=0)]:
+    sys.stderr.write("The %d-th order is inf or Nan\n" % moment_order)
+  used &= ~np.isinf(log_moments).any(axis=0)
+  log_moments = log_moments[:, used]
+  lmbds = lmbds[used]
+
+  # With no usable order, get_privacy_spent gives its initial delta (or eps).
+  if target_eps is not None:
+    if not lmbds.size:
+      return [(target_eps, 1.0)] * len(steps)
+    # exp is monotonic, so the smallest delta comes from the smallest
+    # exponent.
+    exponents = np.min(log_moments - lmbds * target_eps, axis=1)
+    return [(target_eps, math.exp(exponent) if exponent < 0 else 1.0)
+            for exponent in exponents]
+  else:
+    if not lmbds.size:
+      return [(float("inf"), target_delta)] * len(steps)
+    epss = (log_moments - math.log(target_delta)) / lmbds
+    return [(eps, target_delta) for eps in np.min(epss, axis=1)]
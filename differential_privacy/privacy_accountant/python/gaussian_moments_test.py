@@ -0,0 +1,91 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests that the batched log moments match the scalar ones exactly."""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from differential_privacy.privacy_accountant.python import gaussian_moments
+
+
+class GaussianMomentsTest(tf.test.TestCase):
+
+  def testComputeABatch(self):
+    lmbds = [0, 0.5, 1, 2, 3.5, 8, 17, 32, 64]
+    for q, sigma in [(0.01, 4.0), (0.1, 1.0), (0.5, 0.5)]:
+      expected = [gaussian_moments.compute_a(sigma, q, lmbd)
+                  for lmbd in lmbds]
+      self.assertAllEqual(expected,
+                          gaussian_moments.compute_a_batch(sigma, q, lmbds))
+
+  def testLogMomentCache(self):
+    cache_file = os.path.join(self.get_temp_dir(), "moments.pkl")
+    lmbds = np.arange(1, 33)
+    steps = [1, 10, 1000]
+    expected = [[gaussian_moments.compute_log_moment(0.01, 4.0, t, lmbd)
+                 for lmbd in lmbds] for t in steps]
+
+    cache = gaussian_moments.LogMomentCache(cache_file)
+    self.assertAllEqual(expected, gaussian_moments.compute_log_moments(
+        0.01, 4.0, steps, lmbds, cache=cache))
+    self.assertEqual(
+        gaussian_moments.compute_a(4.0, 0.01, 3),
+        gaussian_moments.LogMomentCache(cache_file).get(0.01, 4.0, 3, None))
+
+    # A cache that was saved to disk gives the same log moments.
+    self.assertAllEqual(expected, gaussian_moments.compute_log_moments(
+        0.01, 4.0, steps, lmbds,
+        cache=gaussian_moments.LogMomentCache(cache_file)))
+
+  def testComputeMomentsRestoresPrecision(self):
+    dps = gaussian_moments.mp.dps
+    moments = gaussian_moments.compute_moments(0.1, 1.0, [1, 2],
+                                               precision=dps + 10)
+    self.assertAllClose(gaussian_moments.compute_a_batch(1.0, 0.1, [1, 2]),
+                        moments)
+    self.assertEqual(dps, gaussian_moments.mp.dps)
+
+  def testGetPrivacySpentForSteps(self):
+    lmbds = range(1, 33)
+    steps = [1, 100, 10000]
+    for q, sigma in [(0.01, 4.0), (0.1, 1.0), (0.5, 0.5)]:
+      log_moments = [[(lmbd, gaussian_moments.compute_log_moment(
+          q, sigma, t, lmbd)) for lmbd in lmbds] for t in steps]
+      self.assertEqual(
+          [gaussian_moments.get_privacy_spent(l, target_delta=1e-5)
+           for l in log_moments],
+          gaussian_moments.get_privacy_spent_for_steps(
+              q, sigma, steps, lmbds, target_delta=1e-5))
+      self.assertEqual(
+          [gaussian_moments.get_privacy_spent(l, target_eps=2.0)
+           for l in log_moments],
+          gaussian_moments.get_privacy_spent_for_steps(
+              q, sigma, steps, lmbds, target_eps=2.0))
+
+  def testGetPrivacySpentForStepsNoOrders(self):
+    self.assertEqual(
+        [gaussian_moments.get_privacy_spent([], target_delta=1e-5)] * 2,
+        gaussian_moments.get_privacy_spent_for_steps(
+            0.01, 4.0, [1, 10], [], target_delta=1e-5))
+    self.assertEqual(
+        [gaussian_moments.get_privacy_spent([], target_eps=2.0)] * 2,
+        gaussian_moments.get_privacy_spent_for_steps(
+            0.01, 4.0, [1, 10], [], target_eps=2.0))
+
+
+if __name__ == "__main__":
+  tf.test.main()
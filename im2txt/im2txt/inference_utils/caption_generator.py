@@ -116,7 +116,8 @@ class CaptionGenerator(object):
                vocab,
                beam_size=3,
                max_caption_length=20,
-               length_normalization_factor=0.0):
+               length_normalization_factor=0.0,
+               state_cache=None):
     """Initializes the generator.
 
     Args:
@@ -130,6 +131,8 @@ class CaptionGenerator(object):
         scored by logprob/length^x, rather than logprob. This changes the
         relative scores of captions depending on their lengths. For example, if
         x > 0 then longer captions will be favored.
+      state_cache: Optional ImageStateCache. If given, the initial states of
+        previously seen images are reused rather than recomputed.
     """
     self.vocab = vocab
     self.model = model
@@ -137,6 +140,13 @@ class CaptionGenerator(object):
     self.beam_size = beam_size
     self.max_caption_length = max_caption_length
     self.length_normalization_factor = length_normalization_factor
+    self.state_cache = state_cache
+
+  def _feed_image(self, sess, encoded_image):
+    """Returns the initial state for an image, using the cache if any."""
+    if self.state_cache is None:
+      return self.model.feed_image(sess, encoded_image)
+    return self.state_cache.feed_image(self.model, sess, encoded_image)
 
   def beam_search(self, sess, encoded_image):
     """Runs beam search caption generation on a single image.
@@ -149,7 +159,7 @@ class CaptionGenerator(object):
       A list of Caption sorted by descending score.
     """
     # Feed in the image to get the initial state.
-    initial_state = self.model.feed_image(sess, encoded_image)
+    initial_state = self._feed_image(sess, encoded_image)
 
     initial_beam = Caption(
         sentence=[self.vocab.start_id],
@@ -209,3 +219,100 @@ class CaptionGenerator(object):
       complete_captions = partial_captions
 
     return complete_captions.extract(sort=True)
+
+  def beam_search_batch(self, sess, encoded_images):
+    """Runs beam search caption generation on a batch of images.
+
+    The partial captions of all images are kept in flat arrays, so that each
+    step of the search is a single call to inference_step() for the whole
+    batch. The results are the same as calling beam_search() on each image.
+
+    Args:
+      sess: TensorFlow Session object.
+      encoded_images: A list of encoded image strings.
+
+    Returns:
+      A list with one entry per image, each a list of Caption sorted by
+      descending score.
+    """
+    num_images = len(encoded_images)
+
+    # Feed in the images to get the initial states. Each row of the arrays below
+    # is a partial caption of image image_ids[row].
+    states = np.concatenate(
+        [self._feed_image(sess, image) for image in encoded_images])
+    image_ids = np.arange(num_images)
+    sentences = np.empty([num_images, 1], dtype=np.int64)
+    sentences.fill(self.vocab.start_id)
+    logprobs = np.zeros([num_images])
+    metadata_lists = [[""] for _ in range(num_images)]
+
+    complete_captions = [TopN(self.beam_size) for _ in range(num_images)]
+
+    # Run beam search.
+    for _ in range(self.max_caption_length - 1):
+      softmax, new_states, metadata = self.model.inference_step(
+          sess, sentences[:, -1], states)
+
+      # For each partial caption, get the beam_size most probable next words.
+      k = min(self.beam_size, softmax.shape[1])
+      rows = np.arange(len(softmax))[:, np.newaxis]
+      words = np.argpartition(-softmax, k - 1, axis=1)[:, :k]
+      probs = softmax[rows, words]
+
+      # Each next word gives a new partial caption; avoid log(0).
+      parents, slots = np.nonzero(probs >= 1e-12)
+      words = words[parents, slots]
+      candidate_logprobs = logprobs[parents] + np.log(probs[parents, slots])
+
+      is_end = words == self.vocab.end_id
+      for i in np.flatnonzero(is_end):
+        parent = parents[i]
+        sentence = sentences[parent].tolist() + [int(words[i])]
+        score = candidate_logprobs[i]
+        if self.length_normalization_factor > 0:
+          score /= len(sentence)**self.length_normalization_factor
+        if metadata:
+          metadata_list = metadata_lists[parent] + [metadata[parent]]
+        else:
+          metadata_list = None
+        complete_captions[image_ids[parent]].push(
+            Caption(sentence, new_states[parent], candidate_logprobs[i], score,
+                    metadata_list))
+
+      # Keep the beam_size best remaining candidates of each image.
+      parents = parents[~is_end]
+      words = words[~is_end]
+      candidate_logprobs = candidate_logprobs[~is_end]
+
+      order = np.lexsort((-candidate_logprobs, image_ids[parents]))
+      candidate_images = image_ids[parents[order]]
+      group_starts = np.searchsorted(candidate_images, candidate_images)
+      order = order[np.arange(len(order)) - group_starts < self.beam_size]
+
+      parents = parents[order]
+      image_ids = image_ids[parents]
+      sentences = np.hstack([sentences[parents], words[order, np.newaxis]])
+      states = new_states[parents]
+      logprobs = candidate_logprobs[order]
+      if metadata:
+        metadata_lists = [metadata_lists[p] + [metadata[p]] for p in parents]
+      else:
+        metadata_lists = [None] * len(parents)
+
+      if not len(parents):
+        # We have run out of partial candidates; happens when beam_size = 1.
+        break
+
+    # If an image has no complete captions then fall back to its partial
+    # captions, but never output a mixture of the two.
+    results = []
+    for image_id, captions in enumerate(complete_captions):
+      if not captions.size():
+        for row in np.flatnonzero(image_ids == image_id):
+          captions.push(Caption(sentences[row].tolist(), states[row],
+                                logprobs[row], logprobs[row],
+                                metadata_lists[row]))
+      results.append(captions.extract(sort=True))
+
+    return results
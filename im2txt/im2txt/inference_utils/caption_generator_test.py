@@ -89,6 +89,49 @@ class FakeModel(object):
   # pylint: enable=unused-argument
 
 
+class ImageDependentFakeModel(FakeModel):
+  """Fake model whose next word distributions depend on the image.
+
+  The image is an index into a list of probability maps like the one of
+  FakeModel. It is carried through the model state, so each image follows its
+  own beams.
+  """
+
+  def __init__(self):
+    super(ImageDependentFakeModel, self).__init__()
+    self._image_probabilities = [
+        # Same as FakeModel.
+        self._probabilities,
+        # Finishes after one word, so the image leaves the batch early.
+        {0: {1: 0.6, 2: 0.4},
+         2: {1: 1.0}},
+        # Long captions, finishing at different steps.
+        {0: {3: 0.7, 4: 0.3},
+         3: {1: 0.2, 5: 0.8},
+         4: {1: 1.0},
+         5: {1: 0.1, 6: 0.9},
+         6: {1: 0.35, 7: 0.65},
+         7: {1: 1.0}},
+    ]
+
+  # pylint: disable=unused-argument
+
+  def feed_image(self, sess, encoded_image):
+    return np.array([[encoded_image]], dtype=np.float64)
+
+  def inference_step(self, sess, input_feed, state_feed):
+    batch_size = input_feed.shape[0]
+    softmax_output = np.zeros([batch_size, self._vocab_size])
+    for batch_index, word_id in enumerate(input_feed):
+      probabilities = self._image_probabilities[int(state_feed[batch_index, 0])]
+      for next_word, probability in probabilities[word_id].items():
+        softmax_output[batch_index, next_word] = probability
+
+    return softmax_output, np.array(state_feed), None
+
+  # pylint: enable=unused-argument
+
+
 class CaptionGeneratorTest(tf.test.TestCase):
 
   def _assertExpectedCaptions(self,
@@ -123,6 +166,17 @@ class CaptionGeneratorTest(tf.test.TestCase):
     self.assertEqual(expected_sentences, actual_sentences)
     self.assertAllClose(expected_probabilities, actual_probabilities)
 
+    # Batched beam search should generate the same captions for each image.
+    batch_captions = generator.beam_search_batch(
+        sess=None, encoded_images=[None, None, None])
+    self.assertEqual(3, len(batch_captions))
+    for actual_captions in batch_captions:
+      actual_sentences = [c.sentence for c in actual_captions]
+      actual_probabilities = [math.exp(c.logprob) for c in actual_captions]
+
+      self.assertEqual(expected_sentences, actual_sentences)
+      self.assertAllClose(expected_probabilities, actual_probabilities)
+
   def testBeamSize(self):
     # Beam size = 1.
     expected = [([0, 4, 10, 1], 0.16)]
@@ -173,6 +227,37 @@ class CaptionGeneratorTest(tf.test.TestCase):
     self._assertExpectedCaptions(
         expected, beam_size=4, length_normalization_factor=3)
 
+  def testBatchImageDependent(self):
+    # Images with different captions, that finish at different steps, give the
+    # same captions in a batch as on their own.
+    images = [2, 0, 1, 2, 1]
+    for beam_size in [1, 2, 3]:
+      for max_caption_length in [2, 3, 4, 20]:
+        generator = caption_generator.CaptionGenerator(
+            model=ImageDependentFakeModel(),
+            vocab=FakeVocab(),
+            beam_size=beam_size,
+            max_caption_length=max_caption_length)
+        batch_captions = generator.beam_search_batch(
+            sess=None, encoded_images=images)
+        self.assertEqual(len(images), len(batch_captions))
+        for image, actual_captions in zip(images, batch_captions):
+          expected_captions = generator.beam_search(
+              sess=None, encoded_image=image)
+          self.assertEqual([c.sentence for c in expected_captions],
+                           [c.sentence for c in actual_captions])
+          self.assertAllClose([c.logprob for c in expected_captions],
+                              [c.logprob for c in actual_captions])
+          self.assertAllClose([c.score for c in expected_captions],
+                              [c.score for c in actual_captions])
+
+    # The images really do get different captions.
+    generator = caption_generator.CaptionGenerator(
+        model=ImageDependentFakeModel(), vocab=FakeVocab(), beam_size=3)
+    best = [c[0].sentence for c in generator.beam_search_batch(
+        sess=None, encoded_images=[0, 1, 2])]
+    self.assertEqual([[0, 2, 6, 1], [0, 1], [0, 3, 5, 6, 7, 1]], best)
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -0,0 +1,107 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Cache of the initial model states produced by feed_image()."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import os
+
+
+import numpy as np
+
+
+class ImageStateCache(object):
+  """Caches initial model states, keyed by the content of the encoded image.
+
+  States are kept in an in-memory LRU tier and, optionally, in an on-disk tier
+  of .npy files that survives across processes. The cached states depend on the
+  model, so a cache directory should only be shared by runs of the same model
+  checkpoint (or a distinct key_prefix should be used for each checkpoint).
+  """
+
+  def __init__(self, capacity=1000, cache_dir=None, key_prefix=""):
+    """Initializes the cache.
+
+    Args:
+      capacity: Maximum number of states to keep in memory.
+      cache_dir: Optional directory for the on-disk tier.
+      key_prefix: String mixed into every key, e.g. the checkpoint path.
+    """
+    self._capacity = capacity
+    self._cache_dir = cache_dir
+    self._key_prefix = key_prefix
+    self._states = collections.OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+
+    if cache_dir and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def _key(self, encoded_image):
+    return hashlib.sha1(self._key_prefix.encode("utf-8") +
+                        encoded_image).hexdigest()
+
+  def _filename(self, key):
+    return os.path.join(self._cache_dir, key + ".npy")
+
+  def _remember(self, key, state):
+    self._states[key] = state
+    while len(self._states) > self._capacity:
+      self._states.popitem(last=False)
+
+  def get(self, encoded_image):
+    """Returns the cached state for an image, or None if it is not cached."""
+    key = self._key(encoded_image)
+
+    state = self._states.pop(key, None)
+    if state is None and self._cache_dir:
+      filename = self._filename(key)
+      if os.path.exists(filename):
+        state = np.load(filename)
+
+    if state is None:
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    self._remember(key, state)
+    return state
+
+  def put(self, encoded_image, state):
+    """Adds the state for an image to the cache."""
+    key = self._key(encoded_image)
+    self._remember(key, state)
+
+    if self._cache_dir:
+      # Write to a temporary file and rename it, so that concurrent readers
+      # never see a partially written file.
+      filename = self._filename(key)
+      tmp_filename = "%s.tmp.%d" % (filename, os.getpid())
+      with open(tmp_filename, "wb") as f:
+        np.save(f, state)
+      os.rename(tmp_filename, filename)
+
+  def feed_image(self, model, sess, encoded_image):
+    """Returns model.feed_image(sess, encoded_image), using the cache."""
+    state = self.get(encoded_image)
+    if state is None:
+      state = model.feed_image(sess, encoded_image)
+      self.put(encoded_image, state)
+    return state
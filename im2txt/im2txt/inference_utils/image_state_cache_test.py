@@ -0,0 +1,77 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Unit tests for ImageStateCache."""
+
+
+import numpy as np
+import tensorflow as tf
+
+from im2txt.inference_utils import image_state_cache
+
+
+class FakeModel(object):
+  """Fake model that counts calls to feed_image()."""
+
+  def __init__(self):
+    self.num_calls = 0
+
+  # pylint: disable=unused-argument
+
+  def feed_image(self, sess, encoded_image):
+    self.num_calls += 1
+    return np.array([[float(len(encoded_image))]])
+
+  # pylint: enable=unused-argument
+
+
+class ImageStateCacheTest(tf.test.TestCase):
+
+  def testMemoryTier(self):
+    model = FakeModel()
+    cache = image_state_cache.ImageStateCache(capacity=2)
+
+    self.assertAllEqual([[1.0]], cache.feed_image(model, None, b"a"))
+    self.assertAllEqual([[2.0]], cache.feed_image(model, None, b"bb"))
+    self.assertAllEqual([[1.0]], cache.feed_image(model, None, b"a"))
+    self.assertEqual(2, model.num_calls)
+
+    # "bb" is the least recently used, so it is evicted.
+    cache.feed_image(model, None, b"ccc")
+    self.assertIsNone(cache.get(b"bb"))
+    self.assertAllEqual([[1.0]], cache.get(b"a"))
+
+  def testDiskTier(self):
+    model = FakeModel()
+    cache_dir = self.get_temp_dir()
+    cache = image_state_cache.ImageStateCache(
+        capacity=1, cache_dir=cache_dir, key_prefix="model")
+    cache.feed_image(model, None, b"a")
+    cache.feed_image(model, None, b"bb")
+
+    # A new cache over the same directory reuses the states.
+    cache = image_state_cache.ImageStateCache(
+        capacity=1, cache_dir=cache_dir, key_prefix="model")
+    self.assertAllEqual([[1.0]], cache.feed_image(model, None, b"a"))
+    self.assertAllEqual([[2.0]], cache.feed_image(model, None, b"bb"))
+    self.assertEqual(2, model.num_calls)
+
+    # A different key prefix does not.
+    cache = image_state_cache.ImageStateCache(
+        capacity=1, cache_dir=cache_dir, key_prefix="other")
+    self.assertIsNone(cache.get(b"a"))
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -27,6 +27,7 @@ import tensorflow as tf
 from im2txt import configuration
 from im2txt import inference_wrapper
 from im2txt.inference_utils import caption_generator
+from im2txt.inference_utils import image_state_cache
 from im2txt.inference_utils import vocabulary
 
 FLAGS = tf.flags.FLAGS
@@ -38,17 +39,34 @@ tf.flags.DEFINE_string("vocab_file", "", "Text file containing the vocabulary.")
 tf.flags.DEFINE_string("input_files", "",
                        "File pattern or comma-separated list of file patterns "
                        "of image files.")
+tf.flags.DEFINE_integer("batch_size", 8,
+                        "Number of images to caption in each beam search.")
+tf.flags.DEFINE_integer("state_cache_size", 0,
+                        "Number of initial image states to cache in memory; "
+                        "0 disables the cache.")
+tf.flags.DEFINE_string("state_cache_dir", "",
+                       "Optional directory in which to cache initial image "
+                       "states across runs.")
 
 tf.logging.set_verbosity(tf.logging.INFO)
 
 
 def main(_):
+  # Resolve the checkpoint file here, so that the state cache is keyed on the
+  # same file that restore_fn loads, even if training writes a newer one.
+  checkpoint_path = FLAGS.checkpoint_path
+  if tf.gfile.IsDirectory(checkpoint_path):
+    checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    if not checkpoint_path:
+      raise ValueError("No checkpoint file found in: %s" %
+                       FLAGS.checkpoint_path)
+
   # Build the inference graph.
   g = tf.Graph()
   with g.as_default():
     model = inference_wrapper.InferenceWrapper()
     restore_fn = model.build_graph_from_config(configuration.ModelConfig(),
-                                               FLAGS.checkpoint_path)
+                                               checkpoint_path)
   g.finalize()
 
   # Create the vocabulary.
@@ -67,18 +85,33 @@ def main(_):
     # Prepare the caption generator. Here we are implicitly using the default
     # beam search parameters. See caption_generator.py for a description of the
     # available beam search parameters.
-    generator = caption_generator.CaptionGenerator(model, vocab)
-
-    for filename in filenames:
-      with tf.gfile.GFile(filename, "r") as f:
-        image = f.read()
-      captions = generator.beam_search(sess, image)
-      print("Captions for image %s:" % os.path.basename(filename))
-      for i, caption in enumerate(captions):
-        # Ignore begin and end words.
-        sentence = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
-        sentence = " ".join(sentence)
-        print("  %d) %s (p=%f)" % (i, sentence, math.exp(caption.logprob)))
+    # Optionally cache the initial states so that repeated images skip the
+    # image model. The states depend on the checkpoint file, which is part of
+    # the cache key.
+    state_cache = None
+    if FLAGS.state_cache_size > 0 or FLAGS.state_cache_dir:
+      state_cache = image_state_cache.ImageStateCache(
+          capacity=FLAGS.state_cache_size,
+          cache_dir=FLAGS.state_cache_dir or None,
+          key_prefix=checkpoint_path)
+
+    generator = caption_generator.CaptionGenerator(
+        model, vocab, state_cache=state_cache)
+
+    for start in range(0, len(filenames), FLAGS.batch_size):
+      batch_filenames = filenames[start:start + FLAGS.batch_size]
+      images = []
+      for filename in batch_filenames:
+        with tf.gfile.GFile(filename, "r") as f:
+          images.append(f.read())
+      batch_captions = generator.beam_search_batch(sess, images)
+      for filename, captions in zip(batch_filenames, batch_captions):
+        print("Captions for image %s:" % os.path.basename(filename))
+        for i, caption in enumerate(captions):
+          # Ignore begin and end words.
+          sentence = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
+          sentence = " ".join(sentence)
+          print("  %d) %s (p=%f)" % (i, sentence, math.exp(caption.logprob)))
 
 
 if __name__ == "__main__":
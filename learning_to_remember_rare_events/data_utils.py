@@ -46,6 +46,83 @@ IMAGE_ORIGINAL_SIZE = 105
 IMAGE_NEW_SIZE = 28
 
 
+class EpisodeData(object):
+  """Examples of each label, held in one contiguous array.
+
+  The examples of the i-th label are examples[offsets[i]:offsets[i + 1]].
+  """
+
+  def __init__(self, data):
+    """Copies the examples of a dictionary mapping label to list of examples."""
+    self.labels = list(data.keys())
+    counts = [len(data[label]) for label in self.labels]
+    self.offsets = np.zeros([len(self.labels) + 1], dtype=np.int64)
+    np.cumsum(counts, out=self.offsets[1:])
+
+    example_dim = np.size(data[self.labels[0]][0])
+    self.examples = np.empty([self.offsets[-1], example_dim], dtype=np.float32)
+    for i, label in enumerate(self.labels):
+      self.examples[self.offsets[i]:self.offsets[i + 1]] = data[label]
+
+  def __len__(self):
+    return len(self.labels)
+
+  @property
+  def counts(self):
+    return np.diff(self.offsets)
+
+  def sample_episode_batch(self, episode_length, episode_width, batch_size,
+                           rng=np.random):
+    """Generates a random batch of episodes.
+
+    Each episode contains episode_length examples of episode_width distinct
+    labels, arranged so that each label is seen before any is seen again.
+
+    Args:
+      episode_length: Number of examples in each episode.
+      episode_width: Distinct number of labels in each episode.
+      batch_size: Batch size (number of episodes).
+      rng: A numpy RandomState to sample with.
+
+    Returns:
+      A tuple (x, y) where x is a list of batches of examples
+      with size episode_length and y is a list of batches of labels.
+    """
+    assert len(self) >= episode_width
+    batch_idxs = np.arange(batch_size)[:, np.newaxis]
+
+    # distinct labels of each episode, and how often each is shown
+    labels = np.argsort(rng.rand(batch_size, len(self)),
+                        axis=1)[:, :episode_width]
+    remainder = episode_length % episode_width
+    num_shown = np.full([episode_width], episode_length // episode_width,
+                        dtype=np.int64)
+    num_shown[episode_width - remainder:] += 1
+    max_shown = num_shown.max()
+    counts = self.counts[labels]
+    assert np.all(counts >= num_shown)
+
+    # distinct examples of each label, as offsets into the label's examples
+    example_keys = rng.rand(batch_size, episode_width, counts.max())
+    example_keys[np.arange(counts.max()) >= counts[:, :, np.newaxis]] = 2.0
+    shown = np.argsort(example_keys, axis=2)[:, :, :max_shown]
+    example_idxs = self.offsets[labels][:, :, np.newaxis] + shown
+
+    # Show the labels in a random order within each round of showings.
+    rounds = np.arange(max_shown)
+    order_keys = rounds + rng.rand(batch_size, episode_width, max_shown)
+    order_keys[:, rounds >= num_shown[:, np.newaxis]] = np.inf
+    order = np.argsort(order_keys.reshape([batch_size, -1]),
+                       axis=1)[:, :episode_length]
+
+    example_idxs = example_idxs.reshape([batch_size, -1])[batch_idxs, order]
+    label_idxs = order // max_shown + batch_idxs * episode_width
+
+    x = self.examples[example_idxs.T]
+    y = label_idxs.T.astype('int32')
+    return list(x), list(y)
+
+
 def get_data():
   """Get data in form suitable for episodic training.
 
@@ -26,6 +26,31 @@ import numpy as np
 import tensorflow as tf
 
 
+def _append(log, values):
+  """Appends values to a log variable of unvalidated shape."""
+  return tf.assign(log, tf.concat(axis=0, values=[log, values]),
+                   validate_shape=False)
+
+
+def _first_entries(logged_idxs):
+  """Finds the first log entry of each logged index.
+
+  A row may be logged more than once, and its first entry holds the contents
+  from before the first update.
+
+  Args:
+    logged_idxs: A 1-d Tensor of logged indices.
+
+  Returns:
+    A tuple (idxs, first) of the unique indices and of the positions in the
+    log of their first entries.
+  """
+  idxs, log_to_idxs = tf.unique(logged_idxs)
+  first = -tf.unsorted_segment_max(-tf.range(tf.size(logged_idxs)),
+                                   log_to_idxs, tf.size(idxs))
+  return idxs, first
+
+
 class Memory(object):
   """Memory module."""
 
@@ -65,6 +90,33 @@ class Memory(object):
         initializer=tf.truncated_normal_initializer(0, 0.01),
         caching_device=caching_device)
 
+    # In-graph copies of the memory, for rolling back a cleared memory.
+    # These and the undo log below are local variables, so they are not saved
+    # in checkpoints.
+    self.mem_keys_snapshot = self._local_variable(
+        'memkeys_snapshot', tf.zeros([self.memory_size, self.key_dim]))
+    self.mem_vals_snapshot = self._local_variable(
+        'memvals_snapshot', tf.zeros([self.memory_size], dtype=tf.int32))
+    self.mem_age_snapshot = self._local_variable(
+        'memage_snapshot', tf.zeros([self.memory_size]))
+
+    # Undo log of the memory rows overwritten by logged updates, holding each
+    # row's contents from before the update, and the number of logged updates.
+    self.undo_idxs = self._local_variable(
+        'undo_idxs', tf.zeros([0], dtype=tf.int32), validate_shape=False)
+    self.undo_keys = self._local_variable(
+        'undo_keys', tf.zeros([0, self.key_dim]), validate_shape=False)
+    self.undo_vals = self._local_variable(
+        'undo_vals', tf.zeros([0], dtype=tf.int32), validate_shape=False)
+    self.undo_age = self._local_variable(
+        'undo_age', tf.zeros([0]), validate_shape=False)
+    self.undo_steps = self._local_variable('undo_steps', 0.0)
+
+  def _local_variable(self, name, initial_value, validate_shape=True):
+    return tf.Variable(initial_value, name=name, trainable=False,
+                       collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                       validate_shape=validate_shape)
+
   def get(self):
     return self.mem_keys, self.mem_vals, self.mem_age, self.recent_idx
 
@@ -79,6 +131,79 @@ class Memory(object):
     return tf.variables_initializer([self.mem_keys, self.mem_vals, self.mem_age,
                                      self.recent_idx])
 
+  def snapshot(self):
+    """Copies the memory to the snapshot variables, and clears the undo log."""
+    with tf.control_dependencies([
+        self.mem_keys_snapshot.assign(self.mem_keys),
+        self.mem_vals_snapshot.assign(self.mem_vals),
+        self.mem_age_snapshot.assign(self.mem_age)]):
+      return self.clear_undo_log()
+
+  def restore(self):
+    """Copies the snapshot variables back to the memory."""
+    with tf.control_dependencies([
+        self.mem_keys.assign(self.mem_keys_snapshot),
+        self.mem_vals.assign(self.mem_vals_snapshot),
+        self.mem_age.assign(self.mem_age_snapshot)]):
+      return self.clear_undo_log()
+
+  def clear_undo_log(self):
+    return tf.group(
+        tf.assign(self.undo_idxs, tf.zeros([0], dtype=tf.int32),
+                  validate_shape=False),
+        tf.assign(self.undo_keys, tf.zeros([0, self.key_dim]),
+                  validate_shape=False),
+        tf.assign(self.undo_vals, tf.zeros([0], dtype=tf.int32),
+                  validate_shape=False),
+        tf.assign(self.undo_age, tf.zeros([0]), validate_shape=False),
+        self.undo_steps.assign(0.0))
+
+  def log_update(self, upd_idxs):
+    """Appends the rows about to be updated to the undo log.
+
+    Ages are logged as they were before the first logged update, which is
+    their current value minus the number of updates since then.
+
+    Args:
+      upd_idxs: A Tensor of the memory indices about to be updated.
+
+    Returns:
+      An op that must run before the update.
+    """
+    log_ops = [
+        _append(self.undo_idxs, upd_idxs),
+        _append(self.undo_keys, tf.gather(self.mem_keys, upd_idxs)),
+        _append(self.undo_vals, tf.gather(self.mem_vals, upd_idxs)),
+        _append(self.undo_age,
+                tf.gather(self.mem_age, upd_idxs) - self.undo_steps)]
+    with tf.control_dependencies(log_ops):
+      return self.undo_steps.assign_add(1.0)
+
+  def undo(self):
+    """Rolls back the logged updates, and clears the undo log.
+
+    Only the logged rows are written, so the cost is proportional to the
+    number of logged updates rather than to the memory size, apart from the
+    age decrement that mirrors the increment done by every update.
+
+    Returns:
+      The undo op.
+    """
+    idxs, first = _first_entries(self.undo_idxs)
+
+    age_decr = self.mem_age.assign_sub(
+        self.undo_steps * tf.ones([self.memory_size], dtype=tf.float32))
+    with tf.control_dependencies([age_decr]):
+      undo_ops = [
+          tf.scatter_update(self.mem_keys, idxs,
+                            tf.gather(self.undo_keys, first)),
+          tf.scatter_update(self.mem_vals, idxs,
+                            tf.gather(self.undo_vals, first)),
+          tf.scatter_update(self.mem_age, idxs,
+                            tf.gather(self.undo_age, first))]
+    with tf.control_dependencies(undo_ops):
+      return self.clear_undo_log()
+
   def get_hint_pool_idxs(self, normalized_query):
     """Get small set of idxs to compute nearest neighbor queries on.
 
@@ -102,19 +227,21 @@ class Memory(object):
     return hint_pool_idxs
 
   def make_update_op(self, upd_idxs, upd_keys, upd_vals,
-                     batch_size, use_recent_idx, intended_output):
+                     batch_size, use_recent_idx, intended_output,
+                     log_updates=False):
     """Function that creates all the update ops."""
-    mem_age_incr = self.mem_age.assign_add(tf.ones([self.memory_size],
-                                                   dtype=tf.float32))
+    log_op = self.log_update(upd_idxs) if log_updates else tf.group()
+    with tf.control_dependencies([log_op]):
+      mem_age_incr = self.mem_age.assign_add(tf.ones([self.memory_size],
+                                                     dtype=tf.float32))
+      mem_key_upd = tf.scatter_update(
+          self.mem_keys, upd_idxs, upd_keys)
+      mem_val_upd = tf.scatter_update(
+          self.mem_vals, upd_idxs, upd_vals)
     with tf.control_dependencies([mem_age_incr]):
       mem_age_upd = tf.scatter_update(
           self.mem_age, upd_idxs, tf.zeros([batch_size], dtype=tf.float32))
 
-    mem_key_upd = tf.scatter_update(
-        self.mem_keys, upd_idxs, upd_keys)
-    mem_val_upd = tf.scatter_update(
-        self.mem_vals, upd_idxs, upd_vals)
-
     if use_recent_idx:
       recent_idx_upd = tf.scatter_update(
           self.recent_idx, intended_output, upd_idxs)
@@ -123,7 +250,8 @@ class Memory(object):
 
     return tf.group(mem_age_upd, mem_key_upd, mem_val_upd, recent_idx_upd)
 
-  def query(self, query_vec, intended_output, use_recent_idx=True):
+  def query(self, query_vec, intended_output, use_recent_idx=True,
+            log_updates=False):
     """Queries memory for nearest neighbor.
 
     Args:
@@ -132,6 +260,8 @@ class Memory(object):
         memory.
       use_recent_idx: Whether to always insert at least one instance of a
         correct memory fetch.
+      log_updates: Whether to record the memory updates in the undo log, so
+        they can be rolled back with undo().
 
     Returns:
       A tuple (result, mask, teacher_loss).
@@ -242,7 +372,8 @@ class Memory(object):
 
     def make_update_op():
       return self.make_update_op(upd_idxs, upd_keys, upd_vals,
-                                 batch_size, use_recent_idx, intended_output)
+                                 batch_size, use_recent_idx, intended_output,
+                                 log_updates=log_updates)
 
     update_op = tf.cond(self.update_memory, make_update_op, tf.no_op)
 
@@ -257,7 +388,10 @@ class Memory(object):
 class LSHMemory(Memory):
   """Memory employing locality sensitive hashing.
 
-  Note: Not fully tested.
+  Instead of comparing queries with all the keys in memory, each of
+  num_libraries hash functions maps a query to a slot holding the indices of
+  up to num_per_hash_slot recently updated keys with the same hash, and these
+  form the hint pool. See memory_benchmark.py for its recall against Memory.
   """
 
   def __init__(self, key_dim, memory_size, vocab_size,
@@ -266,7 +400,8 @@ class LSHMemory(Memory):
                num_hashes=None, num_libraries=None):
     super(LSHMemory, self).__init__(
         key_dim, memory_size, vocab_size,
-        choose_k=choose_k, alpha=alpha, correct_in_top=1, age_noise=age_noise,
+        choose_k=choose_k, alpha=alpha, correct_in_top=correct_in_top,
+        age_noise=age_noise,
         var_cache_device=var_cache_device, nn_device=nn_device)
 
     self.num_libraries = num_libraries or int(self.choose_k ** 0.5)
@@ -289,24 +424,73 @@ class LSHMemory(Memory):
         tf.get_variable(
             'hash_slots%d' % i, [self.num_hash_slots, self.num_per_hash_slot],
             dtype=tf.int32, trainable=False,
-            initializer=tf.random_uniform_initializer(maxval=self.memory_size,
+            initializer=tf.random_uniform_initializer(0, self.memory_size,
                                                       dtype=tf.int32))
         for i in xrange(self.num_libraries)]
 
-  def get(self):  # not implemented
-    return self.mem_keys, self.mem_vals, self.mem_age, self.recent_idx
+    # snapshots and undo logs of the hash slots, as for the memory itself
+    self.hash_slots_snapshot = [
+        self._local_variable('hash_slots_snapshot%d' % i,
+                             tf.zeros([self.num_hash_slots,
+                                       self.num_per_hash_slot],
+                                      dtype=tf.int32))
+        for i in xrange(self.num_libraries)]
+    self.undo_slot_idxs = [
+        self._local_variable('undo_slot_idxs%d' % i,
+                             tf.zeros([0], dtype=tf.int32),
+                             validate_shape=False)
+        for i in xrange(self.num_libraries)]
+    self.undo_slot_rows = [
+        self._local_variable('undo_slot_rows%d' % i,
+                             tf.zeros([0, self.num_per_hash_slot],
+                                      dtype=tf.int32),
+                             validate_shape=False)
+        for i in xrange(self.num_libraries)]
 
-  def set(self, k, v, a, r=None):  # not implemented
-    return tf.group(
-        self.mem_keys.assign(k),
-        self.mem_vals.assign(v),
-        self.mem_age.assign(a),
-        (self.recent_idx.assign(r) if r is not None else tf.group()))
+  def set(self, k, v, a, r=None):
+    """Sets the memory, and rebuilds the hash slots from the new keys."""
+    with tf.control_dependencies([
+        super(LSHMemory, self).set(k, v, a, r)]):
+      return self.rebuild_hash_slots(keys=k, ages=a)
 
   def clear(self):
     return tf.variables_initializer([self.mem_keys, self.mem_vals, self.mem_age,
                                      self.recent_idx] + self.hash_slots)
 
+  def snapshot(self):
+    with tf.control_dependencies([
+        snapshot.assign(slots)
+        for snapshot, slots in zip(self.hash_slots_snapshot,
+                                   self.hash_slots)]):
+      return super(LSHMemory, self).snapshot()
+
+  def restore(self):
+    with tf.control_dependencies([
+        slots.assign(snapshot)
+        for snapshot, slots in zip(self.hash_slots_snapshot,
+                                   self.hash_slots)]):
+      return super(LSHMemory, self).restore()
+
+  def clear_undo_log(self):
+    clear_ops = [super(LSHMemory, self).clear_undo_log()]
+    for idxs_log, rows_log in zip(self.undo_slot_idxs, self.undo_slot_rows):
+      clear_ops.append(tf.assign(idxs_log, tf.zeros([0], dtype=tf.int32),
+                                 validate_shape=False))
+      clear_ops.append(tf.assign(
+          rows_log, tf.zeros([0, self.num_per_hash_slot], dtype=tf.int32),
+          validate_shape=False))
+    return tf.group(*clear_ops)
+
+  def undo(self):
+    undo_ops = []
+    for slots, idxs_log, rows_log in zip(
+        self.hash_slots, self.undo_slot_idxs, self.undo_slot_rows):
+      idxs, first = _first_entries(idxs_log)
+      undo_ops.append(
+          tf.scatter_update(slots, idxs, tf.gather(rows_log, first)))
+    with tf.control_dependencies(undo_ops):
+      return super(LSHMemory, self).undo()
+
   def get_hash_slots(self, query):
     """Gets hashed-to buckets for batch of queries.
 
@@ -323,11 +507,63 @@ class LSHMemory(Memory):
     hash_slot_idxs = [
         tf.reduce_sum(
             tf.to_int32(binary_hash[i]) *
-            tf.constant([[2 ** i for i in xrange(self.num_hashes)]],
+            tf.constant([[2 ** j for j in xrange(self.num_hashes)]],
                         dtype=tf.int32), 1)
         for i in xrange(self.num_libraries)]
     return hash_slot_idxs
 
+  def rebuild_hash_slots(self, keys=None, ages=None):
+    """Refills the hash slots from the keys currently in memory.
+
+    Each slot gets the most recently updated keys that hash to it, and slots
+    with fewer keys than num_per_hash_slot are padded with random indices,
+    as when initialized.
+
+    Args:
+      keys: Memory keys to hash; defaults to a fresh read of mem_keys.
+      ages: Memory ages; defaults to a fresh read of mem_age.
+
+    Returns:
+      The rebuild op.
+    """
+    if keys is None:
+      keys = self.mem_keys.read_value()
+    if ages is None:
+      ages = self.mem_age.read_value()
+
+    # rank memory entries from youngest to oldest
+    _, by_age = tf.nn.top_k(-ages, k=self.memory_size)
+    age_rank = tf.scatter_nd(tf.expand_dims(by_age, 1),
+                             tf.range(self.memory_size), [self.memory_size])
+
+    update_ops = []
+    for slots, slot_idxs in zip(self.hash_slots,
+                                self.get_hash_slots(keys)):
+      # sort memory entries by slot, then by age
+      sort_key = (tf.to_double(slot_idxs) * self.memory_size +
+                  tf.to_double(age_rank))
+      _, order = tf.nn.top_k(-sort_key, k=self.memory_size)
+      sorted_slots = tf.gather(slot_idxs, order)
+
+      # position of each entry within its slot
+      positions = tf.range(self.memory_size)
+      slot_starts = -tf.unsorted_segment_max(-positions, sorted_slots,
+                                             self.num_hash_slots)
+      positions -= tf.gather(slot_starts, sorted_slots)
+      keep = tf.less(positions, self.num_per_hash_slot)
+
+      idxs = tf.stack([tf.boolean_mask(sorted_slots, keep),
+                       tf.boolean_mask(positions, keep)], axis=1)
+      shape = [self.num_hash_slots, self.num_per_hash_slot]
+      filled = tf.scatter_nd(idxs, tf.ones_like(idxs[:, 0]), shape)
+      entries = tf.scatter_nd(idxs, tf.boolean_mask(order, keep), shape)
+      padding = tf.random_uniform(shape, maxval=self.memory_size,
+                                  dtype=tf.int32)
+      update_ops.append(slots.assign(
+          tf.where(tf.greater(filled, 0), entries, padding)))
+
+    return tf.group(*update_ops)
+
   def get_hint_pool_idxs(self, normalized_query):
     """Get small set of idxs to compute nearest neighbor queries on.
 
@@ -355,11 +591,13 @@ class LSHMemory(Memory):
     return tf.concat(axis=1, values=hint_pool_idxs)
 
   def make_update_op(self, upd_idxs, upd_keys, upd_vals,
-                     batch_size, use_recent_idx, intended_output):
+                     batch_size, use_recent_idx, intended_output,
+                     log_updates=False):
     """Function that creates all the update ops."""
     base_update_op = super(LSHMemory, self).make_update_op(
         upd_idxs, upd_keys, upd_vals,
-        batch_size, use_recent_idx, intended_output)
+        batch_size, use_recent_idx, intended_output,
+        log_updates=log_updates)
 
     # compute hash slots to be updated
     hash_slot_idxs = self.get_hash_slots(upd_keys)
@@ -378,9 +616,17 @@ class LSHMemory(Memory):
                      tf.one_hot(entry_idx, self.num_per_hash_slot,
                                 dtype=tf.int32))
 
-        mul_op = tf.scatter_mul(self.hash_slots[i], slot_idxs, entry_mul)
-        with tf.control_dependencies([mul_op]):
-          add_op = tf.scatter_add(self.hash_slots[i], slot_idxs, entry_add)
-          update_ops.append(add_op)
+        # Replace whole slot rows rather than scatter_mul and scatter_add,
+        # which corrupt the entries of slots hit twice in one batch.
+        slot_rows = tf.gather(self.hash_slots[i], slot_idxs)
+        if log_updates:
+          log_ops = [_append(self.undo_slot_idxs[i], slot_idxs),
+                     _append(self.undo_slot_rows[i], slot_rows)]
+        else:
+          log_ops = []
+        with tf.control_dependencies(log_ops):
+          update_ops.append(tf.scatter_update(
+              self.hash_slots[i], slot_idxs,
+              slot_rows * entry_mul + entry_add))
 
     return tf.group(*update_ops)
@@ -0,0 +1,152 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ==============================================================================
+r"""Benchmark of the LSH memory look-up against the exact one.
+
+For each memory size, fills an LSHMemory with random keys and queries it
+with noisy copies of stored keys. Reports the latency of the exact hint pool
+look-up of Memory and of the hashed one of LSHMemory, and the recall of the
+hashed hint pool: the fraction of the exact top choose_k keys it contains,
+and how often it contains the exact nearest key.
+
+Simple command to sweep the hash parameters:
+  python memory_benchmark.py --memory_sizes=10000,100000,1000000,10000000 \
+      --num_hashes=,12,16 --num_libraries=,8,32
+"""
+
+import itertools
+import logging
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import memory
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string('memory_sizes', '10000,100000,1000000,10000000',
+                       'comma-separated memory sizes to benchmark')
+tf.flags.DEFINE_string('num_hashes', '',
+                       'comma-separated numbers of hash bits to try, '
+                       'where an empty entry uses the LSHMemory default')
+tf.flags.DEFINE_string('num_libraries', '',
+                       'comma-separated numbers of hash functions to try, '
+                       'where an empty entry uses the LSHMemory default')
+tf.flags.DEFINE_integer('key_dim', 128, 'dimension of keys in memory')
+tf.flags.DEFINE_integer('choose_k', 256, 'size of the hint pool')
+tf.flags.DEFINE_integer('batch_size', 16, 'number of queries per look-up')
+tf.flags.DEFINE_float('query_noise', 0.5,
+                      'norm of the noise added to stored keys to make queries')
+tf.flags.DEFINE_integer('num_trials', 20, 'number of look-ups to time')
+tf.flags.DEFINE_integer('seed', 888, 'random seed')
+
+
+def parse_options(flag_value):
+  return [int(v) if v else None for v in flag_value.split(',')]
+
+
+def recall(exact_idxs, hint_pool_idxs):
+  """Computes the recall of hint pools against the exact ones.
+
+  Args:
+    exact_idxs: [batch_size, choose_k] array of exact neighbors, nearest first.
+    hint_pool_idxs: [batch_size, pool_size] array of hint pools.
+
+  Returns:
+    A tuple (recall_at_k, nearest_recall) of the mean fraction of exact
+    neighbors found in the hint pools, and of the fraction of hint pools
+    containing the nearest neighbor.
+  """
+  found = np.array([np.in1d(exact, pool)
+                    for exact, pool in zip(exact_idxs, hint_pool_idxs)])
+  return found.mean(), found[:, 0].mean()
+
+
+def time_op(sess, op, feed_dict, num_trials):
+  """Returns the outputs of op and its mean run time in seconds."""
+  outputs = sess.run(op, feed_dict)  # warm up
+  start = time.time()
+  for _ in xrange(num_trials):
+    sess.run(op, feed_dict)
+  return outputs, (time.time() - start) / num_trials
+
+
+def run_benchmark(memory_size, num_hashes, num_libraries, rng):
+  """Benchmarks one configuration and returns a dict of results."""
+  with tf.Graph().as_default():
+    tf.set_random_seed(FLAGS.seed)
+    mem = memory.LSHMemory(FLAGS.key_dim, memory_size, 1,
+                           choose_k=FLAGS.choose_k,
+                           num_hashes=num_hashes, num_libraries=num_libraries)
+
+    # Give the keys distinct ages, so the hash slots keep the youngest ones.
+    keys = tf.nn.l2_normalize(
+        tf.random_normal([memory_size, FLAGS.key_dim]), dim=1)
+    fill_op = mem.set(keys, tf.zeros([memory_size], dtype=tf.int32),
+                      tf.random_shuffle(tf.to_float(tf.range(memory_size))))
+
+    query_idxs = tf.placeholder(tf.int32, [None])
+    stored_keys = tf.gather(mem.mem_keys, query_idxs)
+    query = tf.placeholder(tf.float32, [None, FLAGS.key_dim])
+    # The exact look-up is the one of the base class, on the same keys.
+    exact_op = memory.Memory.get_hint_pool_idxs(mem, query)
+    lsh_op = mem.get_hint_pool_idxs(query)
+
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(fill_op)
+
+      idxs = rng.randint(memory_size, size=FLAGS.batch_size)
+      noise = rng.randn(FLAGS.batch_size, FLAGS.key_dim)
+      noise *= FLAGS.query_noise / np.linalg.norm(noise, axis=1,
+                                                  keepdims=True)
+      queries = sess.run(stored_keys, {query_idxs: idxs}) + noise
+      queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+      exact_idxs, exact_time = time_op(sess, exact_op, {query: queries},
+                                       FLAGS.num_trials)
+      lsh_idxs, lsh_time = time_op(sess, lsh_op, {query: queries},
+                                   FLAGS.num_trials)
+
+  recall_at_k, nearest_recall = recall(exact_idxs, lsh_idxs)
+  return {'num_hashes': mem.num_hashes,
+          'num_libraries': mem.num_libraries,
+          'num_per_hash_slot': mem.num_per_hash_slot,
+          'exact_ms': exact_time * 1000,
+          'lsh_ms': lsh_time * 1000,
+          'recall_at_k': recall_at_k,
+          'nearest_recall': nearest_recall}
+
+
+def main(unused_argv):
+  rng = np.random.RandomState(FLAGS.seed)
+  for memory_size, num_hashes, num_libraries in itertools.product(
+      parse_options(FLAGS.memory_sizes),
+      parse_options(FLAGS.num_hashes),
+      parse_options(FLAGS.num_libraries)):
+    result = run_benchmark(memory_size, num_hashes, num_libraries, rng)
+    logging.info('memory_size %d, num_hashes %d, num_libraries %d, '
+                 'num_per_hash_slot %d: exact %.2f ms, lsh %.2f ms, '
+                 'recall@%d %.3f, nearest recall %.3f',
+                 memory_size, result['num_hashes'], result['num_libraries'],
+                 result['num_per_hash_slot'], result['exact_ms'],
+                 result['lsh_ms'], FLAGS.choose_k, result['recall_at_k'],
+                 result['nearest_recall'])
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  tf.app.run()
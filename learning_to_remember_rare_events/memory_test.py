@@ -0,0 +1,60 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# ==============================================================================
+"""Tests for memory."""
+
+import numpy as np
+import tensorflow as tf
+
+import memory
+
+
+class LSHMemoryTest(tf.test.TestCase):
+
+  def testSetFillsHashSlots(self):
+    memory_size, key_dim = 64, 8
+    with self.test_session() as sess:
+      mem = memory.LSHMemory(key_dim, memory_size, 1, choose_k=16,
+                             num_hashes=3, num_libraries=2)
+      keys = tf.nn.l2_normalize(
+          tf.random_normal([memory_size, key_dim]), dim=1)
+      ages = tf.random_shuffle(tf.to_float(tf.range(memory_size)))
+      set_op = mem.set(keys, tf.zeros([memory_size], dtype=tf.int32), ages)
+      sess.run(tf.global_variables_initializer())
+
+      # A single run both sets the memory and rebuilds the hash slots.
+      sess.run(set_op)
+      stored_keys, stored_ages, slots, key_slots = sess.run(
+          [mem.mem_keys, mem.mem_age, mem.hash_slots,
+           mem.get_hash_slots(mem.mem_keys)])
+
+    self.assertGreater(np.abs(stored_keys).sum(), 0)
+    for library_slots, library_key_slots in zip(slots, key_slots):
+      for idx in xrange(memory_size):
+        slot = library_key_slots[idx]
+        if idx in library_slots[slot]:
+          continue
+        # A key can only be left out of its slot if the slot is full of
+        # younger keys that hash to it.
+        in_slot = np.flatnonzero(library_key_slots == slot)
+        younger = in_slot[stored_ages[in_slot] < stored_ages[idx]]
+        self.assertGreaterEqual(len(younger), mem.num_per_hash_slot)
+        self.assertEqual(sorted(younger[np.argsort(
+            stored_ages[younger])][:mem.num_per_hash_slot]),
+                         sorted(library_slots[slot]))
+
+
+if __name__ == '__main__':
+  tf.test.main()
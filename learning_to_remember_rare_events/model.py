@@ -149,12 +149,13 @@ class Model(object):
   def get_classifier(self):
     return BasicClassifier(self.output_dim)
 
-  def core_builder(self, x, y, keep_prob, use_recent_idx=True):
+  def core_builder(self, x, y, keep_prob, use_recent_idx=True,
+                   log_updates=False):
     embeddings = self.embedder.core_builder(x)
     if keep_prob < 1.0:
       embeddings = tf.nn.dropout(embeddings, keep_prob)
     memory_val, _, teacher_loss = self.memory.query(
-        embeddings, y, use_recent_idx=use_recent_idx)
+        embeddings, y, use_recent_idx=use_recent_idx, log_updates=log_updates)
     loss, y_pred = self.classifier.core_builder(memory_val, x, y)
 
     return loss + teacher_loss, y_pred
@@ -165,8 +166,9 @@ class Model(object):
     return loss, gradient_ops
 
   def eval(self, x, y):
+    # Memory updates made while predicting are logged, so they can be undone.
     _, y_preds = self.core_builder(x, y, keep_prob=1.0,
-                                   use_recent_idx=False)
+                                   use_recent_idx=False, log_updates=True)
     return y_preds
 
   def get_xy_placeholders(self):
@@ -183,21 +185,10 @@ class Model(object):
     with tf.variable_scope('core', reuse=True):
       self.y_preds = self.eval(self.x, self.y)
 
-    # setup memory "reset" ops
-    (self.mem_keys, self.mem_vals,
-     self.mem_age, self.recent_idx) = self.memory.get()
-    self.mem_keys_reset = tf.placeholder(self.mem_keys.dtype,
-                                         tf.identity(self.mem_keys).shape)
-    self.mem_vals_reset = tf.placeholder(self.mem_vals.dtype,
-                                         tf.identity(self.mem_vals).shape)
-    self.mem_age_reset = tf.placeholder(self.mem_age.dtype,
-                                        tf.identity(self.mem_age).shape)
-    self.recent_idx_reset = tf.placeholder(self.recent_idx.dtype,
-                                           tf.identity(self.recent_idx).shape)
-    self.mem_reset_op = self.memory.set(self.mem_keys_reset,
-                                        self.mem_vals_reset,
-                                        self.mem_age_reset,
-                                        None)
+    # setup in-graph memory rollback ops
+    self.mem_undo_op = self.memory.undo()
+    self.mem_snapshot_op = self.memory.snapshot()
+    self.mem_restore_op = self.memory.restore()
 
   def training_ops(self, loss):
     opt = self.get_optimizer()
@@ -254,19 +245,14 @@ class Model(object):
       Predicted y.
     """
 
-    cur_memory = sess.run([self.mem_keys, self.mem_vals,
-                           self.mem_age])
-
     outputs = [self.y_preds]
     if y is None:
       ret = sess.run(outputs, feed_dict={self.x: x})
     else:
       ret = sess.run(outputs, feed_dict={self.x: x, self.y: y})
 
-    sess.run([self.mem_reset_op],
-             feed_dict={self.mem_keys_reset: cur_memory[0],
-                        self.mem_vals_reset: cur_memory[1],
-                        self.mem_age_reset: cur_memory[2]})
+    # Roll back the rows that the prediction updated.
+    sess.run([self.mem_undo_op])
 
     return ret
 
@@ -284,10 +270,9 @@ class Model(object):
       List of predicted y.
     """
 
-    cur_memory = sess.run([self.mem_keys, self.mem_vals,
-                           self.mem_age])
-
     if clear_memory:
+      # The whole memory changes, so keep a full in-graph copy of it.
+      sess.run([self.mem_snapshot_op])
       self.clear_memory(sess)
 
     outputs = [self.y_preds]
@@ -297,10 +282,10 @@ class Model(object):
       y_pred = out[0]
       y_preds.append(y_pred)
 
-    sess.run([self.mem_reset_op],
-             feed_dict={self.mem_keys_reset: cur_memory[0],
-                        self.mem_vals_reset: cur_memory[1],
-                        self.mem_age_reset: cur_memory[2]})
+    if clear_memory:
+      sess.run([self.mem_restore_op])
+    else:
+      sess.run([self.mem_undo_op])
 
     return y_preds
 
@@ -24,8 +24,10 @@ Simple command to get up and running:
 import logging
 import os
 import random
+import threading
 
 import numpy as np
+from six.moves import queue
 import tensorflow as tf
 
 import data_utils
@@ -50,17 +52,20 @@ tf.flags.DEFINE_integer('validation_length', 10,
                         'validation accuracy')
 tf.flags.DEFINE_integer('seed', 888, 'random seed for training sampling')
 tf.flags.DEFINE_string('save_dir', '', 'directory to save model to')
+tf.flags.DEFINE_integer('prefetch_batches', 4,
+                        'number of training episode batches to sample ahead '
+                        'in a background thread (0 to sample in line)')
 tf.flags.DEFINE_bool('use_lsh', False,
                      'use locality-sensitive hashing '
-                     '(NOTE: not fully tested)')
+                     '(see memory_benchmark.py for its recall)')
 
 
 class Trainer(object):
   """Class that takes care of training, validating, and checkpointing model."""
 
   def __init__(self, train_data, valid_data, input_dim, output_dim=None):
-    self.train_data = train_data
-    self.valid_data = valid_data
+    self.train_data = data_utils.EpisodeData(train_data)
+    self.valid_data = data_utils.EpisodeData(valid_data)
     self.input_dim = input_dim
 
     self.rep_dim = FLAGS.rep_dim
@@ -83,7 +88,8 @@ class Trainer(object):
         vocab_size, use_lsh=self.use_lsh)
 
   def sample_episode_batch(self, data,
-                           episode_length, episode_width, batch_size):
+                           episode_length, episode_width, batch_size,
+                           rng=np.random):
     """Generates a random batch for training or validation.
 
     Structures each element of the batch as an 'episode'.
@@ -91,41 +97,48 @@ class Trainer(object):
     episode_width distinct labels.
 
     Args:
-      data: A dictionary mapping label to list of examples.
+      data: An EpisodeData holding the examples of each label.
       episode_length: Number of examples in each episode.
       episode_width: Distinct number of labels in each episode.
       batch_size: Batch size (number of episodes).
+      rng: A numpy RandomState to sample with.
 
     Returns:
       A tuple (x, y) where x is a list of batches of examples
       with size episode_length and y is a list of batches of labels.
     """
+    return data.sample_episode_batch(episode_length, episode_width,
+                                     batch_size, rng=rng)
 
-    episodes_x = [[] for _ in xrange(episode_length)]
-    episodes_y = [[] for _ in xrange(episode_length)]
-    assert len(data) >= episode_width
-    keys = data.keys()
-    for b in xrange(batch_size):
-      episode_labels = random.sample(keys, episode_width)
-      remainder = episode_length % episode_width
-      remainders = [0] * (episode_width - remainder) + [1] * remainder
-      episode_x = [
-          random.sample(data[lab],
-                        r + (episode_length - remainder) / episode_width)
-          for lab, r in zip(episode_labels, remainders)]
-      episode = sum([[(x, i, ii) for ii, x in enumerate(xx)]
-                     for i, xx in enumerate(episode_x)], [])
-      random.shuffle(episode)
-      # Arrange episode so that each distinct label is seen before moving to
-      # 2nd showing
-      episode.sort(key=lambda elem: elem[2])
-      assert len(episode) == episode_length
-      for i in xrange(episode_length):
-        episodes_x[i].append(episode[i][0])
-        episodes_y[i].append(episode[i][1] + b * episode_width)
-
-    return ([np.array(xx).astype('float32') for xx in episodes_x],
-            [np.array(yy).astype('int32') for yy in episodes_y])
+  def start_prefetch(self, data, episode_length, episode_width, batch_size,
+                     seed):
+    """Starts a thread sampling episode batches ahead of training.
+
+    The thread samples with its own RandomState, so the batches do not depend
+    on when it runs.
+
+    Args:
+      data: An EpisodeData holding the examples of each label.
+      episode_length: Number of examples in each episode.
+      episode_width: Distinct number of labels in each episode.
+      batch_size: Batch size (number of episodes).
+      seed: Seed of the thread's RandomState.
+
+    Returns:
+      A queue of (x, y) batches, as returned by sample_episode_batch().
+    """
+    batches = queue.Queue(maxsize=FLAGS.prefetch_batches)
+    rng = np.random.RandomState(seed)
+
+    def _sample():
+      while True:
+        batches.put(self.sample_episode_batch(
+            data, episode_length, episode_width, batch_size, rng=rng))
+
+    thread = threading.Thread(target=_sample)
+    thread.daemon = True
+    thread.start()
+    return batches
 
   def compute_correct(self, ys, y_preds):
     return np.mean(np.equal(y_preds, np.array(ys)))
@@ -158,10 +171,8 @@ class Trainer(object):
     logging.info('memory_size %d', memory_size)
     logging.info('batch_size %d', batch_size)
 
-    assert all(len(v) >= float(episode_length) / episode_width
-               for v in train_data.itervalues())
-    assert all(len(v) >= float(episode_length) / episode_width
-               for v in valid_data.itervalues())
+    assert all(train_data.counts >= float(episode_length) / episode_width)
+    assert all(valid_data.counts >= float(episode_length) / episode_width)
 
     output_dim = episode_width
     self.model = self.get_model()
@@ -169,6 +180,7 @@ class Trainer(object):
 
     sess = tf.Session()
     sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
 
     saver = tf.train.Saver(max_to_keep=10)
     ckpt = None
@@ -182,9 +194,15 @@ class Trainer(object):
     losses = []
     random.seed(FLAGS.seed)
     np.random.seed(FLAGS.seed)
+    if FLAGS.prefetch_batches > 0:
+      train_batches = self.start_prefetch(
+          train_data, episode_length, episode_width, batch_size, FLAGS.seed)
     for i in xrange(FLAGS.num_episodes):
-      x, y = self.sample_episode_batch(
-          train_data, episode_length, episode_width, batch_size)
+      if FLAGS.prefetch_batches > 0:
+        x, y = train_batches.get()
+      else:
+        x, y = self.sample_episode_batch(
+            train_data, episode_length, episode_width, batch_size)
       outputs = self.model.episode_step(sess, x, y, clear_memory=True)
       loss = outputs
       losses.append(loss)
@@ -15,9 +15,16 @@
 
 """A library for loading 1B word benchmark dataset."""
 
+import hashlib
+import itertools
+import os
 import random
+import sys
+import threading
 
 import numpy as np
+import six
+from six.moves import queue as Queue
 import tensorflow as tf
 
 
@@ -89,6 +96,11 @@ class Vocabulary(object):
     word_ids = [self.word_to_id(cur_word) for cur_word in sentence.split()]
     return np.array([self.bos] + word_ids + [self.eos], dtype=np.int32)
 
+  @property
+  def fingerprint(self):
+    """A hash of the vocabulary, used to key cached encodings."""
+    return hashlib.sha1('\n'.join(self._id_to_word)).hexdigest()
+
 
 class CharsVocabulary(Vocabulary):
   """Vocabulary containing character-level information."""
@@ -160,6 +172,55 @@ class CharsVocabulary(Vocabulary):
                  for cur_word in sentence.split()]
     return np.vstack([self.bos_chars] + chars_ids + [self.eos_chars])
 
+  @property
+  def fingerprint(self):
+    return hashlib.sha1('%s %d' % (super(CharsVocabulary, self).fingerprint,
+                                   self.max_word_length)).hexdigest()
+
+  def encode_many(self, sentences):
+    """Encodes many sentences into flat arrays.
+
+    This is equivalent to calling encode() and encode_chars() on each sentence
+    and concatenating the results.
+
+    Args:
+      sentences: list of sentence strings.
+
+    Returns:
+      ids: int32 array with the word ids of all the sentences.
+      char_ids: int32 array of shape [len(ids), max_word_length].
+      starts: int64 array such that sentence i is ids[starts[i]:starts[i+1]].
+    """
+    words = [sentence.split() for sentence in sentences]
+    starts = np.zeros([len(words) + 1], dtype=np.int64)
+    np.cumsum([len(w) + 2 for w in words], out=starts[1:])
+
+    # Positions of the <S> and </S> tokens, and of the words between them.
+    is_word = np.ones([starts[-1]], dtype=bool)
+    is_word[starts[:-1]] = False
+    is_word[starts[1:] - 1] = False
+
+    flat_words = list(itertools.chain.from_iterable(words))
+    word_ids = np.array([self._word_to_id.get(w, -1) for w in flat_words],
+                        dtype=np.int32).reshape([-1])
+    is_oov = word_ids < 0
+
+    ids = np.empty([starts[-1]], dtype=np.int32)
+    ids[starts[:-1]] = self.bos
+    ids[starts[1:] - 1] = self.eos
+    ids[is_word] = np.where(is_oov, self.unk, word_ids)
+
+    # Out of vocabulary words keep their own characters.
+    word_char_ids = self._word_char_ids[word_ids]
+    for i in np.flatnonzero(is_oov):
+      word_char_ids[i] = self._convert_word_to_char_ids(flat_words[i])
+
+    char_ids = np.empty([starts[-1], self.max_word_length], dtype=np.int32)
+    char_ids[starts[:-1]] = self.bos_chars
+    char_ids[starts[1:] - 1] = self.eos_chars
+    char_ids[is_word] = word_char_ids
+    return ids, char_ids, starts
+
 
 def get_batch(generator, batch_size, num_steps, max_word_length, pad=False):
   """Read batches of input."""
@@ -214,27 +275,218 @@ def get_batch(generator, batch_size, num_steps, max_word_length, pad=False):
     yield inputs, char_inputs, global_word_ids, targets, weights
 
 
+class _FlatStream(object):
+  """A stream of sentences over a sequence of encoded shards.
+
+  Positions index a virtual concatenation of a small tail buffer and the
+  current shard. When a new shard is loaded, the tokens that the rows still
+  need from the previous one are moved into the tail buffer, so the previous
+  shard can be released without copying the new one.
+  """
+
+  def __init__(self, shards, max_word_length):
+    self._shards = shards
+    self._tail_ids = np.zeros([0], np.int32)
+    self._tail_char_ids = np.zeros([0, max_word_length], np.int32)
+    self._ids = self._tail_ids
+    self._char_ids = self._tail_char_ids
+    self._starts = np.zeros([1], np.int64)
+    self._next = 0
+
+  def take(self, positions):
+    """Returns the ids and char ids at the given positions."""
+    offset = len(self._tail_ids)
+    in_tail = positions < offset
+    if not in_tail.any():
+      return (self._ids[positions - offset],
+              self._char_ids[positions - offset])
+
+    ids = np.empty([len(positions)], np.int32)
+    char_ids = np.empty([len(positions), self._char_ids.shape[1]], np.int32)
+    ids[in_tail] = self._tail_ids[positions[in_tail]]
+    char_ids[in_tail] = self._tail_char_ids[positions[in_tail]]
+    ids[~in_tail] = self._ids[positions[~in_tail] - offset]
+    char_ids[~in_tail] = self._char_ids[positions[~in_tail] - offset]
+    return ids, char_ids
+
+  def _rebase(self, pos, end, delta, positions, mask, shard):
+    """Loads a new shard, moving the tokens still needed to the tail."""
+    total = len(self._tail_ids) + len(self._ids)
+    live = pos < end - 1
+    lo = min([total] + list(pos[live]) + list(positions[mask]))
+    self._tail_ids, self._tail_char_ids = self.take(np.arange(lo, total))
+
+    # Positions all move down by lo, global word ids stay the same.
+    pos -= lo
+    end -= lo
+    delta += lo
+    positions -= lo
+
+    self._ids, self._char_ids, self._starts = shard
+    self._next = 0
+
+  def next_sentence(self, pos, end, delta, positions, mask):
+    """Returns the (start, end, delta) of the next sentence.
+
+    The global word id of position p of the sentence is p + delta. Loading a
+    new shard rebases the row cursors and the positions already gathered for
+    the current batch in place.
+
+    Args:
+      pos: int64 array with the next position of each row.
+      end: int64 array with the end of the current sentence of each row.
+      delta: int64 array with the global word id offset of each row.
+      positions: int64 array with the positions of the current batch.
+      mask: bool array marking which of the positions are filled.
+
+    Returns:
+      The tuple, or None if there are no more sentences.
+    """
+    while self._next >= len(self._starts) - 1:
+      try:
+        shard = next(self._shards)
+      except StopIteration:
+        return None
+      self._rebase(pos, end, delta, positions, mask, shard)
+
+    s = self._next
+    self._next += 1
+    offset = len(self._tail_ids)
+    return (offset + self._starts[s], offset + self._starts[s + 1],
+            -offset - s)
+
+
+def get_stream_batch(shards, batch_size, num_steps, max_word_length,
+                     pad=False):
+  """Read batches of input from a stream of encoded shards.
+
+  This yields the same batches as get_batch() over the sentences of the shards,
+  but each row only keeps a cursor into the flat id arrays, and each batch is
+  filled by a single gather rather than by re-slicing per-sentence lists.
+
+  Args:
+    shards: iterator over (ids, char_ids, starts) tuples, as returned by
+      CharsVocabulary.encode_many().
+    batch_size: Number of rows in a batch.
+    num_steps: Number of time steps in a batch.
+    max_word_length: Maximum number of chars in a word.
+    pad: Whether each row of a batch holds at most one sentence.
+
+  Yields:
+    (inputs, char_inputs, global_word_ids, targets, weights) tuples.
+  """
+  stream = _FlatStream(shards, max_word_length)
+
+  inputs = np.zeros([batch_size, num_steps], np.int32)
+  char_inputs = np.zeros([batch_size, num_steps, max_word_length], np.int32)
+  global_word_ids = np.zeros([batch_size, num_steps], np.int32)
+  targets = np.zeros([batch_size, num_steps], np.int32)
+  weights = np.ones([batch_size, num_steps], np.float32)
+
+  # The cursors of each row: the next position to read, the end of the current
+  # sentence, and the offset from positions to global word ids.
+  pos = np.zeros([batch_size], np.int64)
+  end = np.zeros([batch_size], np.int64)
+  delta = np.zeros([batch_size], np.int64)
+
+  positions = np.zeros([batch_size, num_steps], np.int64)
+  mask = np.zeros([batch_size, num_steps], bool)
+
+  no_more_data = False
+  while True:
+    mask[:] = False
+
+    for i in range(batch_size):
+      cur_pos = 0
+
+      while cur_pos < num_steps:
+        if end[i] - pos[i] <= 1:
+          sentence = stream.next_sentence(pos, end, delta, positions,
+                                          mask)
+          if sentence is None:
+            # No more data, exhaust current streams and quit
+            no_more_data = True
+            break
+          pos[i], end[i], delta[i] = sentence
+
+        how_many = min(end[i] - pos[i] - 1, num_steps - cur_pos)
+        next_pos = cur_pos + how_many
+
+        positions[i, cur_pos:next_pos] = np.arange(pos[i], pos[i] + how_many)
+        global_word_ids[i, cur_pos:next_pos] = (
+            positions[i, cur_pos:next_pos] + delta[i])
+        mask[i, cur_pos:next_pos] = True
+
+        cur_pos = next_pos
+        pos[i] += how_many
+
+        if pad:
+          break
+
+    if no_more_data and not mask.any():
+      # There is no more data and this is an empty batch. Done!
+      break
+
+    filled = positions[mask]
+    ids, char_ids = stream.take(filled)
+    next_ids, _ = stream.take(filled + 1)
+
+    inputs[:] = 0
+    char_inputs[:] = 0
+    targets[:] = 0
+    inputs[mask] = ids
+    char_inputs[mask] = char_ids
+    global_word_ids[~mask] = 0
+    targets[mask] = next_ids
+    weights[:] = mask
+
+    yield inputs, char_inputs, global_word_ids, targets, weights
+
+
 class LM1BDataset(object):
   """Utility class for 1B word benchmark dataset.
 
   The current implementation reads the data from the tokenized text files.
+  Each shard is encoded into flat id and char id arrays. If cache_dir is given,
+  these are saved there as .npy files keyed by the shard and the vocabulary,
+  and later reads memory map them instead of re-encoding the text. If prefetch
+  is set, the next shard is loaded by a background thread while the current
+  one is consumed.
   """
 
-  def __init__(self, filepattern, vocab):
+  def __init__(self, filepattern, vocab, cache_dir=None, prefetch=False):
     """Initialize LM1BDataset reader.
 
     Args:
       filepattern: Dataset file pattern.
       vocab: Vocabulary.
+      cache_dir: Optional directory in which to cache encoded shards.
+      prefetch: Whether to load the next shard in a background thread.
     """
     self._vocab = vocab
     self._all_shards = tf.gfile.Glob(filepattern)
+    self._cache_dir = cache_dir
+    self._prefetch = prefetch
     tf.logging.info('Found %d shards at %s', len(self._all_shards), filepattern)
 
+    if cache_dir and not tf.gfile.Exists(cache_dir):
+      tf.gfile.MakeDirs(cache_dir)
+
   def _load_random_shard(self):
     """Randomly select a file and read it."""
     return self._load_shard(random.choice(self._all_shards))
 
+  def _cache_filenames(self, shard_name):
+    """Returns the cache files of a shard, keyed by its content and vocab."""
+    stat = tf.gfile.Stat(shard_name)
+    key = hashlib.sha1('%s %s %d %d' % (
+        self.vocab.fingerprint, shard_name, stat.length,
+        stat.mtime_nsec)).hexdigest()
+    prefix = os.path.join(
+        self._cache_dir, '%s.%s' % (os.path.basename(shard_name), key))
+    return [prefix + suffix
+            for suffix in ('.ids.npy', '.char_ids.npy', '.starts.npy')]
+
   def _load_shard(self, shard_name):
     """Read one file and convert to ids.
 
@@ -242,38 +494,96 @@ class LM1BDataset(object):
       shard_name: file path.
 
     Returns:
-      list of (id, char_id, global_word_id) tuples.
+      (ids, char_ids, starts) arrays, as returned by vocab.encode_many().
     """
+    cache_filenames = None
+    if self._cache_dir:
+      cache_filenames = self._cache_filenames(shard_name)
+      if all(os.path.exists(f) for f in cache_filenames):
+        tf.logging.info('Loading cached data for: %s', shard_name)
+        return [np.load(f, mmap_mode='r') for f in cache_filenames]
+
     tf.logging.info('Loading data from: %s', shard_name)
     with tf.gfile.Open(shard_name) as f:
       sentences = f.readlines()
-    chars_ids = [self.vocab.encode_chars(sentence) for sentence in sentences]
-    ids = [self.vocab.encode(sentence) for sentence in sentences]
+    arrays = self.vocab.encode_many(sentences)
+
+    if cache_filenames:
+      # Write to temporary files and rename them, so that an interrupted run
+      # never leaves a partial cache behind.
+      for array, filename in zip(arrays, cache_filenames):
+        tmp_filename = '%s.tmp.%d' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+          np.save(f, array)
+        os.rename(tmp_filename, filename)
+
+    tf.logging.info('Loaded %d words.', len(arrays[0]) - (len(arrays[2]) - 1))
+    tf.logging.info('Finished loading')
+    return arrays
 
-    global_word_ids = []
+  def _shard_sentences(self, arrays):
+    """Yields (id, char_id, global_word_id) tuples for each sentence."""
+    ids, char_ids, starts = arrays
     current_idx = 0
-    for word_ids in ids:
-      current_size = len(word_ids) - 1  # without <BOS> symbol
-      cur_ids = np.arange(current_idx, current_idx + current_size)
-      global_word_ids.append(cur_ids)
+    for start, end in itertools.izip(starts[:-1], starts[1:]):
+      current_size = end - start - 1  # without <BOS> symbol
+      yield (ids[start:end], char_ids[start:end],
+             np.arange(current_idx, current_idx + current_size))
       current_idx += current_size
 
-    tf.logging.info('Loaded %d words.', current_idx)
-    tf.logging.info('Finished loading')
-    return zip(ids, chars_ids, global_word_ids)
+  def _get_shards(self, forever=True):
+    """Yields randomly selected shards, as flat arrays."""
+    if self._prefetch:
+      for arrays in self._prefetch_shards(forever):
+        yield arrays
+      return
 
-  def _get_sentence(self, forever=True):
     while True:
-      ids = self._load_random_shard()
-      for current_ids in ids:
-        yield current_ids
+      yield self._load_random_shard()
       if not forever:
         break
 
+  def _prefetch_shards(self, forever):
+    """Yields shards that are loaded one ahead by a background thread."""
+    # Items are (arrays, exc_info) pairs; an error while loading is passed on
+    # to the consumer instead of silently ending the thread.
+    shards = Queue.Queue(maxsize=1)
+
+    def _load():
+      try:
+        while True:
+          shards.put((self._load_random_shard(), None))
+          if not forever:
+            break
+        shards.put((None, None))
+      except Exception:  # pylint: disable=broad-except
+        shards.put((None, sys.exc_info()))
+
+    loader = threading.Thread(target=_load)
+    loader.daemon = True
+    loader.start()
+
+    while True:
+      arrays, exc_info = shards.get()
+      if exc_info is not None:
+        six.reraise(*exc_info)
+      if arrays is None:
+        break
+      yield arrays
+
+  def _get_sentence(self, forever=True):
+    for arrays in self._get_shards(forever):
+      for current_ids in self._shard_sentences(arrays):
+        yield current_ids
+
   def get_batch(self, batch_size, num_steps, pad=False, forever=True):
     return get_batch(self._get_sentence(forever), batch_size, num_steps,
                      self.vocab.max_word_length, pad=pad)
 
+  def get_stream_batch(self, batch_size, num_steps, pad=False, forever=True):
+    return get_stream_batch(self._get_shards(forever), batch_size, num_steps,
+                            self.vocab.max_word_length, pad=pad)
+
   @property
   def vocab(self):
     return self._vocab
@@ -17,6 +17,7 @@
 """
 import os
 import sys
+import time
 
 import numpy as np
 import tensorflow as tf
@@ -54,6 +55,17 @@ tf.flags.DEFINE_integer('max_sample_words', 100,
                         'of steps has passed.')
 tf.flags.DEFINE_integer('num_samples', 3,
                         'Number of samples to generate for the prefix.')
+tf.flags.DEFINE_integer('sample_batch_size', 64,
+                        'Number of samples generated in parallel, if the '
+                        'graph does not fix its batch size.')
+tf.flags.DEFINE_string('sample_file', '',
+                       'Optional file to append the samples to, one per line. '
+                       'Samples already in the file count towards '
+                       'FLAGS.num_samples, so an interrupted run resumes.')
+# dump_emb mode flags.
+tf.flags.DEFINE_integer('dump_emb_batch_size', 4096,
+                        'Number of words embedded per run, if the graph does '
+                        'not fix its batch size.')
 # dump_lstm_emb mode flags.
 tf.flags.DEFINE_string('sentence', '',
                        'Used as input for "dump_lstm_emb" mode.')
@@ -62,6 +74,12 @@ tf.flags.DEFINE_string('input_data', '',
                        'Input data files for eval model.')
 tf.flags.DEFINE_integer('max_eval_steps', 1000000,
                         'Maximum mumber of steps to run "eval" mode.')
+tf.flags.DEFINE_string('cache_dir', '',
+                       'Optional directory in which to cache the encoded '
+                       'input data for "eval" mode.')
+tf.flags.DEFINE_bool('prefetch_shards', True,
+                     'Load the next input shard in the background in "eval" '
+                     'mode.')
 
 
 # For saving demo resources, use batch size 1 and step 1.
@@ -117,6 +135,14 @@ def _LoadModel(gd_file, ckpt_file):
   return sess, t
 
 
+def _BatchSize(tensor, default):
+  """Returns the batch size fixed by the graph for tensor, or default."""
+  shape = tensor.get_shape()
+  if shape.ndims and shape[0].value is not None:
+    return shape[0].value
+  return default
+
+
 def _EvalModel(dataset):
   """Evaluate model perplexity using provided dataset.
 
@@ -128,10 +154,13 @@ def _EvalModel(dataset):
   current_step = t['global_step'].eval(session=sess)
   sys.stderr.write('Loaded step %d.\n' % current_step)
 
-  data_gen = dataset.get_batch(BATCH_SIZE, NUM_TIMESTEPS, forever=False)
+  data_gen = dataset.get_stream_batch(BATCH_SIZE, NUM_TIMESTEPS,
+                                      forever=False)
   sum_num = 0.0
   sum_den = 0.0
   perplexity = 0.0
+  num_tokens = 0
+  start_time = time.time()
   for i, (inputs, char_inputs, _, targets, weights) in enumerate(data_gen):
     input_dict = {t['inputs_in']: inputs,
                   t['targets_in']: targets,
@@ -148,15 +177,33 @@ def _EvalModel(dataset):
     if sum_den > 0:
       perplexity = np.exp(sum_num / sum_den)
 
-    sys.stderr.write('Eval Step: %d, Average Perplexity: %f.\n' %
-                     (i, perplexity))
+    num_tokens += int(weights.sum())
+    tokens_per_sec = num_tokens / max(time.time() - start_time, 1e-6)
+    sys.stderr.write('Eval Step: %d, Average Perplexity: %f, '
+                     'Tokens/sec: %.1f.\n' % (i, perplexity, tokens_per_sec))
 
     if i > FLAGS.max_eval_steps:
       break
 
 
 def _SampleSoftmax(softmax):
-  return min(np.sum(np.cumsum(softmax) < np.random.rand()), len(softmax) - 1)
+  """Samples one id from each row of softmax.
+
+  Args:
+    softmax: [batch_size, vocab_size] array of probabilities.
+
+  Returns:
+    int array with the sampled id of each row.
+  """
+  softmax = np.atleast_2d(softmax)
+  batch_size, vocab_size = softmax.shape
+  # Offset each row's cdf by its row index, so that one searchsorted over the
+  # flattened cdfs samples all the rows.
+  offsets = np.arange(batch_size)
+  cdf = np.minimum(np.cumsum(softmax, axis=1, dtype=np.float64), 1.0)
+  cdf += offsets[:, np.newaxis]
+  samples = np.searchsorted(cdf.ravel(), np.random.rand(batch_size) + offsets)
+  return np.minimum(samples - offsets * vocab_size, vocab_size - 1)
 
 
 def _SampleModel(prefix_words, vocab):
@@ -167,47 +214,77 @@ def _SampleModel(prefix_words, vocab):
     vocab: Vocabulary. Contains max word chard id length and converts between
         words and ids.
   """
-  targets = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
-  weights = np.ones([BATCH_SIZE, NUM_TIMESTEPS], np.float32)
-
   sess, t = _LoadModel(FLAGS.pbtxt, FLAGS.ckpt)
 
+  # Each row of the batch generates an independent sample.
+  batch_size = _BatchSize(t['inputs_in'], FLAGS.sample_batch_size)
+  inputs = np.zeros([batch_size, NUM_TIMESTEPS], np.int32)
+  char_ids_inputs = np.zeros(
+      [batch_size, NUM_TIMESTEPS, vocab.max_word_length], np.int32)
+  targets = np.zeros([batch_size, NUM_TIMESTEPS], np.int32)
+  weights = np.ones([batch_size, NUM_TIMESTEPS], np.float32)
+
   if prefix_words.find('<S>') != 0:
     prefix_words = '<S> ' + prefix_words
 
   prefix = [vocab.word_to_id(w) for w in prefix_words.split()]
   prefix_char_ids = [vocab.word_to_char_ids(w) for w in prefix_words.split()]
-  for _ in xrange(FLAGS.num_samples):
-    inputs = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
-    char_ids_inputs = np.zeros(
-        [BATCH_SIZE, NUM_TIMESTEPS, vocab.max_word_length], np.int32)
-    samples = prefix[:]
-    char_ids_samples = prefix_char_ids[:]
-    sent = ''
+
+  num_done = 0
+  if FLAGS.sample_file and tf.gfile.Exists(FLAGS.sample_file):
+    with tf.gfile.Open(FLAGS.sample_file) as f:
+      num_done = len(f.readlines())
+    sys.stderr.write('Resuming after %d samples.\n' % num_done)
+
+  while num_done < FLAGS.num_samples:
+    num_rows = min(batch_size, FLAGS.num_samples - num_done)
+    sess.run(t['states_init'])
+
+    sents = [prefix_words.split()[1:] for _ in xrange(num_rows)]
+    done = np.arange(batch_size) >= num_rows
+    step = 0
     while True:
-      inputs[0, 0] = samples[0]
-      char_ids_inputs[0, 0, :] = char_ids_samples[0]
-      samples = samples[1:]
-      char_ids_samples = char_ids_samples[1:]
+      if step < len(prefix):
+        inputs[:, 0] = prefix[step]
+        char_ids_inputs[:, 0, :] = prefix_char_ids[step]
+      step += 1
 
       softmax = sess.run(t['softmax_out'],
                          feed_dict={t['char_inputs_in']: char_ids_inputs,
                                     t['inputs_in']: inputs,
                                     t['targets_in']: targets,
                                     t['target_weights_in']: weights})
+      if step < len(prefix):
+        continue
+
+      samples = _SampleSoftmax(softmax)
+      for i in np.flatnonzero(~done):
+        sents[i].append(vocab.id_to_word(samples[i]))
+        if (sents[i][-1] == '</S>' or
+            step - len(prefix) + 1 >= FLAGS.max_sample_words):
+          done[i] = True
+      if done.all():
+        break
 
-      sample = _SampleSoftmax(softmax[0])
-      sample_char_ids = vocab.word_to_char_ids(vocab.id_to_word(sample))
+      inputs[:, 0] = samples
+      char_ids_inputs[:, 0, :] = [
+          vocab.word_to_char_ids(vocab.id_to_word(s)) for s in samples]
 
-      if not samples:
-        samples = [sample]
-        char_ids_samples = [sample_char_ids]
-      sent += vocab.id_to_word(samples[0]) + ' '
-      sys.stderr.write('%s\n' % sent)
+    lines = ['%s\n' % ' '.join(sent) for sent in sents]
+    for line in lines:
+      sys.stderr.write(line)
+    if FLAGS.sample_file:
+      with tf.gfile.Open(FLAGS.sample_file, mode='a') as f:
+        f.write(''.join(lines))
+    num_done += num_rows
 
-      if (vocab.id_to_word(samples[0]) == '</S>' or
-          len(sent) > FLAGS.max_sample_words):
-        break
+
+def _WriteProgress(progress_fname, num_done):
+  """Atomically records in progress_fname that num_done items are written."""
+  tmp_fname = '%s.tmp.%d' % (progress_fname, os.getpid())
+  with open(tmp_fname, 'w') as f:
+    f.write('%d' % num_done)
+  os.rename(tmp_fname, progress_fname)
 
 
 def _DumpEmb(vocab):
@@ -217,33 +294,66 @@ def _DumpEmb(vocab):
     vocab: Vocabulary. Contains vocabulary size and converts word to ids.
   """
   assert FLAGS.save_dir, 'Must specify FLAGS.save_dir for dump_emb.'
-  inputs = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
-  targets = np.zeros([BATCH_SIZE, NUM_TIMESTEPS], np.int32)
-  weights = np.ones([BATCH_SIZE, NUM_TIMESTEPS], np.float32)
-
   sess, t = _LoadModel(FLAGS.pbtxt, FLAGS.ckpt)
 
+  if 'char_inputs_in' in t:
+    batch_size = _BatchSize(t['char_inputs_in'], FLAGS.dump_emb_batch_size)
+  else:
+    batch_size = _BatchSize(t['inputs_in'], FLAGS.dump_emb_batch_size)
+  inputs = np.zeros([batch_size, NUM_TIMESTEPS], np.int32)
+  char_inputs = np.zeros([batch_size, NUM_TIMESTEPS, MAX_WORD_LEN], np.int32)
+  targets = np.zeros([batch_size, NUM_TIMESTEPS], np.int32)
+  weights = np.ones([batch_size, NUM_TIMESTEPS], np.float32)
+
   softmax_weights = sess.run(t['softmax_weights'])
   fname = FLAGS.save_dir + '/embeddings_softmax.npy'
   with tf.gfile.Open(fname, mode='w') as f:
     np.save(f, softmax_weights)
   sys.stderr.write('Finished softmax weights\n')
 
-  all_embs = np.zeros([vocab.size, 1024])
-  for i in range(vocab.size):
+  # The embeddings are written to a memmap in a partial file, and the number
+  # of words written so far is kept in a progress file. Once all are done the
+  # partial file is renamed, so the embedding file only exists when complete.
+  fname = FLAGS.save_dir + '/embeddings_char_cnn.npy'
+  partial_fname = fname + '.partial'
+  progress_fname = fname + '.progress'
+  emb_size = t['all_embs'].get_shape()[-1].value or 1024
+  if os.path.exists(fname):
+    sys.stderr.write('Embedding file already saved\n')
+    return
+
+  start = 0
+  if os.path.exists(partial_fname) and os.path.exists(progress_fname):
+    all_embs = np.lib.format.open_memmap(partial_fname, mode='r+')
+    with open(progress_fname) as f:
+      start = int(f.read())
+    sys.stderr.write('Resuming at word embedding %d/%d\n' % (start, vocab.size))
+  else:
+    all_embs = np.lib.format.open_memmap(
+        partial_fname, mode='w+', dtype=np.float32,
+        shape=(vocab.size, emb_size))
+    _WriteProgress(progress_fname, 0)
+
+  for begin in xrange(start, vocab.size, batch_size):
+    end = min(begin + batch_size, vocab.size)
+    char_inputs[:end - begin, 0, :] = vocab.word_char_ids[begin:end]
+    char_inputs[end - begin:] = 0
+
     input_dict = {t['inputs_in']: inputs,
                   t['targets_in']: targets,
                   t['target_weights_in']: weights}
     if 'char_inputs_in' in t:
-      input_dict[t['char_inputs_in']] = (
-          vocab.word_char_ids[i].reshape([-1, 1, MAX_WORD_LEN]))
+      input_dict[t['char_inputs_in']] = char_inputs
     embs = sess.run(t['all_embs'], input_dict)
-    all_embs[i, :] = embs
-    sys.stderr.write('Finished word embedding %d/%d\n' % (i, vocab.size))
+    all_embs[begin:end] = embs.reshape([batch_size, -1])[:end - begin]
 
-  fname = FLAGS.save_dir + '/embeddings_char_cnn.npy'
-  with tf.gfile.Open(fname, mode='w') as f:
-    np.save(f, all_embs)
+    all_embs.flush()
+    _WriteProgress(progress_fname, end)
+    sys.stderr.write('Finished word embedding %d/%d\n' % (end, vocab.size))
+
+  del all_embs
+  os.rename(partial_fname, fname)
+  os.remove(progress_fname)
   sys.stderr.write('Embedding file saved\n')
 
 
@@ -291,7 +401,9 @@ def main(unused_argv):
   vocab = data_utils.CharsVocabulary(FLAGS.vocab_file, MAX_WORD_LEN)
 
   if FLAGS.mode == 'eval':
-    dataset = data_utils.LM1BDataset(FLAGS.input_data, vocab)
+    dataset = data_utils.LM1BDataset(FLAGS.input_data, vocab,
+                                     cache_dir=FLAGS.cache_dir or None,
+                                     prefetch=FLAGS.prefetch_shards)
     _EvalModel(dataset)
   elif FLAGS.mode == 'sample':
     _SampleModel(FLAGS.prefix, vocab)
@@ -14,11 +14,12 @@
 # ==============================================================================
 """Neural GPU -- data generation and batching utilities."""
 
+import hashlib
 import math
+import multiprocessing
 import os
 import random
 import sys
-import time
 
 import numpy as np
 import tensorflow as tf
@@ -47,14 +48,77 @@ def bin_for(l):
   return len(bins) - 1
 
 
+class DataBin(object):
+  """The cases of one bin, padded with zeros and packed in int32 arrays.
+
+  A case is a pair of a list of input rows and a list of target rows. The
+  rows are stored in inputs[i] and targets[i], of shapes [rows, length],
+  where rows is the most rows of any case, so that get_batch can gather a
+  batch without building lists. For the bucketing code a DataBin is a
+  container whose len() is the number of cases.
+  """
+
+  def __init__(self, length):
+    self.length = length
+    self.size = 0
+    self.inputs = np.zeros((0, 1, length), dtype=np.int32)
+    self.targets = np.zeros((0, 1, length), dtype=np.int32)
+    # The longest row of each case, which may not fit the bin.
+    self.lengths = np.zeros(0, dtype=np.int32)
+
+  def __len__(self):
+    return self.size
+
+  def _reserve(self, size, input_rows, target_rows, length):
+    """Grow the arrays to hold size cases with the given rows and length."""
+    capacity = self.inputs.shape[0]
+    if size > capacity:
+      capacity = max(size, 2 * capacity)
+    length = max(length, self.inputs.shape[2])
+    input_rows = max(input_rows, self.inputs.shape[1])
+    target_rows = max(target_rows, self.targets.shape[1])
+    if ((capacity, input_rows, length) != self.inputs.shape or
+        (capacity, target_rows, length) != self.targets.shape):
+      inputs = np.zeros((capacity, input_rows, length), dtype=np.int32)
+      targets = np.zeros((capacity, target_rows, length), dtype=np.int32)
+      old_inputs, old_targets = self.inputs, self.targets
+      inputs[:self.size, :old_inputs.shape[1], :old_inputs.shape[2]] = (
+          old_inputs[:self.size])
+      targets[:self.size, :old_targets.shape[1], :old_targets.shape[2]] = (
+          old_targets[:self.size])
+      lengths = np.zeros(capacity, dtype=np.int32)
+      lengths[:self.size] = self.lengths[:self.size]
+      self.inputs, self.targets, self.lengths = inputs, targets, lengths
+
+  def append(self, case):
+    """Append a case given as a pair of lists of input and target rows."""
+    inpt, target = case
+    length = max([len(r) for r in inpt] + [len(r) for r in target] + [0])
+    self._reserve(self.size + 1, len(inpt), len(target), length)
+    for dest, rows in [(self.inputs, inpt), (self.targets, target)]:
+      for i, row in enumerate(rows):
+        dest[self.size, i, :len(row)] = row
+    self.lengths[self.size] = length
+    self.size += 1
+
+  def extend(self, inputs, targets):
+    """Append cases given as [n, rows, length] arrays padded with zeros."""
+    n = inputs.shape[0]
+    length = max(inputs.shape[2], targets.shape[2])
+    self._reserve(self.size + n, inputs.shape[1], targets.shape[1], length)
+    end = self.size + n
+    self.inputs[self.size:end, :inputs.shape[1], :inputs.shape[2]] = inputs
+    self.targets[self.size:end, :targets.shape[1], :targets.shape[2]] = (
+        targets)
+    self.lengths[self.size:end] = length
+    self.size = end
+
+
 train_set = {}
 test_set = {}
 for some_task in all_tasks:
-  train_set[some_task] = []
-  test_set[some_task] = []
-  for all_max_len in xrange(10000):
-    train_set[some_task].append([])
-    test_set[some_task].append([])
+  train_set[some_task] = [DataBin(b) for b in bins]
+  test_set[some_task] = [DataBin(b) for b in bins]
 
 
 def read_tmp_file(name):
@@ -106,66 +170,300 @@ def add(n1, n2, base=10):
   return [0]
 
 
-def init_data(task, length, nbr_cases, nclass):
-  """Data initialization."""
-  def rand_pair(l, task):
-    """Random data pair for a task. Total length should be <= l."""
-    k = (l-1)/2
+def _strip_lengths(digits):
+  """Lengths of lower-endian digit rows without trailing zeros, at least 1."""
+  nonzero = digits[:, ::-1] != 0
+  lengths = digits.shape[1] - np.argmax(nonzero, axis=1)
+  lengths[~nonzero.any(axis=1)] = 1
+  return lengths
+
+
+def add_batch(d1, d2, base=10):
+  """Add rows of lower-endian digit arrays, like add() on each pair of rows.
+
+  Args:
+    d1: [n, k] array of digits.
+    d2: [n, k] array of digits.
+    base: the base of the digits.
+
+  Returns:
+    A pair of the [n, k + 1] array of the digits of the sums, and the
+    length of each sum as add() returns it.
+  """
+  n, k = d1.shape
+  res = np.zeros((n, k + 1), dtype=np.int64)
+  carry = np.zeros(n, dtype=np.int64)
+  for i in xrange(k):
+    total = d1[:, i] + d2[:, i] + carry
+    carry = (total >= base).astype(np.int64)
+    res[:, i] = total - carry * base
+  res[:, k] = carry
+  return res, _strip_lengths(res)
+
+
+def mul_batch(d1, d2, base=10):
+  """Multiply rows of lower-endian digit arrays.
+
+  Args:
+    d1: [n, k] array of digits.
+    d2: [n, k] array of digits.
+    base: the base of the digits.
+
+  Returns:
+    A pair of the [n, max(2k, 1)] array of the digits of the products, and
+    the number of digits of each product, which is 1 for 0.
+  """
+  n, k = d1.shape
+  res = np.zeros((n, max(2 * k, 1)), dtype=np.int64)
+  for i in xrange(k):
+    res[:, i:i + k] += d1[:, i:i + 1] * d2
+  carry = np.zeros(n, dtype=np.int64)
+  for i in xrange(res.shape[1]):
+    total = res[:, i] + carry
+    carry = total // base
+    res[:, i] = total - carry * base
+  return res, _strip_lengths(res)
+
+
+def _interleave(a, b):
+  """Interleave the columns of two [n, k] arrays into one [n, 2k] array."""
+  return np.stack([a, b], axis=2).reshape(a.shape[0], -1)
+
+
+def _spec(task, inp, nclass):
+  """Return the target given the input for some tasks."""
+  if task == "sort":
+    return sorted(inp)
+  elif task == "id":
+    return inp
+  elif task == "rev":
+    return [i for i in reversed(inp)]
+  elif task == "incr":
+    carry = 1
+    res = []
+    for i in xrange(len(inp)):
+      if inp[i] + carry < nclass:
+        res.append(inp[i] + carry)
+        carry = 0
+      else:
+        res.append(1)
+        carry = 1
+    return res
+  elif task == "left":
+    return [inp[0]]
+  elif task == "right":
+    return [inp[-1]]
+  elif task == "left-shift":
+    return [inp[l-1] for l in xrange(len(inp))]
+  elif task == "right-shift":
+    return [inp[l+1] for l in xrange(len(inp))]
+  else:
+    print_out("Unknown spec for task " + str(task))
+    sys.exit()
+
+
+def _spec_batch(task, inp, nclass):
+  """_spec on each row of the [n, l] array inp, vectorized where possible."""
+  if task == "sort":
+    return np.sort(inp, axis=1)
+  elif task == "id":
+    return inp
+  elif task == "rev":
+    return inp[:, ::-1]
+  elif task == "incr":
+    # Digits equal to nclass - 1 overflow to 1 when a carry reaches them, and
+    # a carry reaches the first digit and every digit after overflowing ones.
+    overflow = inp + 1 >= nclass
+    carry_in = np.ones(inp.shape, dtype=bool)
+    carry_in[:, 1:] = np.cumprod(overflow, axis=1)[:, :-1]
+    return np.where(carry_in, np.where(overflow, 1, inp + 1), inp)
+  elif task == "left" and inp.shape[1]:
+    return inp[:, :1]
+  elif task == "right" and inp.shape[1]:
+    return inp[:, -1:]
+  elif task == "left-shift":
+    return np.roll(inp, 1, axis=1)
+  else:
+    return np.array([_spec(task, i, nclass) for i in inp.tolist()],
+                    dtype=np.int64).reshape(inp.shape[0], -1)
+
+
+def _case_draws(task, l, nclass):
+  """Number of random integers drawn per case and their upper bound."""
+  if task in ["add", "badd", "qadd", "bmul", "mul"]:
     base = 10
     if task[0] == "b": base = 2
     if task[0] == "q": base = 4
-    d1 = [np.random.randint(base) for _ in xrange(k)]
-    d2 = [np.random.randint(base) for _ in xrange(k)]
+    return 2 * max((l - 1) // 2, 0), base
+  if task == "dup":
+    return l // 2, nclass - 1
+  if task in ["rev2", "kvsort"]:
+    return 2 * (l // 2), nclass - 1
+  if task == "search":
+    # The cases have l - 1/2 pairs, that is l with integer division.
+    return 2 * l + 1, nclass - 1
+  return l, nclass - 1
+
+
+def _cases_from_draws(task, l, nclass, draws):
+  """Build cases from their random draws.
+
+  Args:
+    task: the task name.
+    l: the length the cases were drawn for.
+    nclass: the number of classes.
+    draws: [n, ndraws] array of the random integers drawn for each case, as
+      given by _case_draws.
+
+  Returns:
+    A triple of the [n, input length] array of inputs, the [n, target
+    length] array of targets padded with zeros and the [n] array of the
+    target lengths.
+  """
+  n = draws.shape[0]
+  if task in ["add", "badd", "qadd", "bmul", "mul"]:
+    _, base = _case_draws(task, l, nclass)
+    k = draws.shape[1] // 2
+    d1, d2 = draws[:, :k], draws[:, k:]
     if task in ["add", "badd", "qadd"]:
-      res = add(d1, d2, base)
-    elif task in ["mul", "bmul"]:
-      d1n = sum([d * (base ** i) for i, d in enumerate(d1)])
-      d2n = sum([d * (base ** i) for i, d in enumerate(d2)])
-      if task == "bmul":
-        res = [int(x) for x in list(reversed(str(bin(d1n * d2n))))[:-2]]
-      else:
-        res = [int(x) for x in list(reversed(str(d1n * d2n)))]
+      res, lengths = add_batch(d1, d2, base)
+      sep = 11
     else:
-      sys.exit()
-    sep = [12]
-    if task in ["add", "badd", "qadd"]: sep = [11]
-    inp = [d + 1 for d in d1] + sep + [d + 1 for d in d2]
-    return inp, [r + 1 for r in res]
-
-  def rand_dup_pair(l):
-    """Random data pair for duplication task. Total length should be <= l."""
-    k = l/2
-    x = [np.random.randint(nclass - 1) + 1 for _ in xrange(k)]
-    inp = x + [0 for _ in xrange(l - k)]
-    res = x + x + [0 for _ in xrange(l - 2*k)]
-    return inp, res
-
-  def rand_rev2_pair(l):
-    """Random data pair for reverse2 task. Total length should be <= l."""
-    inp = [(np.random.randint(nclass - 1) + 1,
-            np.random.randint(nclass - 1) + 1) for _ in xrange(l/2)]
-    res = [i for i in reversed(inp)]
-    return [x for p in inp for x in p], [x for p in res for x in p]
-
-  def rand_search_pair(l):
-    """Random data pair for search task. Total length should be <= l."""
-    inp = [(np.random.randint(nclass - 1) + 1,
-            np.random.randint(nclass - 1) + 1) for _ in xrange(l-1/2)]
-    q = np.random.randint(nclass - 1) + 1
-    res = 0
-    for (k, v) in reversed(inp):
-      if k == q:
-        res = v
-    return [x for p in inp for x in p] + [q], [res]
-
-  def rand_kvsort_pair(l):
-    """Random data pair for key-value sort. Total length should be <= l."""
-    keys = [(np.random.randint(nclass - 1) + 1, i) for i in xrange(l/2)]
-    vals = [np.random.randint(nclass - 1) + 1 for _ in xrange(l/2)]
-    kv = [(k, vals[i]) for (k, i) in keys]
-    sorted_kv = [(k, vals[i]) for (k, i) in sorted(keys)]
-    return [x for p in kv for x in p], [x for p in sorted_kv for x in p]
-
+      res, lengths = mul_batch(d1, d2, base)
+      sep = 12
+    inp = np.concatenate([d1 + 1, np.full((n, 1), sep, dtype=np.int64),
+                          d2 + 1], axis=1)
+    target = res + 1
+    target[np.arange(res.shape[1]) >= lengths[:, None]] = 0
+    return inp, target, lengths
+
+  draws = draws + 1
+  if task == "dup":
+    k = draws.shape[1]
+    inp = np.zeros((n, l), dtype=np.int64)
+    inp[:, :k] = draws
+    target = np.zeros((n, l), dtype=np.int64)
+    target[:, :k] = draws
+    target[:, k:2 * k] = draws
+  elif task == "rev2":
+    inp = draws
+    target = draws.reshape(n, -1, 2)[:, ::-1].reshape(n, -1)
+  elif task == "search":
+    inp = draws
+    keys, vals, q = draws[:, 0:-1:2], draws[:, 1:-1:2], draws[:, -1:]
+    # The value of the first pair with the query as key, or 0 if none.
+    match = np.concatenate([keys == q, np.ones((n, 1), dtype=bool)], axis=1)
+    vals = np.concatenate([vals, np.zeros((n, 1), dtype=np.int64)], axis=1)
+    target = vals[np.arange(n), np.argmax(match, axis=1)][:, None]
+  elif task == "kvsort":
+    half = draws.shape[1] // 2
+    keys, vals = draws[:, :half], draws[:, half:]
+    inp = _interleave(keys, vals)
+    # A stable sort on the keys orders equal keys by position, as sorting
+    # (key, position) pairs does.
+    order = np.argsort(keys, axis=1, kind="mergesort")
+    rows = np.arange(n)[:, None]
+    target = _interleave(keys[rows, order], vals[rows, order])
+  else:
+    inp = draws
+    target = _spec_batch(task, inp, nclass)
+  return inp, target, np.full(n, target.shape[1], dtype=np.int64)
+
+
+def _cases_from_draws_star(args):
+  return _cases_from_draws(*args)
+
+
+_pools = {}
+
+
+def _get_pool(num_processes):
+  """A process pool of the given size, kept for all later calls."""
+  if num_processes not in _pools:
+    _pools[num_processes] = multiprocessing.Pool(num_processes)
+  return _pools[num_processes]
+
+
+def _rng_state_digest():
+  _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+  digest = hashlib.md5(keys.tobytes())
+  digest.update(repr((pos, has_gauss, cached_gaussian)).encode("ascii"))
+  return digest.hexdigest()
+
+
+def gen_cases(task, length, nbr_cases, nclass, num_processes=1,
+              cache_dir=None):
+  """Generate training and test cases of an algorithmic task in one shot.
+
+  Draws the same random numbers from np.random as generating the cases one
+  by one, a training case and then a test case, so that under a fixed seed
+  it gives the same cases and leaves np.random in the same state.
+
+  Args:
+    task: the task name, not a program task.
+    length: the length to generate cases for.
+    nbr_cases: the number of training and of test cases.
+    nclass: the number of classes.
+    num_processes: if above 1, build the cases from the random draws in that
+      many processes.
+    cache_dir: if not empty, a directory with a cache file per (task, length,
+      number of cases). A cache file is only used if it was generated from
+      the current state of np.random, which it then sets to the state after
+      generation.
+
+  Returns:
+    A triple of int32 arrays of the inputs, the targets padded with zeros
+    and the target lengths, of shapes [2, nbr_cases, input length],
+    [2, nbr_cases, target length] and [2, nbr_cases]. The training cases come
+    first.
+  """
+  cache_file = None
+  if cache_dir:
+    cache_file = os.path.join(cache_dir, "%s_len%d_n%d_c%d.npz"
+                              % (task, length, nbr_cases, nclass))
+    state_digest = _rng_state_digest()
+    if os.path.exists(cache_file):
+      cache = np.load(cache_file)
+      if str(cache["state_digest"]) == state_digest:
+        state = cache["state"]
+        np.random.set_state((str(cache["state_name"]), state,
+                             int(cache["state_pos"]),
+                             int(cache["state_has_gauss"]),
+                             float(cache["state_cached_gaussian"])))
+        return cache["inputs"], cache["targets"], cache["target_lengths"]
+
+  ndraws, high = _case_draws(task, length, nclass)
+  draws = np.random.randint(high, size=(nbr_cases, 2, ndraws))
+  draws = draws.transpose(1, 0, 2).reshape(2 * nbr_cases, ndraws)
+  if num_processes > 1:
+    chunks = np.array_split(draws, num_processes)
+    parts = _get_pool(num_processes).map(
+        _cases_from_draws_star, [(task, length, nclass, c) for c in chunks])
+    inputs, targets, target_lengths = [np.concatenate(p) for p in zip(*parts)]
+  else:
+    inputs, targets, target_lengths = _cases_from_draws(task, length, nclass,
+                                                        draws)
+  inputs = inputs.astype(np.int32).reshape(2, nbr_cases, -1)
+  targets = targets.astype(np.int32).reshape(2, nbr_cases, -1)
+  target_lengths = target_lengths.astype(np.int32).reshape(2, nbr_cases)
+
+  if cache_file:
+    if not tf.gfile.Exists(cache_dir):
+      tf.gfile.MakeDirs(cache_dir)
+    state_name, state, pos, has_gauss, cached_gaussian = np.random.get_state()
+    tmp_file = "%s.tmp%d.npz" % (cache_file[:-len(".npz")], os.getpid())
+    np.savez(tmp_file, inputs=inputs, targets=targets,
+             target_lengths=target_lengths, state_digest=state_digest,
+             state_name=state_name, state=state, state_pos=pos,
+             state_has_gauss=has_gauss,
+             state_cached_gaussian=cached_gaussian)
+    os.rename(tmp_file, cache_file)
+  return inputs, targets, target_lengths
+
+
+def init_data(task, length, nbr_cases, nclass, num_processes=1,
+              cache_dir=None):
+  """Data initialization."""
   def prog_io_pair(prog, max_len, counter=0):
     try:
       ilen = np.random.randint(max_len - 3) + 1
@@ -173,7 +471,7 @@ def init_data(task, length, nbr_cases, nclass):
       inp = [random.choice(range(-bound, bound)) for _ in range(ilen)]
       inp_toks = [program_utils.prog_rev_vocab[t]
                   for t in program_utils.tokenize(str(inp)) if t != ","]
-      out = program_utils.evaluate(prog, {"a": inp})
+      out = program_utils.evaluate_batch(prog, [[inp]])[0]
       out_toks = [program_utils.prog_rev_vocab[t]
                   for t in program_utils.tokenize(str(out)) if t != ","]
       if counter > 400:
@@ -190,40 +488,7 @@ def init_data(task, length, nbr_cases, nclass):
     except ValueError:
       return prog_io_pair(prog, max_len, counter+1)
 
-  def spec(inp):
-    """Return the target given the input for some tasks."""
-    if task == "sort":
-      return sorted(inp)
-    elif task == "id":
-      return inp
-    elif task == "rev":
-      return [i for i in reversed(inp)]
-    elif task == "incr":
-      carry = 1
-      res = []
-      for i in xrange(len(inp)):
-        if inp[i] + carry < nclass:
-          res.append(inp[i] + carry)
-          carry = 0
-        else:
-          res.append(1)
-          carry = 1
-      return res
-    elif task == "left":
-      return [inp[0]]
-    elif task == "right":
-      return [inp[-1]]
-    elif task == "left-shift":
-      return [inp[l-1] for l in xrange(len(inp))]
-    elif task == "right-shift":
-      return [inp[l+1] for l in xrange(len(inp))]
-    else:
-      print_out("Unknown spec for task " + str(task))
-      sys.exit()
-
   l = length
-  cur_time = time.time()
-  total_time = 0.0
 
   is_prog = task in ["progeval", "progsynth"]
   if is_prog:
@@ -295,43 +560,21 @@ def init_data(task, length, nbr_cases, nclass):
             ilist.append(inp + out)
           dset[task][bin_for(plen)].append([ilist, [ptoks]])
 
-  for case in xrange(0 if is_prog else nbr_cases):
-    total_time += time.time() - cur_time
-    cur_time = time.time()
-    if l > 10000 and case % 100 == 1:
-      print_out("  avg gen time %.4f s" % (total_time / float(case)))
+  if is_prog:
+    return
+
+  inputs, targets, target_lengths = gen_cases(
+      task, l, nbr_cases, nclass, num_processes=num_processes,
+      cache_dir=cache_dir)
+  for dset, dset_inputs, dset_targets in zip([train_set, test_set],
+                                             inputs, targets):
     if task in ["add", "badd", "qadd", "bmul", "mul"]:
-      i, t = rand_pair(l, task)
-      train_set[task][bin_for(len(i))].append([[[], i, [], []], [t]])
-      i, t = rand_pair(l, task)
-      test_set[task][bin_for(len(i))].append([[[], i, [], []], [t]])
-    elif task == "dup":
-      i, t = rand_dup_pair(l)
-      train_set[task][bin_for(len(i))].append([[i], [t]])
-      i, t = rand_dup_pair(l)
-      test_set[task][bin_for(len(i))].append([[i], [t]])
-    elif task == "rev2":
-      i, t = rand_rev2_pair(l)
-      train_set[task][bin_for(len(i))].append([[i], [t]])
-      i, t = rand_rev2_pair(l)
-      test_set[task][bin_for(len(i))].append([[i], [t]])
-    elif task == "search":
-      i, t = rand_search_pair(l)
-      train_set[task][bin_for(len(i))].append([[i], [t]])
-      i, t = rand_search_pair(l)
-      test_set[task][bin_for(len(i))].append([[i], [t]])
-    elif task == "kvsort":
-      i, t = rand_kvsort_pair(l)
-      train_set[task][bin_for(len(i))].append([[i], [t]])
-      i, t = rand_kvsort_pair(l)
-      test_set[task][bin_for(len(i))].append([[i], [t]])
-    elif task not in ["progeval", "progsynth"]:
-      inp = [np.random.randint(nclass - 1) + 1 for i in xrange(l)]
-      target = spec(inp)
-      train_set[task][bin_for(l)].append([[inp], [target]])
-      inp = [np.random.randint(nclass - 1) + 1 for i in xrange(l)]
-      target = spec(inp)
-      test_set[task][bin_for(l)].append([[inp], [target]])
+      # The number is the second of four input rows.
+      rows = np.zeros((nbr_cases, 4, inputs.shape[2]), dtype=np.int32)
+      rows[:, 1] = dset_inputs
+    else:
+      rows = dset_inputs[:, None]
+    dset[task][bin_for(inputs.shape[2])].extend(rows, dset_targets[:, None])
 
 
 def to_symbol(i):
@@ -349,31 +592,59 @@ def to_id(s):
   return int(s) + 1
 
 
-def get_batch(bin_id, batch_size, data_set, height, offset=None, preset=None):
-  """Get a batch of data, training or testing."""
-  inputs, targets = [], []
+_batch_buffers = {}
+
+
+def get_batch(bin_id, batch_size, data_set, height, offset=None, preset=None,
+              reuse_buffers=False):
+  """Get a batch of data, training or testing.
+
+  Args:
+    bin_id: the bin to take the batch from.
+    batch_size: the number of cases in the batch.
+    data_set: a list of DataBins, indexed by bin.
+    height: the number of input rows; cases with one input row get zero rows
+      below it.
+    offset: if not None, take the cases from offset on, as far as the bin
+      has them, instead of random ones.
+    preset: if not None, a case to fill the batch with.
+    reuse_buffers: if True, return arrays that the next call with the same
+      sizes overwrites, instead of new ones.
+
+  Returns:
+    A pair of int32 arrays of the inputs and targets, of shapes
+    [batch_size, height, bins[bin_id]] and [batch_size, 1, bins[bin_id]].
+  """
   pad_length = bins[bin_id]
-  for b in xrange(batch_size):
-    if preset is None:
-      elem = random.choice(data_set[bin_id])
-      if offset is not None and offset + b < len(data_set[bin_id]):
-        elem = data_set[bin_id][offset + b]
-    else:
-      elem = preset
-    inpt, targett, inpl, targetl = elem[0], elem[1], [], []
-    for inp in inpt:
-      inpl.append(inp + [0 for _ in xrange(pad_length - len(inp))])
-    if len(inpl) == 1:
-      for _ in xrange(height - 1):
-        inpl.append([0 for _ in xrange(pad_length)])
-    for target in targett:
-      targetl.append(target + [0 for _ in xrange(pad_length - len(target))])
-    inputs.append(inpl)
-    targets.append(targetl)
-  res_input = np.array(inputs, dtype=np.int32)
-  res_target = np.array(targets, dtype=np.int32)
-  assert list(res_input.shape) == [batch_size, height, pad_length]
-  assert list(res_target.shape) == [batch_size, 1, pad_length]
+  if preset is None:
+    data_bin = data_set[bin_id]
+    idxs = np.array([random.randrange(len(data_bin))
+                     for _ in xrange(batch_size)], dtype=np.int64)
+    if offset is not None:
+      in_bin = offset + np.arange(batch_size) < len(data_bin)
+      idxs[in_bin] = offset + np.arange(batch_size)[in_bin]
+  else:
+    data_bin = DataBin(pad_length)
+    data_bin.append(preset)
+    idxs = np.zeros(batch_size, dtype=np.int64)
+  assert np.all(data_bin.lengths[idxs] <= pad_length)
+  input_rows = data_bin.inputs.shape[1]
+  assert input_rows <= height
+  assert data_bin.targets.shape[1] == 1
+
+  shapes = ((batch_size, height, pad_length), (batch_size, 1, pad_length))
+  if reuse_buffers and shapes in _batch_buffers:
+    res_input, res_target = _batch_buffers[shapes]
+  else:
+    res_input = np.empty(shapes[0], dtype=np.int32)
+    res_target = np.empty(shapes[1], dtype=np.int32)
+    if reuse_buffers:
+      _batch_buffers[shapes] = res_input, res_target
+  np.take(data_bin.inputs[:, :, :pad_length], idxs, axis=0,
+          out=res_input[:, :input_rows], mode="clip")
+  res_input[:, input_rows:] = 0
+  np.take(data_bin.targets[:, :, :pad_length], idxs, axis=0,
+          out=res_target, mode="clip")
   return res_input, res_target
 
 
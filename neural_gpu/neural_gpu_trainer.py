@@ -15,6 +15,7 @@
 """Neural GPU."""
 
 import math
+import multiprocessing
 import os
 import random
 import sys
@@ -48,6 +49,16 @@ tf.app.flags.DEFINE_integer("nmaps", 64, "Number of floats in each cell.")
 tf.app.flags.DEFINE_integer("vec_size", 64, "Size of word vectors.")
 tf.app.flags.DEFINE_integer("train_data_size", 1000, "Training examples/len.")
 tf.app.flags.DEFINE_integer("max_length", 40, "Maximum length.")
+tf.app.flags.DEFINE_integer("data_gen_processes", 1,
+                            "Processes to generate algorithmic data with.")
+tf.app.flags.DEFINE_string("data_cache_dir", "",
+                           "Directory to cache algorithmic data in.")
+tf.app.flags.DEFINE_integer("prog_eval_processes", 8,
+                            "Processes to evaluate programs in when scoring "
+                            "beams, 0 to evaluate them in the trainer.")
+tf.app.flags.DEFINE_integer("prog_eval_max_steps", 0,
+                            "Steps a program may take on one input when "
+                            "scoring beams, 0 for no limit.")
 tf.app.flags.DEFINE_integer("random_seed", 125459, "Random seed.")
 tf.app.flags.DEFINE_integer("nconvs", 2, "How many convolutions / 1 step.")
 tf.app.flags.DEFINE_integer("kw", 3, "Kernel width.")
@@ -130,12 +141,13 @@ def read_data(source_path, target_path, buckets, max_size=None, print_out=True):
     print_out: whether to print out status or not.
 
   Returns:
-    data_set: a list of length len(_buckets); data_set[n] contains a list of
-      (source, target) pairs read from the provided data files that fit
-      into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
-      len(target) < _buckets[n][1]; source and target are lists of token-ids.
+    data_set: a list of length len(_buckets); data_set[n] is a data.DataBin
+      with the (source, target) pairs read from the provided data files that
+      fit into the n-th bucket, i.e., such that len(source) < _buckets[n][0]
+      and len(target) < _buckets[n][1]; source and target are lists of rows
+      of token-ids.
   """
-  data_set = [[] for _ in buckets]
+  data_set = [data.DataBin(size) for size in buckets]
   counter = 0
   if max_size != 1:
     with tf.gfile.GFile(source_path, mode="r") as source_file:
@@ -291,10 +303,11 @@ def initialize(sess=None):
         data.rev_vocab = program_utils.prog_vocab
         data.vocab = program_utils.prog_rev_vocab
       else:
-        for l in xrange(max_length + EXTRA_EVAL - 1):
-          data.init_data(t, l, data_size, FLAGS.vocab_size)
-        data.init_data(t, data.bins[-2], data_size, FLAGS.vocab_size)
-        data.init_data(t, data.bins[-1], data_size, FLAGS.vocab_size)
+        lengths = range(max_length + EXTRA_EVAL - 1) + data.bins[-2:]
+        for l in lengths:
+          data.init_data(t, l, data_size, FLAGS.vocab_size,
+                         num_processes=FLAGS.data_gen_processes,
+                         cache_dir=FLAGS.data_cache_dir)
       if t not in global_train_set:
         global_train_set[t] = []
       global_train_set[t].append(data.train_set[t])
@@ -516,41 +529,141 @@ def get_bucket_id(train_buckets_scale_c, max_cur_length, data_set):
   return bucket_id
 
 
-def score_beams(beams, target, inp, history, p,
-                print_out=False, test_mode=False):
-  """Score beams."""
-  if p == "progsynth":
-    return score_beams_prog(beams, target, inp, history, print_out, test_mode)
-  elif test_mode:
-    return beams[0], 10.0 if str(beams[0][:len(target)]) == str(target) else 0.0
+_prog_eval_pool = None
+
+
+def _evaluate_prog(prog_inps_and_max_steps):
+  prog, inps, max_steps = prog_inps_and_max_steps
+  return program_utils.evaluate_batch(prog, [[inp] for inp in inps],
+                                      max_steps=max_steps)
+
+
+def start_prog_eval_pool():
+  """Start the pool for evaluate_progs, if one is used and not started yet.
+
+  Call it before creating sessions, so that the workers are forked before
+  TensorFlow starts its threads.
+  """
+  global _prog_eval_pool
+  if _prog_eval_pool is None and FLAGS.prog_eval_processes > 0:
+    _prog_eval_pool = multiprocessing.Pool(FLAGS.prog_eval_processes)
+  return _prog_eval_pool
+
+
+def evaluate_progs(progs_and_inps):
+  """Evaluate (program, input list) pairs, in parallel if configured."""
+  # Each program is compiled once for the run of pairs it starts.
+  max_steps = FLAGS.prog_eval_max_steps or None
+  groups = []
+  for prog, inp in progs_and_inps:
+    if groups and groups[-1][0] == prog:
+      groups[-1][1].append(inp)
+    else:
+      groups.append((prog, [inp], max_steps))
+  pool = start_prog_eval_pool()
+  if pool is None:
+    outs = [_evaluate_prog(g) for g in groups]
   else:
-    history_s = [str(h) for h in history]
-    best, best_score, tgt, eos_id = None, -1000.0, target, None
-    if p == "wmt":
-      eos_id = wmt.EOS_ID
-    if eos_id and eos_id in target:
-      tgt = target[:target.index(eos_id)]
-    for beam in beams:
-      if eos_id and eos_id in beam:
-        beam = beam[:beam.index(eos_id)]
-      l = min(len(tgt), len(beam))
-      score = len([i for i in xrange(l) if tgt[i] == beam[i]]) / float(len(tgt))
-      hist_score = 20.0 if str([b for b in beam if b > 0]) in history_s else 0.0
-      if score < 1.0:
-        score -= hist_score
-      if score > best_score:
-        best = beam
-        best_score = score
-    return best, best_score
-
-
-def score_beams_prog(beams, target, inp, history, print_out=False,
-                     test_mode=False):
-  """Score beams for program synthesis."""
+    chunksize = max(1, len(groups) // (4 * FLAGS.prog_eval_processes))
+    outs = pool.map(_evaluate_prog, groups, chunksize=chunksize)
+  return [out for group_outs in outs for out in group_outs]
+
+
+def _compact_positive(rows):
+  """Move the positive entries of rows to the front, in order, and zero rest.
+
+  Args:
+    rows: [..., length] array.
+
+  Returns:
+    A pair of the compacted array, so that compacted[i, :counts[i]] is
+    [t for t in rows[i] if t > 0] and the rest is 0, and of the counts.
+  """
+  positive = rows > 0
+  order = np.argsort(~positive, axis=-1, kind="mergesort")
+  flat_rows = rows.reshape(-1, rows.shape[-1])
+  compacted = flat_rows[np.arange(flat_rows.shape[0])[:, None],
+                        order.reshape(flat_rows.shape)].reshape(rows.shape)
+  counts = positive.sum(axis=-1)
+  compacted[np.arange(rows.shape[-1]) >= counts[..., None]] = 0
+  return compacted, counts
+
+
+def _first_index(mask, default):
+  """Index of the first True along the last axis, or default if none."""
+  return np.where(mask.any(axis=-1), np.argmax(mask, axis=-1), default)
+
+
+def _pad_to(rows, length):
+  """Cut or zero-pad the last axis of rows to length."""
+  res = np.zeros(rows.shape[:-1] + (length,), dtype=rows.dtype)
+  res[..., :min(length, rows.shape[-1])] = rows[..., :length]
+  return res
+
+
+def score_beams_batch(beams, target, history, p, test_mode=False):
+  """Score beams for every batch element at once, for all but progsynth.
+
+  A beam scores the fraction of target positions it matches, minus 20 if it
+  is not perfect and equals an earlier input. For wmt, beams and targets are
+  cut at EOS first. In test mode, the first beam is taken and scores 10 if
+  it starts with the target, 0 otherwise.
+
+  Args:
+    beams: [batch_size, beam_size, length] array of beams.
+    target: [batch_size, target length] array of targets, padded with zeros.
+    history: list of [batch_size, history length] arrays of earlier inputs,
+      padded with zeros.
+    p: the problem.
+    test_mode: whether scoring for test.
+
+  Returns:
+    A pair of the [batch_size, length] array of the best beams, cut at EOS
+    and zero-padded, and the [batch_size] array of their scores.
+  """
+  batch_size, beam_size, length = beams.shape
+  tgt, tgt_len = _compact_positive(target)
+  width = min(length, tgt.shape[1])
+  positions = np.arange(width)
+  if test_mode:
+    first = beams[:, 0]
+    same = np.all((first[:, :width] == tgt[:, :width]) |
+                  (positions >= tgt_len[:, None]), axis=1)
+    return first, np.where(same & (tgt_len <= length), 10.0, 0.0)
+
+  beam_len = np.full((batch_size, beam_size), length, dtype=np.int64)
+  if p == "wmt":
+    tgt_len = _first_index(tgt == wmt.EOS_ID, tgt_len)
+    beam_len = _first_index(beams == wmt.EOS_ID, beam_len)
+  cut_beams = np.where(np.arange(length) < beam_len[..., None], beams, 0)
+
+  common_len = np.minimum(tgt_len[:, None], beam_len)
+  matches = np.sum((beams[..., :width] == tgt[:, None, :width]) &
+                   (positions < common_len[..., None]), axis=2)
+  scores = matches / tgt_len[:, None].astype(np.float64)
+
+  # Beams equal to an earlier input once zeros are dropped are penalized.
+  history_len = max([length] + [h.shape[1] for h in history])
+  beam_set, _ = _compact_positive(_pad_to(cut_beams, history_len))
+  in_history = np.zeros((batch_size, beam_size), dtype=bool)
+  for h in history:
+    h_set, _ = _compact_positive(_pad_to(h, history_len))
+    in_history |= np.all(beam_set == h_set[:, None], axis=2)
+  scores = np.where((scores < 1.0) & in_history, scores - 20.0, scores)
+
+  best = np.argmax(scores, axis=1)
+  rows = np.arange(batch_size)
+  return cut_beams[rows, best], scores[rows, best]
+
+
+def prog_beam_evals(beams, target, inp, print_out=False, test_mode=False):
+  """The program evaluations needed to score beams for program synthesis.
+
+  Returns:
+    A pair of the list of (program, input list) pairs to evaluate, and of
+    the other values that score_prog_beams needs with their results.
+  """
   tgt_prog = linearize(target, program_utils.prog_vocab, True, 1)
-  hist_progs = [linearize(h, program_utils.prog_vocab, True, 1)
-                for h in history]
-  tgt_set = set(target)
   if print_out:
     print "target: ", tgt_prog
   inps, tgt_outs = [], []
@@ -576,14 +689,41 @@ def score_beams_prog(beams, target, inp, history, print_out=False,
     for _ in xrange(7):
       ilen = np.random.randint(len(target) - 3) + 1
       inps.append([random.choice(range(-15, 15)) for _ in range(ilen)])
-    tgt_outs.extend([program_utils.evaluate(tgt_prog, {"a": inp})
-                     for inp in inps[3:]])
+  b_progs = [linearize(beam, program_utils.prog_vocab, True, 1)
+             for beam in beams]
+  # The target program on the random inputs, then each beam on all inputs.
+  evals = ([(tgt_prog, inp) for inp in inps[3:]] +
+           [(b_prog, inp) for b_prog in b_progs for inp in inps])
+  return evals, (tgt_outs, len(inps), b_progs)
+
+
+def score_prog_beams(beams, target, history, eval_info, outs,
+                     print_out=False, test_mode=False):
+  """Score beams for program synthesis given the outputs of their programs.
+
+  Args:
+    beams: the beams.
+    target: the target program tokens.
+    history: the earlier inputs.
+    eval_info: the values that prog_beam_evals returned with its evaluations.
+    outs: the results of those evaluations.
+    print_out: whether to print the best program.
+    test_mode: whether scoring for test.
+
+  Returns:
+    A pair of the best beam and its score.
+  """
+  tgt_outs, num_inps, b_progs = eval_info
+  tgt_outs = tgt_outs + outs[:num_inps - 3]
+  outs = outs[num_inps - 3:]
+  hist_progs = [linearize(h, program_utils.prog_vocab, True, 1)
+                for h in history]
+  tgt_set = set(target)
   best, best_prog, best_score = None, "", -1000.0
-  for beam in beams:
-    b_prog = linearize(beam, program_utils.prog_vocab, True, 1)
+  for beam_idx, (beam, b_prog) in enumerate(zip(beams, b_progs)):
     b_set = set(beam)
     jsim = len(tgt_set & b_set) / float(len(tgt_set | b_set))
-    b_outs = [program_utils.evaluate(b_prog, {"a": inp}) for inp in inps]
+    b_outs = outs[beam_idx * num_inps:(beam_idx + 1) * num_inps]
     errs = len([x for x in b_outs if x == "ERROR"])
     imatches = len([i for i in xrange(3) if b_outs[i] == tgt_outs[i]])
     perfect = 10.0 if imatches == 3 else 0.0
@@ -611,43 +751,70 @@ def get_best_beam(beam_model, sess, inp, target, batch_size, beam_size,
   """Run beam_model, score beams, and return the best as target and in input."""
   _, output_logits, _, _ = beam_model.step(
       sess, inp, target, None, beam_size=FLAGS.beam_size)
-  new_targets, new_firsts, scores, new_inp = [], [], [], np.copy(inp)
-  for b in xrange(batch_size):
-    outputs = []
-    history_b = [[h[b, 0, l] for l in xrange(data.bins[bucket])]
-                 for h in history]
-    for beam_idx in xrange(beam_size):
-      outputs.append([int(o[beam_idx * batch_size + b])
-                      for o in output_logits])
-    target_t = [target[b, 0, l] for l in xrange(data.bins[bucket])]
-    best, best_score = score_beams(
-        outputs, [t for t in target_t if t > 0], inp[b, :, :],
-        [[t for t in h if t > 0] for h in history_b], p, test_mode=test_mode)
-    scores.append(best_score)
-    if 1 in best:  # Only until _EOS.
-      best = best[:best.index(1) + 1]
-    best += [0 for _ in xrange(len(target_t) - len(best))]
-    new_targets.append([best])
-    first, _ = score_beams(
-        outputs, [t for t in target_t if t > 0], inp[b, :, :],
-        [[t for t in h if t > 0] for h in history_b], p, test_mode=True)
-    if 1 in first:  # Only until _EOS.
-      first = first[:first.index(1) + 1]
-    first += [0 for _ in xrange(len(target_t) - len(first))]
-    new_inp[b, 0, :] = np.array(first, dtype=np.int32)
-    new_firsts.append([first])
+  length = data.bins[bucket]
+  # outputs[b, beam_idx] is the output of beam beam_idx for batch element b.
+  outputs = np.array([o[:beam_size * batch_size] for o in output_logits])
+  outputs = outputs.astype(np.int64).reshape(-1, beam_size, batch_size)
+  outputs = outputs.transpose(2, 1, 0)
+  target_t = target[:, 0, :length]
+  history_t = [h[:, 0, :length] for h in history]
+  if p == "progsynth":
+    # Evaluate the programs of the whole batch in one go.
+    beams, tgts, histories, evals, eval_infos = [], [], [], [], []
+    for b in xrange(batch_size):
+      beams.append(outputs[b].tolist())
+      tgts.append([t for t in target_t[b] if t > 0])
+      histories.append([[t for t in h[b] if t > 0] for h in history_t])
+      evals_b, eval_info = prog_beam_evals(beams[b], tgts[b], inp[b, :, :],
+                                           test_mode=test_mode)
+      evals.append(evals_b)
+      eval_infos.append(eval_info)
+    outs = evaluate_progs([e for evals_b in evals for e in evals_b])
+    best, first, scores, start = [], [], [], 0
+    for b in xrange(batch_size):
+      outs_b = outs[start:start + len(evals[b])]
+      start += len(evals[b])
+      best_b, score_b = score_prog_beams(beams[b], tgts[b], histories[b],
+                                         eval_infos[b], outs_b,
+                                         test_mode=test_mode)
+      # In test mode only the outputs on the 3 given inputs count.
+      tgt_outs, num_inps, b_progs = eval_infos[b]
+      beam_outs = outs_b[num_inps - 3:]
+      test_outs = [o for i in xrange(len(beams[b]))
+                   for o in beam_outs[i * num_inps:i * num_inps + 3]]
+      first_b, _ = score_prog_beams(beams[b], tgts[b], histories[b],
+                                    (tgt_outs[:3], 3, b_progs), test_outs,
+                                    test_mode=True)
+      best.append(_pad_to(np.array(best_b, dtype=np.int64), length))
+      first.append(_pad_to(np.array(first_b, dtype=np.int64), length))
+      scores.append(score_b)
+    best, first = np.array(best), np.array(first)
+  else:
+    best, scores = score_beams_batch(outputs, target_t, history_t, p,
+                                     test_mode=test_mode)
+    first, _ = score_beams_batch(outputs, target_t, history_t, p,
+                                 test_mode=True)
+    best, first = _pad_to(best, length), _pad_to(first, length)
+    scores = scores.tolist()
+  # Only until _EOS.
+  positions = np.arange(length)
+  best[positions > _first_index(best == 1, length)[:, None]] = 0
+  first[positions > _first_index(first == 1, length)[:, None]] = 0
+  new_target = best[:, None, :].astype(np.int32)
+  new_first = first[:, None, :].astype(np.int32)
+  new_inp = np.copy(inp)
+  new_inp[:, 0, :] = new_first[:, 0, :]
   # Change target if we found a great answer.
-  new_target = np.array(new_targets, dtype=np.int32)
-  for b in xrange(batch_size):
-    if scores[b] >= 10.0:
-      target[b, 0, :] = new_target[b, 0, :]
-  new_first = np.array(new_firsts, dtype=np.int32)
+  great = np.array(scores) >= 10.0
+  target[great, 0, :] = new_target[great, 0, :]
   return new_target, new_first, new_inp, scores
 
 
 def train():
   """Train the model."""
   batch_size = FLAGS.batch_size * FLAGS.num_gpus
+  if "progsynth" in FLAGS.problem.split("-"):
+    start_prog_eval_pool()
   (model, beam_model, min_length, max_length, checkpoint_dir,
    (train_set, dev_set, en_vocab_path, fr_vocab_path), sv, sess) = initialize()
   with sess.as_default():
@@ -700,7 +867,7 @@ def train():
         # Run a step and time it.
         start_time = time.time()
         inp, target = data.get_batch(bucket_id, batch_size, train_set,
-                                     FLAGS.height)
+                                     FLAGS.height, reuse_buffers=True)
         noise_param = math.sqrt(math.pow(global_step + 1, -0.55) *
                                 prev_seq_err) * FLAGS.grad_noise_scale
         # In multi-step mode, we use best from beam for middle steps.
@@ -837,6 +1004,8 @@ def linearize(output, rev_fr_vocab, simple_tokenizer=None, eos_id=wmt.EOS_ID):
 def evaluate():
   """Evaluate an existing model."""
   batch_size = FLAGS.batch_size * FLAGS.num_gpus
+  if "progsynth" in FLAGS.problem.split("-"):
+    start_prog_eval_pool()
   with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
     (model, beam_model, _, _, _,
      (_, dev_set, en_vocab_path, fr_vocab_path), _, sess) = initialize(sess)
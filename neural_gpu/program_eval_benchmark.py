@@ -0,0 +1,64 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Compare evaluations/sec of program_utils.evaluate and evaluate_batch.
+
+Programs are generated as for progsynth, each is run on the same random
+inputs by both evaluators, and their results are checked to be equal.
+
+  python program_eval_benchmark.py [num_programs] [inputs_per_program]
+"""
+
+import random
+import sys
+import time
+
+import program_utils
+
+
+def main(argv):
+  num_programs = int(argv[1]) if len(argv) > 1 else 500
+  inputs_per_program = int(argv[2]) if len(argv) > 2 else 10
+  random.seed(125459)
+  program_utils.make_vocab()
+  progs = program_utils.gen(4, num_programs)
+  inps = [[[random.choice(range(-15, 15))
+            for _ in xrange(random.randint(1, 12))]]
+          for _ in xrange(inputs_per_program)]
+  num_evals = len(progs) * len(inps)
+
+  start = time.time()
+  exec_outs = [[program_utils.evaluate(p, {"a": inp[0]}) for inp in inps]
+               for p in progs]
+  exec_time = time.time() - start
+
+  start = time.time()
+  batch_outs = [program_utils.evaluate_batch(p, inps) for p in progs]
+  batch_time = time.time() - start
+
+  start = time.time()
+  for p in progs:
+    program_utils.evaluate_batch(p, inps)
+  cached_time = time.time() - start
+
+  if exec_outs != batch_outs:
+    raise ValueError("evaluate and evaluate_batch results differ.")
+  print "%d programs on %d inputs each" % (len(progs), len(inps))
+  print "evaluate (exec):        %10.0f evals/sec" % (num_evals / exec_time)
+  print "evaluate_batch:         %10.0f evals/sec" % (num_evals / batch_time)
+  print "evaluate_batch, cached: %10.0f evals/sec" % (num_evals / cached_time)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
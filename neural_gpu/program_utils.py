@@ -14,7 +14,10 @@
 # ==============================================================================
 """Utilities for generating program synthesis and evaluation data."""
 
+import __builtin__
+import ast
 import contextlib
+import operator
 import sys
 import StringIO
 import random
@@ -184,6 +187,246 @@ def evaluate(program_str, input_names_to_vals, default="ERROR"):
    # pylint: enable=bare-except
 
 
+# Names that the exec in evaluate sees as its own locals. Programs that use
+# them are left to evaluate, as their results depend on its internals.
+_EVALUATE_LOCALS = frozenset(["program_str", "input_names_to_vals", "default",
+                              "exec_str", "name", "val", "s"])
+_BINARY_OPS = {ast.Add: operator.add, ast.Sub: operator.sub,
+               ast.Mult: operator.mul}
+_UNARY_OPS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+_MAX_COMPILED_PROGRAMS = 100000
+_compiled_programs = {}
+
+
+class StepLimitExceeded(Exception):
+  pass
+
+
+class _Unsupported(Exception):
+  pass
+
+
+class _ProgramCompiler(object):
+  """Compile the statements of a program to closures over a list of slots.
+
+  Slot 0 holds the steps left, the other slots hold the program variables.
+  Straight-line code lets each name load be resolved here, to a slot if the
+  name was assigned before, and else to the global or builtin exec would find.
+  """
+
+  def __init__(self, input_names):
+    self.slots = {}
+    self.bound = set()
+    for name in input_names:
+      if name in _EVALUATE_LOCALS:
+        raise _Unsupported(name)
+      self._bind(name)
+
+  def _bind(self, name):
+    if name not in self.slots:
+      self.slots[name] = len(self.slots) + 1
+    self.bound.add(name)
+    return self.slots[name]
+
+  def statement(self, node):
+    """Compile an Assign or Expr statement."""
+    if isinstance(node, ast.Expr):
+      return self.expr(node.value)
+    if not isinstance(node, ast.Assign):
+      raise _Unsupported(node)
+    value_fn = self.expr(node.value)
+    store_fns = [self.store(t) for t in node.targets]
+    def assign(env):
+      value = value_fn(env)
+      for store_fn in store_fns:
+        store_fn(env, value)
+    return assign
+
+  def store(self, node):
+    """Compile an assignment target to a function of (env, value)."""
+    if isinstance(node, ast.Name):
+      if node.id in _EVALUATE_LOCALS:
+        raise _Unsupported(node.id)
+      slot = self._bind(node.id)
+      def store_name(env, value):
+        env[slot] = value
+      return store_name
+    if isinstance(node, (ast.Tuple, ast.List)):
+      store_fns = [self.store(e) for e in node.elts]
+      def store_unpacked(env, value):
+        values = list(value)
+        if len(values) != len(store_fns):
+          raise ValueError("wrong number of values to unpack")
+        for store_fn, v in zip(store_fns, values):
+          store_fn(env, v)
+      return store_unpacked
+    if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Index):
+      obj_fn = self.expr(node.value)
+      index_fn = self.expr(node.slice.value)
+      def store_item(env, value):
+        obj = obj_fn(env)
+        obj[index_fn(env)] = value
+      return store_item
+    raise _Unsupported(node)
+
+  def expr(self, node):
+    """Compile an expression to a function of env."""
+    if isinstance(node, ast.Num):
+      n = node.n
+      return lambda env: n
+    if isinstance(node, ast.Name):
+      return self.load(node.id)
+    if isinstance(node, ast.List):
+      elt_fns = [self.expr(e) for e in node.elts]
+      return lambda env: [f(env) for f in elt_fns]
+    if isinstance(node, ast.Tuple):
+      elt_fns = [self.expr(e) for e in node.elts]
+      return lambda env: tuple([f(env) for f in elt_fns])
+    if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Index):
+      obj_fn = self.expr(node.value)
+      index_fn = self.expr(node.slice.value)
+      return lambda env: obj_fn(env)[index_fn(env)]
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+      op = _BINARY_OPS[type(node.op)]
+      left_fn, right_fn = self.expr(node.left), self.expr(node.right)
+      return lambda env: op(left_fn(env), right_fn(env))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+      op = _UNARY_OPS[type(node.op)]
+      operand_fn = self.expr(node.operand)
+      return lambda env: op(operand_fn(env))
+    if (isinstance(node, ast.Call) and node.starargs is None and
+        node.kwargs is None):
+      return self.call(node)
+    raise _Unsupported(node)
+
+  def call(self, node):
+    """Compile a call, charging 1 step plus the length of its list args."""
+    fn_fn = self.expr(node.func)
+    arg_fns = [self.expr(a) for a in node.args]
+    kw_fns = [(k.arg, self.expr(k.value)) for k in node.keywords]
+    def call(env):
+      fn = fn_fn(env)
+      args = [f(env) for f in arg_fns]
+      kwargs = dict([(k, f(env)) for k, f in kw_fns]) if kw_fns else {}
+      steps = 1
+      for a in args:
+        if type(a) is list:
+          steps += len(a)
+      env[0] -= steps
+      if env[0] < 0:
+        raise StepLimitExceeded()
+      return fn(*args, **kwargs)
+    return call
+
+  def load(self, name):
+    if name in self.bound:
+      slot = self.slots[name]
+      return lambda env: env[slot]
+    if name in _EVALUATE_LOCALS:
+      raise _Unsupported(name)
+    if name in globals():
+      value = globals()[name]
+    elif hasattr(__builtin__, name):
+      value = getattr(__builtin__, name)
+    else:
+      def undefined(env):
+        raise NameError("name '%s' is not defined" % name)
+      return undefined
+    return lambda env: value
+
+
+def compile_program(program_str, input_names=("a",)):
+  """Compile a program to a function of its input values, or return None.
+
+  The program is parsed as evaluate would exec it, once, and the returned
+  function runs it on a list of input values, in input_names order, without
+  exec or printing. It returns what evaluate returns on success and raises
+  when evaluate would return its default.
+
+  Args:
+    program_str: the program, as passed to evaluate.
+    input_names: the names of the program inputs.
+
+  Returns:
+    A function of (input values, max_steps), where max_steps bounds the
+    number of calls plus the lengths of their list arguments and None means
+    no bound. None if the program uses more Python than the program
+    vocabulary can express, and so needs to be run by evaluate.
+  """
+  # Parse the same text as evaluate, with the inputs assigned in front.
+  inputs_str = "".join([name + " = 0; " for name in input_names])
+  try:
+    body = ast.parse(inputs_str + program_str + " print(out)").body
+  except Exception:  # pylint: disable=broad-except
+    def syntax_error(unused_values, unused_max_steps=None):
+      raise SyntaxError(program_str)
+    return syntax_error
+  body = body[len(input_names):]
+  printed = body[-1]
+  if (not isinstance(printed, ast.Print) or printed.dest is not None or
+      not printed.nl or len(printed.values) != 1):
+    return None
+  try:
+    compiler = _ProgramCompiler(input_names)
+    stmt_fns = [compiler.statement(stmt) for stmt in body[:-1]]
+    out_fn = compiler.expr(printed.values[0])
+  except (_Unsupported, RuntimeError):
+    return None
+  input_slots = [compiler.slots[name] for name in input_names]
+  num_slots = len(compiler.slots) + 1
+
+  def run(values, max_steps=None):
+    env = [float("inf") if max_steps is None else max_steps] * num_slots
+    for slot, value in zip(input_slots, values):
+      # evaluate execs a fresh copy of each input, which programs may change.
+      env[slot] = list(value) if isinstance(value, list) else value
+    for stmt_fn in stmt_fns:
+      stmt_fn(env)
+    return str(out_fn(env))
+  return run
+
+
+def _is_int_or_int_list(value):
+  if isinstance(value, list):
+    return all([type(v) in (int, long) for v in value])
+  return type(value) in (int, long)
+
+
+def evaluate_batch(program_str, inputs, input_names=("a",), default="ERROR",
+                   max_steps=None):
+  """Evaluate a program on many inputs, as evaluate does but compiled once.
+
+  Args:
+    program_str: the program, as passed to evaluate.
+    inputs: a list of lists of input values, in input_names order.
+    input_names: the names of the program inputs.
+    default: the result for inputs the program fails on.
+    max_steps: the step budget of each run, see compile_program; a run
+      that exceeds it returns default. None for no limit.
+
+  Returns:
+    The list of results, one per list of input values.
+  """
+  key = (program_str, tuple(input_names))
+  run = _compiled_programs.get(key)
+  if run is None and key not in _compiled_programs:
+    if len(_compiled_programs) >= _MAX_COMPILED_PROGRAMS:
+      _compiled_programs.clear()
+    run = _compiled_programs[key] = compile_program(program_str, input_names)
+  results = []
+  for values in inputs:
+    # Inputs that do not print back to themselves are left to evaluate.
+    if run is None or not all([_is_int_or_int_list(v) for v in values]):
+      results.append(evaluate(program_str, dict(zip(input_names, values)),
+                              default))
+      continue
+    try:
+      results.append(run(values, max_steps))
+    except Exception:  # pylint: disable=broad-except
+      results.append(default)
+  return results
+
+
 class Statement(object):
   """Statement class."""
   
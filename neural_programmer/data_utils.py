@@ -16,7 +16,9 @@
 """
 
 import copy
+import hashlib
 import numbers
+import os
 import numpy as np
 import wiki_data
 
@@ -116,84 +118,118 @@ def convert_to_bool_and_pad(a, utility):
 
 
 seen_tables = {}
+table_features = {}
 
 
-def partial_match(question, table, number):
-  answer = []
+class MatchIndex(object):
+  #inverted index from the cells of a table to their positions. A table is a
+  #list of columns of cells, whose positions are (column, row) pairs, or with
+  #names=True a list of column names, whose positions are column indices.
+  #Cells are numbers when number is True, and lists of words otherwise
+
+  def __init__(self, table, number, names=False):
+    if (names):
+      cells = list(enumerate(table))
+    else:
+      cells = [((i, j), cell)
+               for i, column in enumerate(table)
+               for j, cell in enumerate(column)]
+    self.number = number
+    #cell, as a tuple of words unless number -> positions
+    self.positions = {}
+    #word -> positions of the cells that contain it, unless number
+    self.word_positions = {}
+    for position, cell in cells:
+      if (number):
+        self.positions.setdefault(cell, []).append(position)
+      else:
+        self.positions.setdefault(tuple(cell), []).append(position)
+        for word in set(cell):
+          self.word_positions.setdefault(word, []).append(position)
+    self.lengths = []
+    if (not (number)):
+      self.lengths = sorted(set([len(cell) for cell in self.positions]))
+
+  def equal_positions(self, question):
+    #positions of the cells equal to a question word
+    return [
+        position
+        for word in set(question) for position in self.positions.get(word, [])
+    ]
+
+  def contain_positions(self, question):
+    #positions of the cells that contain a question word
+    return [
+        position
+        for word in set(question)
+        for position in self.word_positions.get(word, [])
+    ]
+
+  def ngram_matches(self, question):
+    #(position, start, length) of the cells equal to a span of the question,
+    #sorted as the spans were found by scanning the cells in order
+    matches = []
+    for length in self.lengths:
+      for k in range(min(len(question), len(question) - length + 1)):
+        for position in self.positions.get(tuple(question[k:(k + length)]),
+                                           []):
+          matches.append((position, k, length))
+    matches.sort()
+    return matches
+
+
+def partial_match(question, table, number, index=None):
+  if (index is None):
+    index = MatchIndex(table, number)
+  answer = [[0] * len(column) for column in table]
   match = {}
-  for i in range(len(table)):
-    temp = []
-    for j in range(len(table[i])):
-      temp.append(0)
-    answer.append(temp)
-  for i in range(len(table)):
-    for j in range(len(table[i])):
-      for word in question:
-        if (number):
-          if (word == table[i][j]):
-            answer[i][j] = 1.0
-            match[i] = 1.0
-        else:
-          if (word in table[i][j]):
-            answer[i][j] = 1.0
-            match[i] = 1.0
+  if (number):
+    positions = index.equal_positions(question)
+  else:
+    positions = index.contain_positions(question)
+  for (i, j) in positions:
+    answer[i][j] = 1.0
+    match[i] = 1.0
   return answer, match
 
 
-def exact_match(question, table, number):
+def exact_match(question, table, number, index=None):
   #performs exact match operation
-  answer = []
+  if (index is None):
+    index = MatchIndex(table, number)
+  answer = [[0] * len(column) for column in table]
   match = {}
   matched_indices = []
-  for i in range(len(table)):
-    temp = []
-    for j in range(len(table[i])):
-      temp.append(0)
-    answer.append(temp)
-  for i in range(len(table)):
-    for j in range(len(table[i])):
-      if (number):
-        for word in question:
-          if (word == table[i][j]):
-            match[i] = 1.0
-            answer[i][j] = 1.0
-      else:
-        table_entry = table[i][j]
-        for k in range(len(question)):
-          if (k + len(table_entry) <= len(question)):
-            if (table_entry == question[k:(k + len(table_entry))]):
-              #if(len(table_entry) == 1):
-              #print "match: ", table_entry, question
-              match[i] = 1.0
-              answer[i][j] = 1.0
-              matched_indices.append((k, len(table_entry)))
+  if (number):
+    for (i, j) in index.equal_positions(question):
+      match[i] = 1.0
+      answer[i][j] = 1.0
+  else:
+    for ((i, j), k, length) in index.ngram_matches(question):
+      match[i] = 1.0
+      answer[i][j] = 1.0
+      matched_indices.append((k, length))
   return answer, match, matched_indices
 
 
-def partial_column_match(question, table, number):
-  answer = []
-  for i in range(len(table)):
-    answer.append(0)
-  for i in range(len(table)):
-    for word in question:
-      if (word in table[i]):
-        answer[i] = 1.0
+def partial_column_match(question, table, number, index=None):
+  if (index is None):
+    index = MatchIndex(table, False, names=True)
+  answer = [0] * len(table)
+  for i in index.contain_positions(question):
+    answer[i] = 1.0
   return answer
 
 
-def exact_column_match(question, table, number):
+def exact_column_match(question, table, number, index=None):
   #performs exact match on column names
-  answer = []
+  if (index is None):
+    index = MatchIndex(table, False, names=True)
+  answer = [0] * len(table)
   matched_indices = []
-  for i in range(len(table)):
-    answer.append(0)
-  for i in range(len(table)):
-    table_entry = table[i]
-    for k in range(len(question)):
-      if (k + len(table_entry) <= len(question)):
-        if (table_entry == question[k:(k + len(table_entry))]):
-          answer[i] = 1.0
-          matched_indices.append((k, len(table_entry)))
+  for (i, k, length) in index.ngram_matches(question):
+    answer[i] = 1.0
+    matched_indices.append((k, length))
   return answer, matched_indices
 
 
@@ -260,6 +296,25 @@ def check_processed_cols(col, utility):
   ]
 
 
+class TableFeatures(object):
+  #match indices and group by max features of a table, which all examples on
+  #the table share
+
+  def __init__(self, example):
+    self.word_index = MatchIndex(example.original_wc, False)
+    self.number_index = MatchIndex(example.original_nc, True)
+    self.word_name_index = MatchIndex(example.original_wc_names, False, True)
+    self.number_name_index = MatchIndex(example.original_nc_names, False, True)
+    self.word_group_by_max = group_by_max(example.original_wc, False)
+    self.number_group_by_max = group_by_max(example.original_nc, True)
+
+
+def get_table_features(example):
+  if (not (table_features.has_key(example.table_key))):
+    table_features[example.table_key] = TableFeatures(example)
+  return table_features[example.table_key]
+
+
 def complete_wiki_processing(data, utility, train=True):
   #convert to integers and padding
   processed_data = []
@@ -273,30 +328,42 @@ def complete_wiki_processing(data, utility, train=True):
       #entry match
       example.processed_number_columns = example.processed_number_columns[:]
       example.processed_word_columns = example.processed_word_columns[:]
+      features = get_table_features(example)
       example.word_exact_match, word_match, matched_indices = exact_match(
-          example.string_question, example.original_wc, number=False)
+          example.string_question, example.original_wc, number=False,
+          index=features.word_index)
       example.number_exact_match, number_match, _ = exact_match(
-          example.string_question, example.original_nc, number=True)
+          example.string_question, example.original_nc, number=True,
+          index=features.number_index)
       if (not (pick_one(example.word_exact_match)) and not (
           pick_one(example.number_exact_match))):
         assert len(word_match) == 0
         assert len(number_match) == 0
         example.word_exact_match, word_match = partial_match(
-            example.string_question, example.original_wc, number=False)
+            example.string_question, example.original_wc, number=False,
+            index=features.word_index)
       #group by max
-      example.word_group_by_max = group_by_max(example.original_wc, False)
-      example.number_group_by_max = group_by_max(example.original_nc, True)
+      example.word_group_by_max = [
+          row[:] for row in features.word_group_by_max
+      ]
+      example.number_group_by_max = [
+          row[:] for row in features.number_group_by_max
+      ]
       #column name match
       example.word_column_exact_match, wcol_matched_indices = exact_column_match(
-          example.string_question, example.original_wc_names, number=False)
+          example.string_question, example.original_wc_names, number=False,
+          index=features.word_name_index)
       example.number_column_exact_match, ncol_matched_indices = exact_column_match(
-          example.string_question, example.original_nc_names, number=False)
+          example.string_question, example.original_nc_names, number=False,
+          index=features.number_name_index)
       if (not (1.0 in example.word_column_exact_match) and not (
           1.0 in example.number_column_exact_match)):
         example.word_column_exact_match = partial_column_match(
-            example.string_question, example.original_wc_names, number=False)
+            example.string_question, example.original_wc_names, number=False,
+            index=features.word_name_index)
         example.number_column_exact_match = partial_column_match(
-            example.string_question, example.original_nc_names, number=False)
+            example.string_question, example.original_nc_names, number=False,
+            index=features.number_name_index)
       if (len(word_match) > 0 or len(number_match) > 0):
         example.question.append(utility.entry_match_token)
       if (1.0 in example.word_column_exact_match or
@@ -662,3 +729,112 @@ def generate_feed_dict(data, curr, batch_size, gr, train=False, utility=None):
       feed_examples[j].word_column_entry_mask for j in range(batch_size)
   ]
   return feed_dict
+
+
+#fields of processed examples that generate_feed_dict reads, with the type
+#of the placeholder they are fed to
+feed_fields = [("question", np.int32), ("question_attention_mask", np.float64),
+               ("answer", np.float64), ("columns", np.float64),
+               ("processed_number_columns", np.float64),
+               ("sorted_number_index", np.int32),
+               ("sorted_word_index", np.int32),
+               ("question_number", np.float64),
+               ("question_number_1", np.float64),
+               ("question_number_mask", np.float64),
+               ("question_number_one_mask", np.float64),
+               ("print_answer", np.float64), ("exact_match", np.float64),
+               ("group_by_max", np.float64),
+               ("exact_column_match", np.float64),
+               ("ordinal_question", np.float64),
+               ("ordinal_question_one", np.float64),
+               ("column_mask", np.float64), ("column_ids", np.int32),
+               ("processed_word_columns", np.float64),
+               ("word_column_mask", np.float64), ("word_column_ids", np.int32),
+               ("word_column_entry_mask", np.int32)]
+
+
+class ProcessedExample(object):
+  #an example loaded by load_processed_data, with the feed_fields only
+
+  def __init__(self, fields):
+    for name, value in fields:
+      setattr(self, name, value)
+
+
+def data_file_stats(data_dir, data_names):
+  #(path, size, mtime) of every file that wiki_data reads for data_names,
+  #with None for a missing file
+  paths = [os.path.join(data_dir, "data", name) for name in data_names]
+  paths.append(os.path.join(data_dir, "arvind-with-norms-2.tsv"))
+  #annotated/ holds the annotated examples and all the tables
+  for root, dirs, files in os.walk(os.path.join(data_dir, "annotated")):
+    dirs.sort()
+    paths.extend(os.path.join(root, name) for name in sorted(files))
+  stats = []
+  for path in paths:
+    if (os.path.exists(path)):
+      stat = os.stat(path)
+      stats.append((path, stat.st_size, stat.st_mtime))
+    else:
+      stats.append((path, None))
+  return stats
+
+
+def processed_data_file(cache_dir, data_names, utility):
+  #the cache file for the processed data of data_names with the current flags
+  #and data files
+  FLAGS = utility.FLAGS
+  data_dir = os.path.abspath(FLAGS.data_dir)
+  key = (data_dir, data_names, data_file_stats(data_dir, data_names),
+         FLAGS.max_elements, FLAGS.max_number_cols, FLAGS.max_word_cols,
+         FLAGS.question_length, FLAGS.max_entry_length, FLAGS.pad_int,
+         FLAGS.bad_number_pre_process, FLAGS.word_cutoff)
+  return os.path.join(cache_dir,
+                      "processed_%s.npz" % hashlib.md5(repr(key)).hexdigest())
+
+
+def save_processed_data(filename, data_sets, utility):
+  #packs the feed_fields of each data set, and the vocabulary, into arrays
+  arrays = {}
+  for d, data in enumerate(data_sets):
+    arrays["num_examples_%d" % d] = len(data)
+    for name, dtype in feed_fields:
+      arrays["%s_%d" % (name, d)] = np.array(
+          [getattr(example, name) for example in data], dtype=dtype)
+  arrays["words"] = np.array([
+      w.encode("utf-8") if isinstance(w, unicode) else w for w in utility.words
+  ])
+  arrays["unicode_words"] = np.array(
+      [isinstance(w, unicode) for w in utility.words], dtype=bool)
+  arrays["word_ids"] = np.array(
+      [utility.word_ids[w] for w in utility.words], dtype=np.int64)
+  cache_dir = os.path.dirname(filename)
+  if (cache_dir and not (os.path.isdir(cache_dir))):
+    os.makedirs(cache_dir)
+  tmp_file = "%s.tmp%d.npz" % (filename[:-len(".npz")], os.getpid())
+  np.savez(tmp_file, num_data_sets=len(data_sets), **arrays)
+  os.rename(tmp_file, filename)
+
+
+def load_processed_data(filename, utility):
+  #returns the data sets saved by save_processed_data and restores the
+  #vocabulary of utility
+  cache = np.load(filename)
+  utility.words = [
+      w.decode("utf-8") if is_unicode else str(w)
+      for w, is_unicode in zip(cache["words"], cache["unicode_words"])
+  ]
+  utility.word_ids = dict(zip(utility.words, cache["word_ids"].tolist()))
+  utility.reverse_word_ids = dict(
+      [(i, w) for w, i in utility.word_ids.iteritems()])
+  utility.entry_match_token_id = utility.word_ids[utility.entry_match_token]
+  utility.column_match_token_id = utility.word_ids[utility.column_match_token]
+  utility.dummy_token_id = utility.word_ids[utility.dummy_token]
+  data_sets = []
+  for d in range(int(cache["num_data_sets"])):
+    fields = [(name, cache["%s_%d" % (name, d)]) for name, _ in feed_fields]
+    data_sets.append([
+        ProcessedExample([(name, values[n]) for name, values in fields])
+        for n in range(int(cache["num_examples_%d" % d]))
+    ])
+  return data_sets
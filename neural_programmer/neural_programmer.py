@@ -55,6 +55,10 @@ tf.flags.DEFINE_string("output_dir", "../model/",
                        """output_dir""")
 tf.flags.DEFINE_string("data_dir", "../data/",
                        """data_dir""")
+tf.flags.DEFINE_string("data_cache_dir", "",
+                       "directory to cache the processed data in, if set. "
+                       "Processed data is reused only while the flags and the "
+                       "sizes and mtimes of the data files are unchanged")
 tf.flags.DEFINE_integer("write_every", 500, "wrtie every N")
 tf.flags.DEFINE_integer("param_seed", 150, "")
 tf.flags.DEFINE_integer("python_seed", 200, "")
@@ -209,22 +213,34 @@ def main(args):
   train_name = "random-split-1-train.examples"
   dev_name = "random-split-1-dev.examples"
   test_name = "pristine-unseen-tables.examples"
-  #load data
-  dat = wiki_data.WikiQuestionGenerator(train_name, dev_name, test_name, FLAGS.data_dir)
-  train_data, dev_data, test_data = dat.load()
-  utility.words = []
-  utility.word_ids = {}
-  utility.reverse_word_ids = {}
-  #construct vocabulary
-  data_utils.construct_vocab(train_data, utility)
-  data_utils.construct_vocab(dev_data, utility, True)
-  data_utils.construct_vocab(test_data, utility, True)
-  data_utils.add_special_words(utility)
-  data_utils.perform_word_cutoff(utility)
-  #convert data to int format and pad the inputs
-  train_data = data_utils.complete_wiki_processing(train_data, utility, True)
-  dev_data = data_utils.complete_wiki_processing(dev_data, utility, False)
-  test_data = data_utils.complete_wiki_processing(test_data, utility, False)
+  cache_file = None
+  if (FLAGS.data_cache_dir):
+    cache_file = data_utils.processed_data_file(
+        FLAGS.data_cache_dir, (train_name, dev_name, test_name), utility)
+  if (cache_file and tf.gfile.Exists(cache_file)):
+    print "loading processed data from ", cache_file
+    train_data, dev_data, test_data = data_utils.load_processed_data(
+        cache_file, utility)
+  else:
+    #load data
+    dat = wiki_data.WikiQuestionGenerator(train_name, dev_name, test_name, FLAGS.data_dir)
+    train_data, dev_data, test_data = dat.load()
+    utility.words = []
+    utility.word_ids = {}
+    utility.reverse_word_ids = {}
+    #construct vocabulary
+    data_utils.construct_vocab(train_data, utility)
+    data_utils.construct_vocab(dev_data, utility, True)
+    data_utils.construct_vocab(test_data, utility, True)
+    data_utils.add_special_words(utility)
+    data_utils.perform_word_cutoff(utility)
+    #convert data to int format and pad the inputs
+    train_data = data_utils.complete_wiki_processing(train_data, utility, True)
+    dev_data = data_utils.complete_wiki_processing(dev_data, utility, False)
+    test_data = data_utils.complete_wiki_processing(test_data, utility, False)
+    if (cache_file):
+      data_utils.save_processed_data(
+          cache_file, [train_data, dev_data, test_data], utility)
   print "# train examples ", len(train_data)
   print "# dev examples ", len(dev_data)
   print "# test examples ", len(test_data)
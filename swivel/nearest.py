@@ -23,22 +23,31 @@ from getopt import GetoptError, getopt
 from vecs import Vecs
 
 try:
-  opts, args = getopt(sys.argv[1:], 'v:e:', ['vocab=', 'embeddings='])
+  opts, args = getopt(
+      sys.argv[1:], 'v:e:i:', ['vocab=', 'embeddings=', 'index='])
 except GetoptError, e:
   print >> sys.stderr, e
   sys.exit(2)
 
 opt_vocab = 'vocab.txt'
 opt_embeddings = None
+opt_index = None
 
 for o, a in opts:
   if o in ('-v', '--vocab'):
     opt_vocab = a
   if o in ('-e', '--embeddings'):
     opt_embeddings = a
+  if o in ('-i', '--index'):
+    opt_index = a
 
 vecs = Vecs(opt_vocab, opt_embeddings)
 
+# Use an approximate index if one was requested; it is built and saved the first
+# time, and reloaded afterwards.
+if opt_index:
+  vecs.build_index(opt_index)
+
 while True:
   sys.stdout.write('query> ')
   sys.stdout.flush()
@@ -50,7 +59,7 @@ while True:
   parts = re.split(r'\s+', query)
 
   if len(parts) == 1:
-    res = vecs.neighbors(parts[0])
+    res = vecs.neighbors(parts[0], 20)
 
   elif len(parts) == 3:
     vs = [vecs.lookup(w) for w in parts]
@@ -60,7 +69,7 @@ while True:
 
       continue
 
-    res = vecs.neighbors(vs[2] - vs[0] + vs[1])
+    res = vecs.neighbors(vs[2] - vs[0] + vs[1], 20)
 
   else:
     print 'use a single word to query neighbors, or three words for analogy'
@@ -69,7 +78,7 @@ while True:
   if not res:
     continue
 
-  for word, sim in res[:20]:
+  for word, sim in res:
     print '%0.4f: %s' % (sim, word)
 
   print
@@ -53,14 +53,33 @@ Options:
   --bufsz <int>
       The number of co-occurrences that are buffered; default 16M.
 
+  --num_workers <int>
+      The number of processes used to count co-occurrences.  When set, the
+      input is split into byte ranges that are counted in parallel using
+      vectorized NumPy operations, and each worker buffers at most --bufsz
+      co-occurrences at a time.  The default (0) uses the original,
+      single-process counter.
+
+  --merge_bufsz <int>
+      The number of co-occurrences held in memory while sorting and merging
+      each shard; larger shards are merged from sorted runs on disk.  The
+      merged co-occurrences are added to the shard's tf.Example a chunk at a
+      time, so beyond this buffer, memory grows only with the Example itself,
+      which holds the whole shard.  Default 16M.
+
 """
 
+import glob
 import itertools
 import math
+import multiprocessing
 import os
+import shutil
 import struct
 import sys
+import tempfile
 
+import numpy as np
 import tensorflow as tf
 
 flags = tf.app.flags
@@ -77,11 +96,25 @@ flags.DEFINE_string('vocab', '', 'Vocabulary to use instead of generating one')
 flags.DEFINE_integer('window_size', 10, 'The window size')
 flags.DEFINE_integer('bufsz', 16 * 1024 * 1024,
                      'The number of co-occurrences to buffer')
+flags.DEFINE_integer('num_workers', 0,
+                     'The number of processes used to count co-occurrences; '
+                     '0 uses the single-process counter')
+flags.DEFINE_integer('merge_bufsz', 16 * 1024 * 1024,
+                     'The number of co-occurrences to hold in memory while '
+                     'merging a shard')
 
 FLAGS = flags.FLAGS
 
 shard_cooc_fmt = struct.Struct('iif')
 
+# The NumPy equivalent of shard_cooc_fmt, used to read and write the temporary
+# shard files in bulk.
+shard_cooc_dtype = np.dtype(
+    [('row', np.int32), ('col', np.int32), ('cnt', np.float32)])
+
+# The sorted, reduced runs of a shard that are spilled to disk while merging.
+merge_cooc_dtype = np.dtype([('key', np.int64), ('cnt', np.float64)])
+
 
 def words(line):
   """Splits a line of text into tokens."""
@@ -213,6 +246,325 @@ def compute_coocs(lines, vocab):
   return shardfiles, sums
 
 
+def split_input(filename, num_ranges):
+  """Splits a file into roughly equal byte ranges.
+
+  A line belongs to the range that contains its first byte, so the ranges may
+  be processed independently without splitting any lines.
+
+  """
+  nbytes = os.path.getsize(filename)
+  bounds = [nbytes * i / num_ranges for i in range(num_ranges + 1)]
+  return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def count_window(wids, line_ids, vocab_size):
+  """Counts the co-occurrences of a buffer of sentences with NumPy.
+
+  Args:
+    wids: the in-vocabulary word IDs of the sentences, concatenated.
+    line_ids: the sentence that each word belongs to; windows never span
+      sentences.
+    vocab_size: the vocabulary size.
+
+  Returns:
+    A (keys, counts, sums) tuple.  Each key packs a (min(a, b), max(a, b)) pair
+    as a * vocab_size + b; the keys are sorted and unique, and counts holds the
+    corresponding co-occurrence counts.  The sums are the marginal counts
+    contributed by the buffer.
+
+  """
+  # Every word co-occurs with itself once; as in compute_coocs, only add 1/2
+  # since both (a, b) and (b, a) are output.
+  keys = [wids * vocab_size + wids]
+  counts = [np.empty(len(wids))]
+  counts[0].fill(0.5)
+  sums = np.bincount(wids, minlength=vocab_size).astype(np.float64)
+
+  for off in xrange(1, min(FLAGS.window_size + 1, len(wids))):
+    same_line = line_ids[off:] == line_ids[:-off]
+    lids = wids[:-off][same_line]
+    rids = wids[off:][same_line]
+    count = 1.0 / off
+    sums += count * np.bincount(lids, minlength=vocab_size)
+    sums += count * np.bincount(rids, minlength=vocab_size)
+    keys.append(np.minimum(lids, rids) * vocab_size + np.maximum(lids, rids))
+    counts.append(np.empty(len(lids)))
+    counts[-1].fill(count)
+
+  keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+  counts = np.bincount(inverse, weights=np.concatenate(counts))
+  return keys, counts, sums
+
+
+def write_coocs(keys, counts, vocab_size, filename_fmt):
+  """Appends packed co-occurrences to the temporary file for each shard.
+
+  Args:
+    keys: packed (a, b) pairs, as returned by count_window.
+    counts: the co-occurrence count for each pair.
+    vocab_size: the vocabulary size.
+    filename_fmt: the temporary filename, parameterized by the row and column
+      shard.
+
+  """
+  num_shards = vocab_size / FLAGS.shard_size
+
+  # Since we only stored (a, b), we emit both (a, b) and (b, a).
+  row_ids = np.concatenate([keys // vocab_size, keys % vocab_size])
+  col_ids = np.concatenate([keys % vocab_size, keys // vocab_size])
+  counts = np.concatenate([counts, counts])
+
+  shard_ids = (row_ids % num_shards) * num_shards + col_ids % num_shards
+  order = np.argsort(shard_ids, kind='mergesort')
+  shard_ids = shard_ids[order]
+
+  coocs = np.empty(len(order), dtype=shard_cooc_dtype)
+  coocs['row'] = row_ids[order] // num_shards
+  coocs['col'] = col_ids[order] // num_shards
+  coocs['cnt'] = counts[order]
+
+  bounds = np.searchsorted(shard_ids, np.arange(num_shards * num_shards + 1))
+  for shard_id in np.flatnonzero(np.diff(bounds)):
+    row, col = divmod(shard_id, num_shards)
+    with open(filename_fmt % (row, col), 'ab') as out:
+      coocs[bounds[shard_id]:bounds[shard_id + 1]].tofile(out)
+
+
+def init_counter(word_to_id, input_filename, tmp_dir):
+  """Initializes the state of a co-occurrence counting process.
+
+  Args:
+    word_to_id: the vocabulary.
+    input_filename: the input text file.
+    tmp_dir: the directory for this run's per-process temporary shard files.
+
+  """
+  global counter_word_to_id, counter_input_filename, counter_tmp_dir
+  counter_word_to_id = word_to_id
+  counter_input_filename = input_filename
+  counter_tmp_dir = tmp_dir
+
+
+def count_range(byte_range):
+  """Counts the co-occurrences for the lines within a byte range of the input.
+
+  This runs in a worker process.  Co-occurrences are buffered until there are
+  roughly FLAGS.bufsz of them, then reduced and appended to per-process
+  temporary shard files in the run's temporary directory.
+
+  Returns:
+    The marginal sums for the range.
+
+  """
+  start, end = byte_range
+  vocab_size = len(counter_word_to_id)
+  filename_fmt = os.path.join(
+      counter_tmp_dir, 'shard-%%03d-%%03d.tmp.%d' % os.getpid())
+
+  sums = np.zeros(vocab_size)
+  wids, line_ids = [], []
+
+  def flush():
+    keys, counts, window_sums = count_window(
+        np.array(wids, dtype=np.int64), np.array(line_ids, dtype=np.int64),
+        vocab_size)
+
+    write_coocs(keys, counts, vocab_size, filename_fmt)
+    sums[:] += window_sums
+
+  with open(counter_input_filename, 'r') as lines:
+    # Skip the line that straddles the start of the range: it belongs to the
+    # previous range.
+    pos = 0
+    if start > 0:
+      lines.seek(start - 1)
+      pos = start - 1 + len(lines.readline())
+
+    lineno = 0
+    while pos < end:
+      line = lines.readline()
+      if not line:
+        break
+
+      pos += len(line)
+      lineno += 1
+
+      # As in compute_coocs, OOV tokens are dropped before windowing.
+      for w in words(line):
+        wid = counter_word_to_id.get(w)
+        if wid is not None:
+          wids.append(wid)
+          line_ids.append(lineno)
+
+      if len(wids) * (FLAGS.window_size + 1) >= FLAGS.bufsz:
+        flush()
+        del wids[:], line_ids[:]
+
+  if wids:
+    flush()
+
+  return sums
+
+
+def compute_coocs_parallel(filename, vocab):
+  """Compute the co-occurrence statistics using multiple processes.
+
+  This is equivalent to compute_coocs, except that the input is split into byte
+  ranges that are counted by FLAGS.num_workers processes.  Each process writes
+  its own temporary files, which are then collected into the same per-shard
+  temporary files that compute_coocs produces.  The process files are kept in
+  a directory of their own, so that files left behind by an interrupted run
+  are never merged into this one.
+
+  """
+  word_to_id = {tok: idx for idx, tok in enumerate(vocab)}
+  num_shards = len(vocab) / FLAGS.shard_size
+
+  # Use several ranges per worker so that the load stays balanced and progress
+  # can be reported.
+  ranges = split_input(filename, 4 * FLAGS.num_workers)
+
+  tmp_dir = tempfile.mkdtemp(prefix='coocs.', dir=FLAGS.output_dir)
+  try:
+    pool = multiprocessing.Pool(
+        FLAGS.num_workers, initializer=init_counter,
+        initargs=(word_to_id, filename, tmp_dir))
+
+    sums = np.zeros(len(vocab))
+    try:
+      for ix, range_sums in enumerate(
+          pool.imap_unordered(count_range, ranges), start=1):
+        sums += range_sums
+        sys.stdout.write('\rComputing co-occurrences: %d/%d ranges...' % (
+            ix, len(ranges)))
+        sys.stdout.flush()
+
+    finally:
+      pool.close()
+      pool.join()
+
+    sys.stdout.write('\n')
+
+    shardfiles = {}
+    for row in range(num_shards):
+      for col in range(num_shards):
+        shard_filename = 'shard-%03d-%03d.tmp' % (row, col)
+        shardfiles[(row, col)] = open(
+            os.path.join(FLAGS.output_dir, shard_filename), 'w+')
+        for worker_filename in glob.glob(
+            os.path.join(tmp_dir, shard_filename + '.*')):
+          with open(worker_filename, 'rb') as worker_fh:
+            shutil.copyfileobj(worker_fh, shardfiles[(row, col)])
+
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+  return shardfiles, sums.tolist()
+
+
+def reduce_coocs(keys, counts):
+  """Sorts packed co-occurrences and sums the counts of duplicate pairs."""
+  keys, inverse = np.unique(keys, return_inverse=True)
+  return keys, np.bincount(inverse, weights=counts)
+
+
+def merge_runs(run_filenames, block_size):
+  """Merges sorted, reduced runs of co-occurrences.
+
+  Each run is read block_size co-occurrences at a time.  On every pass, all of
+  the buffered co-occurrences up to the smallest last key of a partially read
+  run are merged; since the runs are sorted, no later block can contain those
+  keys.
+
+  Yields:
+    (keys, counts) tuples, each sorted and reduced, and in increasing key order
+    from one tuple to the next.
+
+  """
+  runs = [open(filename, 'rb') for filename in run_filenames]
+  pending = [np.empty(0, dtype=merge_cooc_dtype) for _ in runs]
+  exhausted = [False] * len(runs)
+
+  try:
+    while True:
+      for ix, run in enumerate(runs):
+        if not len(pending[ix]) and not exhausted[ix]:
+          pending[ix] = np.fromfile(run, dtype=merge_cooc_dtype,
+                                    count=block_size)
+          exhausted[ix] = len(pending[ix]) < block_size
+
+      if all(exhausted) and not any(len(block) for block in pending):
+        break
+
+      limits = [block['key'][-1]
+                for block, done in zip(pending, exhausted) if not done]
+      limit = min(limits) if limits else np.iinfo(np.int64).max
+
+      keys, counts = [], []
+      for ix, block in enumerate(pending):
+        split = np.searchsorted(block['key'], limit, side='right')
+        keys.append(block['key'][:split])
+        counts.append(block['cnt'][:split])
+        pending[ix] = block[split:]
+
+      yield reduce_coocs(np.concatenate(keys), np.concatenate(counts))
+
+  finally:
+    for run in runs:
+      run.close()
+
+
+def merge_shard(fh):
+  """Sorts and merges the co-occurrences in a temporary shard file.
+
+  The file is read in chunks of at most FLAGS.merge_bufsz co-occurrences.  Each
+  chunk is sorted and reduced with NumPy; if the file does not fit in a single
+  chunk, the reduced chunks are spilled to disk as runs which are then merged,
+  so that memory use is bounded by FLAGS.merge_bufsz rather than by the size of
+  the shard.
+
+  Yields:
+    (keys, counts) tuples, where each key packs a (row, col) pair as
+    row * FLAGS.shard_size + col.  Across all of the tuples, the keys are sorted
+    and unique.
+
+  """
+  fh.flush()
+  fh.seek(0, os.SEEK_END)
+  num_coocs = fh.tell() / shard_cooc_dtype.itemsize
+  fh.seek(0)
+
+  run_filenames = []
+  keys, counts = np.empty(0, dtype=np.int64), np.empty(0)
+  for offset in xrange(0, num_coocs, FLAGS.merge_bufsz):
+    chunk = np.fromfile(fh, dtype=shard_cooc_dtype, count=FLAGS.merge_bufsz)
+    keys, counts = reduce_coocs(
+        chunk['row'].astype(np.int64) * FLAGS.shard_size + chunk['col'],
+        chunk['cnt'])
+
+    if offset + FLAGS.merge_bufsz < num_coocs or run_filenames:
+      run = np.empty(len(keys), dtype=merge_cooc_dtype)
+      run['key'] = keys
+      run['cnt'] = counts
+      run_filenames.append('%s.run%d' % (fh.name, len(run_filenames)))
+      run.tofile(run_filenames[-1])
+      del chunk, run
+
+  if not run_filenames:
+    yield keys, counts
+    return
+
+  try:
+    for keys, counts in merge_runs(
+        run_filenames, max(1, FLAGS.merge_bufsz / len(run_filenames))):
+      yield keys, counts
+
+  finally:
+    for filename in run_filenames:
+      os.unlink(filename)
+
+
 def write_shards(vocab, shardfiles):
   """Processes the temporary files to generate the final shard data.
 
@@ -228,38 +580,6 @@ def write_shards(vocab, shardfiles):
     sys.stdout.write('\rwriting shard %d/%d' % (ix, len(shardfiles)))
     sys.stdout.flush()
 
-    # Read the entire binary co-occurrence and unpack it into an array.
-    fh.seek(0)
-    buf = fh.read()
-    os.unlink(fh.name)
-    fh.close()
-
-    coocs = [
-        shard_cooc_fmt.unpack_from(buf, off)
-        for off in range(0, len(buf), shard_cooc_fmt.size)]
-
-    # Sort and merge co-occurrences for the same pairs.
-    coocs.sort()
-
-    if coocs:
-      current_pos = 0
-      current_row_col = (coocs[current_pos][0], coocs[current_pos][1])
-      for next_pos in range(1, len(coocs)):
-        next_row_col = (coocs[next_pos][0], coocs[next_pos][1])
-        if current_row_col == next_row_col:
-          coocs[current_pos] = (
-              coocs[current_pos][0],
-              coocs[current_pos][1],
-              coocs[current_pos][2] + coocs[next_pos][2])
-        else:
-          current_pos += 1
-          if current_pos < next_pos:
-            coocs[current_pos] = coocs[next_pos]
-
-          current_row_col = (coocs[current_pos][0], coocs[current_pos][1])
-
-      coocs = coocs[:(1 + current_pos)]
-
     # Convert to a TF Example proto.
     def _int64s(xs):
       return tf.train.Feature(int64_list=tf.train.Int64List(value=list(xs)))
@@ -273,11 +593,24 @@ def write_shards(vocab, shardfiles):
         'global_col': _int64s(
             col + num_shards * i for i in range(FLAGS.shard_size)),
 
-        'sparse_local_row': _int64s(cooc[0] for cooc in coocs),
-        'sparse_local_col': _int64s(cooc[1] for cooc in coocs),
-        'sparse_value': _floats(cooc[2] for cooc in coocs),
+        'sparse_local_row': _int64s([]),
+        'sparse_local_col': _int64s([]),
+        'sparse_value': _floats([]),
     }))
 
+    # Sort and merge co-occurrences for the same pairs, and add them to the
+    # Example a chunk at a time.
+    feature = example.features.feature
+    for keys, counts in merge_shard(fh):
+      feature['sparse_local_row'].int64_list.value.extend(
+          (keys // FLAGS.shard_size).tolist())
+      feature['sparse_local_col'].int64_list.value.extend(
+          (keys % FLAGS.shard_size).tolist())
+      feature['sparse_value'].float_list.value.extend(counts.tolist())
+
+    os.unlink(fh.name)
+    fh.close()
+
     filename = os.path.join(FLAGS.output_dir, 'shard-%03d-%03d.pb' % (row, col))
     with open(filename, 'w') as out:
       out.write(example.SerializeToString())
@@ -299,8 +632,11 @@ def main(_):
       vocab = create_vocabulary(lines)
 
   # Now read the file again to determine the co-occurrence stats.
-  with open(FLAGS.input, 'r') as lines:
-    shardfiles, sums = compute_coocs(lines, vocab)
+  if FLAGS.num_workers > 0:
+    shardfiles, sums = compute_coocs_parallel(FLAGS.input, vocab)
+  else:
+    with open(FLAGS.input, 'r') as lines:
+      shardfiles, sums = compute_coocs(lines, vocab)
 
   # Collect individual shards into the shards.recs file.
   write_shards(vocab, shardfiles)
@@ -55,6 +55,7 @@ from __future__ import print_function
 import glob
 import math
 import os
+import random
 import sys
 import time
 import threading
@@ -92,6 +93,16 @@ flags.DEFINE_float('per_process_gpu_memory_fraction', 0,
                    'Fraction of GPU memory to use, 0 means allow_growth')
 flags.DEFINE_integer('num_gpus', 0,
                      'Number of GPUs to use, 0 means all available')
+flags.DEFINE_boolean('prefetch_input', False,
+                     'Read shards with Python prefetch threads that cache '
+                     'them as memory-mapped CSR arrays, instead of the '
+                     'queue-based tf.Example reader')
+flags.DEFINE_string('input_cache_path', '',
+                    'Directory for the cached CSR shards; defaults to '
+                    'input_base_path/csr_cache')
+flags.DEFINE_integer('submatrices_per_step', 1,
+                     'Number of submatrices each tower trains on per step; '
+                     'requires --prefetch_input')
 
 FLAGS = flags.FLAGS
 
@@ -153,6 +164,151 @@ def count_matrix_input(filenames, submatrix_rows, submatrix_cols):
   return queued_global_row, queued_global_col, queued_count
 
 
+class ShardLoader(object):
+  """Prefetches submatrix shards using Python threads.
+
+  The first time a shard is read, its tf.Example is decoded into compact CSR
+  arrays that are saved in cache_path; afterwards, the shard is loaded from
+  memory-mapped .npy files.  Each of num_readers threads densifies shards and
+  feeds them into a TF queue, from which the model dequeues several submatrices
+  at a time.  The shards are visited in a new random order each epoch.
+  """
+
+  FIELDS = ('global_row', 'global_col', 'indptr', 'indices', 'values')
+
+  def __init__(self, filenames, cache_path, submatrix_rows, submatrix_cols,
+               num_readers, capacity=32):
+    self._filenames = list(filenames)
+    self._order = []
+    self._cache_path = cache_path
+    self._submatrix_rows = submatrix_rows
+    self._submatrix_cols = submatrix_cols
+    self._num_readers = num_readers
+    self._lock = threading.Lock()
+
+    self.num_loaded = 0
+    self._start_time = None
+
+    if not os.path.isdir(cache_path):
+      os.makedirs(cache_path)
+
+    self._global_row = tf.placeholder(tf.int64, [submatrix_rows])
+    self._global_col = tf.placeholder(tf.int64, [submatrix_cols])
+    self._count = tf.placeholder(tf.float32, [submatrix_rows, submatrix_cols])
+
+    self._queue = tf.FIFOQueue(
+        capacity, [tf.int64, tf.int64, tf.float32],
+        shapes=[[submatrix_rows], [submatrix_cols],
+                [submatrix_rows, submatrix_cols]])
+    self._enqueue_op = self._queue.enqueue(
+        [self._global_row, self._global_col, self._count])
+    self.close_op = self._queue.close(cancel_pending_enqueues=True)
+    self.size = self._queue.size()
+
+  def dequeue_many(self, n):
+    """Returns the global rows, global columns, and counts of n shards."""
+    return self._queue.dequeue_many(n)
+
+  def _cache_filenames(self, filename):
+    base = os.path.join(
+        self._cache_path, os.path.splitext(os.path.basename(filename))[0])
+    return ['%s.%s.npy' % (base, field) for field in self.FIELDS]
+
+  def _decode(self, filename):
+    """Decodes a tf.Example shard into CSR arrays."""
+    with open(filename, 'rb') as fh:
+      example = tf.train.Example.FromString(fh.read())
+
+    feature = example.features.feature
+
+    def _values(name, dtype):
+      kind = feature[name].WhichOneof('kind')
+      return np.array(getattr(feature[name], kind).value, dtype=dtype)
+
+    rows = _values('sparse_local_row', np.int32)
+    cols = _values('sparse_local_col', np.int32)
+    values = _values('sparse_value', np.float32)
+
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate([
+        [0], np.cumsum(np.bincount(rows, minlength=self._submatrix_rows))])
+
+    return (_values('global_row', np.int64), _values('global_col', np.int64),
+            indptr.astype(np.int32), cols[order], values[order])
+
+  def load(self, filename):
+    """Returns the global rows, global columns, and dense counts of a shard."""
+    cache_filenames = self._cache_filenames(filename)
+    if all(os.path.exists(fn) for fn in cache_filenames):
+      arrays = [np.load(fn, mmap_mode='r') for fn in cache_filenames]
+    else:
+      arrays = self._decode(filename)
+
+      # Write to temporary files and rename them, so that an interrupted run
+      # never leaves a partial cache behind. The temporary name is per reader
+      # thread, as two readers can decode the same shard at once.
+      for array, cache_filename in zip(arrays, cache_filenames):
+        tmp_filename = '%s.tmp.%d.%d' % (
+            cache_filename, os.getpid(), threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as out:
+          np.save(out, array)
+
+        os.rename(tmp_filename, cache_filename)
+
+    global_row, global_col, indptr, indices, values = arrays
+
+    count = np.zeros(
+        (self._submatrix_rows, self._submatrix_cols), dtype=np.float32)
+    count[np.repeat(np.arange(self._submatrix_rows), np.diff(indptr)),
+          indices] = values
+
+    return global_row, global_col, count
+
+  def _next_filename(self):
+    with self._lock:
+      if not self._order:
+        self._order = list(self._filenames)
+        random.shuffle(self._order)
+
+      return self._order.pop()
+
+  def _run(self, sess, coord):
+    try:
+      while not coord.should_stop():
+        global_row, global_col, count = self.load(self._next_filename())
+        sess.run(self._enqueue_op, feed_dict={
+            self._global_row: global_row,
+            self._global_col: global_col,
+            self._count: count})
+
+        with self._lock:
+          self.num_loaded += 1
+
+    except tf.errors.CancelledError:
+      pass
+
+    except Exception as e:  # pylint: disable=broad-except
+      coord.request_stop(e)
+
+  def start(self, sess, coord):
+    """Starts the reader threads, and returns them."""
+    self._start_time = time.time()
+    threads = [
+        threading.Thread(target=self._run, args=(sess, coord))
+        for _ in range(self._num_readers)]
+
+    for t in threads:
+      t.daemon = True
+      t.start()
+
+    return threads
+
+  def shards_per_sec(self):
+    """Returns the average rate at which shards have been loaded."""
+    with self._lock:
+      return self.num_loaded / max(time.time() - self._start_time, 1e-6)
+
+
 def read_marginals_file(filename):
   """Reads text file with one number per line to an array."""
   with open(filename) as lines:
@@ -216,9 +372,27 @@ class SwivelModel(object):
 
     with tf.device('/cpu:0'):
       # ===== CREATE VARIABLES ======
-      # Get input
-      global_row, global_col, count = count_matrix_input(
-        count_matrix_files, config.submatrix_rows, config.submatrix_cols)
+      # Get input.  Each step trains on a batch of submatrices, so the inputs
+      # have a leading submatrix dimension.
+      if config.prefetch_input:
+        self.input = ShardLoader(
+            count_matrix_files,
+            (config.input_cache_path or
+             os.path.join(config.input_base_path, 'csr_cache')),
+            config.submatrix_rows, config.submatrix_cols, config.num_readers)
+        self.submatrices_per_step = config.submatrices_per_step
+        global_row, global_col, count = self.input.dequeue_many(
+            self.submatrices_per_step)
+      else:
+        if config.submatrices_per_step != 1:
+          raise ValueError('--submatrices_per_step=%d requires '
+                           '--prefetch_input' % config.submatrices_per_step)
+        self.input = None
+        self.submatrices_per_step = 1
+        global_row, global_col, count = [
+            tf.expand_dims(t, 0) for t in count_matrix_input(
+                count_matrix_files, config.submatrix_rows,
+                config.submatrix_cols)]
 
       # Embeddings
       self.row_embedding = embeddings_with_init(
@@ -280,9 +454,8 @@ class SwivelModel(object):
             count_is_zero = 1 - count_is_nonzero
 
             objectives = count_is_nonzero * tf.log(count + 1e-30)
-            objectives -= tf.reshape(
-                selected_row_bias, [config.submatrix_rows, 1])
-            objectives -= selected_col_bias
+            objectives -= tf.expand_dims(selected_row_bias, 2)
+            objectives -= tf.expand_dims(selected_col_bias, 1)
             objectives += matrix_log_sum
 
             err = predictions - objectives
@@ -357,12 +530,15 @@ def main(_):
     # Start feeding input
     coord = tf.train.Coordinator()
     threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+    if model.input:
+      threads += model.input.start(sess, coord)
 
     # Calculate how many steps each thread should run
     n_total_steps = int(FLAGS.num_epochs * model.n_rows * model.n_cols) / (
         FLAGS.submatrix_rows * FLAGS.submatrix_cols)
     n_steps_per_thread = n_total_steps / (
-        FLAGS.num_concurrent_steps * model.devices_number)
+        FLAGS.num_concurrent_steps * model.devices_number *
+        model.submatrices_per_step)
     n_submatrices_to_train = model.n_submatrices * FLAGS.num_epochs
     t0 = [time.time()]
     n_steps_between_status_updates = 100
@@ -384,9 +560,18 @@ def main(_):
             show_status = True
         if show_status:
           elapsed = float(time.time() - t0[0])
-          log(msg, global_step, n_submatrices_to_train,
-              100.0 * global_step / n_submatrices_to_train,
-              n_steps_between_status_updates / elapsed, loss)
+          n_trained = global_step * model.submatrices_per_step
+          log(msg, n_trained, n_submatrices_to_train,
+              100.0 * n_trained / n_submatrices_to_train,
+              n_steps_between_status_updates * model.submatrices_per_step /
+              elapsed, loss)
+
+          # Compare the input rate to the training rate to see which one is
+          # the bottleneck.
+          if model.input:
+            log('input: %5.1f shards/sec loaded, %d queued',
+                model.input.shards_per_sec(), sess.run(model.input.size))
+
           t0[0] = time.time()
 
     # Start training threads
@@ -401,6 +586,8 @@ def main(_):
       t.join()
 
     coord.request_stop()
+    if model.input:
+      sess.run(model.input.close_op)
     coord.join(threads)
 
     # Write out vectors
@@ -12,53 +12,265 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import mmap
 import numpy as np
 import os
 import struct
 
+
+def top_k(scores, k):
+  """Returns the indices of the k largest scores in each row, best first."""
+  k = min(k, scores.shape[1])
+  if k < scores.shape[1]:
+    idxs = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+  else:
+    idxs = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+
+  rows = np.arange(scores.shape[0])[:, np.newaxis]
+  order = np.argsort(-scores[rows, idxs], axis=1)
+  return idxs[rows, order]
+
+
+class ExactIndex(object):
+  """Exact nearest neighbor search over normalized vectors.
+
+  The vectors are scored a block at a time so that the score matrix for a batch
+  of queries never exceeds block_size rows of the vocabulary, and only the top k
+  of each block are kept.
+  """
+
+  def __init__(self, vecs, block_size=65536):
+    self.vecs = np.asarray(vecs)
+    self.block_size = block_size
+
+  def search(self, queries, k):
+    """Returns (indices, scores) of the k nearest vectors for each query."""
+    queries = np.asarray(queries, dtype=np.float32)
+    best_idxs = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    rows = np.arange(len(queries))[:, np.newaxis]
+
+    for start in xrange(0, len(self.vecs), self.block_size):
+      scores = queries.dot(self.vecs[start:start + self.block_size].T)
+      idxs = top_k(scores, k)
+      best_idxs = np.hstack([best_idxs, idxs + start])
+      best_scores = np.hstack([best_scores, scores[rows, idxs]])
+
+      order = top_k(best_scores, k)
+      best_idxs = best_idxs[rows, order]
+      best_scores = best_scores[rows, order]
+
+    return best_idxs, best_scores
+
+
+class LSHIndex(object):
+  """Approximate nearest neighbor search using random projection LSH.
+
+  Each of num_tables tables hashes a vector to num_bits sign bits of its
+  projection onto random hyperplanes.  The candidates for a query are the
+  vectors that share a bucket with it in any table; these are then scored
+  exactly.  If there are fewer than k candidates, the query falls back to an
+  exact search.
+
+  Use save() to store the index next to the binary vectors, and load() to
+  reopen it without rehashing the vocabulary.
+  """
+
+  def __init__(self, vecs, num_bits=16, num_tables=8, seed=0, _tables=None):
+    if num_bits > 62:
+      raise ValueError('num_bits must be at most 62')
+
+    self.vecs = np.asarray(vecs)
+    self.exact = ExactIndex(self.vecs)
+
+    if _tables is not None:
+      self.planes, self.codes, self.orders = _tables
+      return
+
+    rng = np.random.RandomState(seed)
+    self.planes = rng.randn(
+        num_tables, self.vecs.shape[1], num_bits).astype(np.float32)
+
+    self.codes, self.orders = [], []
+    for planes in self.planes:
+      codes = self._hash(self.vecs, planes)
+      order = np.argsort(codes, kind='mergesort')
+      self.codes.append(codes[order])
+      self.orders.append(order)
+
+    self.codes = np.array(self.codes)
+    self.orders = np.array(self.orders)
+
+  @staticmethod
+  def _hash(vecs, planes):
+    bits = (np.asarray(vecs).dot(planes) > 0).astype(np.int64)
+    return bits.dot(np.int64(1) << np.arange(planes.shape[1], dtype=np.int64))
+
+  def save(self, filename):
+    """Writes the hash tables to a .npz file."""
+    with open(filename, 'wb') as fh:
+      np.savez(fh, planes=self.planes, codes=self.codes, orders=self.orders)
+
+  @classmethod
+  def load(cls, filename, vecs):
+    """Reads hash tables written by save() for the given vectors."""
+    tables = np.load(filename)
+    if tables['orders'].shape[1] != len(vecs):
+      raise IOError('index %s does not match the vectors' % filename)
+
+    return cls(vecs, _tables=(
+        tables['planes'], tables['codes'], tables['orders']))
+
+  def candidates(self, query):
+    """Returns the indices of the vectors that share a bucket with a query."""
+    buckets = []
+    for planes, codes, order in zip(self.planes, self.codes, self.orders):
+      code = self._hash(query[np.newaxis], planes)[0]
+      lo, hi = np.searchsorted(codes, [code, code + 1])
+      buckets.append(order[lo:hi])
+
+    return np.unique(np.concatenate(buckets))
+
+  def search(self, queries, k):
+    """Returns (indices, scores) of the approximately nearest vectors."""
+    queries = np.asarray(queries, dtype=np.float32)
+    k = min(k, len(self.vecs))
+    best_idxs = np.empty((len(queries), k), dtype=np.int64)
+    best_scores = np.empty((len(queries), k), dtype=np.float32)
+
+    for ix, query in enumerate(queries):
+      cands = self.candidates(query)
+      if len(cands) < k:
+        idxs, scores = self.exact.search(query[np.newaxis], k)
+        best_idxs[ix], best_scores[ix] = idxs[0], scores[0]
+        continue
+
+      scores = self.vecs[cands].dot(query)[np.newaxis]
+      order = top_k(scores, k)[0]
+      best_idxs[ix] = cands[order]
+      best_scores[ix] = scores[0, order]
+
+    return best_idxs, best_scores
+
+
 class Vecs(object):
-  def __init__(self, vocab_filename, rows_filename, cols_filename=None):
-    """Initializes the vectors from a text vocabulary and binary data."""
+  def __init__(self, vocab_filename, rows_filename, cols_filename=None,
+               normalized_filename=None):
+    """Initializes the vectors from a text vocabulary and binary data.
+
+    By default, the (row plus column) vectors are normalized into a private
+    in-memory copy.  If normalized_filename is given, the normalized vectors are
+    instead written to that file the first time (or whenever it is older than
+    the inputs) and then served from a read-only memory map, so that several
+    processes can share a single copy in the page cache.  The file starts with
+    a header that names the input files, so that vectors normalized from other
+    inputs (for example, from the rows only) are never reused.
+    """
     with open(vocab_filename, 'r') as lines:
       self.vocab = [line.split()[0] for line in lines]
       self.word_to_idx = {word: idx for idx, word in enumerate(self.vocab)}
 
     n = len(self.vocab)
 
-    with open(rows_filename, 'r') as rows_fh:
-      rows_fh.seek(0, os.SEEK_END)
-      size = rows_fh.tell()
+    size = os.path.getsize(rows_filename)
 
-      # Make sure that the file size seems reasonable.
-      if size % (4 * n) != 0:
-        raise IOError(
-            'unexpected file size for binary vector file %s' % rows_filename)
+    # Make sure that the file size seems reasonable.
+    if size % (4 * n) != 0:
+      raise IOError(
+          'unexpected file size for binary vector file %s' % rows_filename)
 
-      # Memory map the rows.
-      dim = size / (4 * n)
-      rows_mm = mmap.mmap(rows_fh.fileno(), 0, prot=mmap.PROT_READ)
-      rows = np.matrix(
-          np.frombuffer(rows_mm, dtype=np.float32).reshape(n, dim))
+    if cols_filename and os.path.getsize(cols_filename) != size:
+      raise IOError('row and column vector files have different sizes')
 
-      # If column vectors were specified, then open them and add them to the row
-      # vectors.
-      if cols_filename:
-        with open(cols_filename, 'r') as cols_fh:
-          cols_mm = mmap.mmap(cols_fh.fileno(), 0, prot=mmap.PROT_READ)
-          cols_fh.seek(0, os.SEEK_END)
-          if cols_fh.tell() != size:
-            raise IOError('row and column vector files have different sizes')
+    dim = size / (4 * n)
 
-          cols = np.matrix(
-              np.frombuffer(cols_mm, dtype=np.float32).reshape(n, dim))
+    if normalized_filename:
+      inputs = [rows_filename] + ([cols_filename] if cols_filename else [])
+      header = self._normalized_header(inputs)
+      if not self._is_fresh(normalized_filename, header, size, inputs):
+        self._write_normalized(normalized_filename, header, rows_filename,
+                               cols_filename, n, dim)
 
-          rows += cols
-          cols_mm.close()
+      self.vecs = np.asmatrix(np.memmap(
+          normalized_filename, dtype=np.float32, mode='r', offset=len(header),
+          shape=(n, dim)))
+
+    else:
+      # Memory map the rows, and the columns if they were specified.  The maps
+      # are released when the arrays that refer to them are.
+      rows = np.memmap(rows_filename, dtype=np.float32, mode='r', shape=(n, dim))
+      if cols_filename:
+        rows = rows + np.memmap(
+            cols_filename, dtype=np.float32, mode='r', shape=(n, dim))
 
       # Normalize so that dot products are just cosine similarity.
+      rows = np.matrix(rows)
       self.vecs = rows / np.linalg.norm(rows, axis=1).reshape(n, 1)
-      rows_mm.close()
+
+    self.index = ExactIndex(self.vecs)
+
+  @staticmethod
+  def _normalized_header(inputs):
+    """Returns the header naming the inputs of the normalized vectors.
+
+    The header is padded with zeros to a multiple of 64 bytes, so that the
+    vectors after it stay aligned.
+    """
+    header = 'swivel normalized vectors: %s\n' % '\t'.join(
+        os.path.abspath(filename) for filename in inputs)
+    return header + '\0' * (-len(header) % 64)
+
+  @staticmethod
+  def _is_fresh(normalized_filename, header, size, inputs):
+    """Checks whether the normalized vectors are of these inputs, and newer."""
+    if not os.path.exists(normalized_filename):
+      return False
+
+    if os.path.getsize(normalized_filename) != len(header) + size:
+      return False
+
+    with open(normalized_filename, 'rb') as fh:
+      if fh.read(len(header)) != header:
+        return False
+
+    mtime = os.path.getmtime(normalized_filename)
+    return all(os.path.getmtime(filename) <= mtime for filename in inputs)
+
+  @staticmethod
+  def _write_normalized(normalized_filename, header, rows_filename,
+                        cols_filename, n, dim, block_size=65536):
+    """Writes the header, then the normalized vectors a block at a time."""
+    rows = np.memmap(rows_filename, dtype=np.float32, mode='r', shape=(n, dim))
+    cols = cols_filename and np.memmap(
+        cols_filename, dtype=np.float32, mode='r', shape=(n, dim))
+
+    # Write to a temporary file and rename it, so that concurrent readers never
+    # see a partially written file.
+    tmp_filename = '%s.tmp.%d' % (normalized_filename, os.getpid())
+    with open(tmp_filename, 'wb') as out:
+      out.write(header)
+      for start in xrange(0, n, block_size):
+        block = np.array(rows[start:start + block_size])
+        if cols_filename:
+          block += cols[start:start + block_size]
+
+        block /= np.linalg.norm(block, axis=1).reshape(-1, 1)
+        block.tofile(out)
+
+    os.rename(tmp_filename, normalized_filename)
+
+  def build_index(self, index_filename=None, **kwargs):
+    """Builds an approximate LSH index for neighbor queries.
+
+    If index_filename names an existing file, the index is loaded from it;
+    otherwise it is built with the given LSHIndex arguments and, if a filename
+    was given, saved there.
+    """
+    if index_filename and os.path.exists(index_filename):
+      self.index = LSHIndex.load(index_filename, self.vecs)
+    else:
+      self.index = LSHIndex(self.vecs, **kwargs)
+      if index_filename:
+        self.index.save(index_filename)
 
   def similarity(self, word1, word2):
     """Computes the similarity of two tokens."""
@@ -69,20 +281,46 @@ class Vecs(object):
 
     return float(self.vecs[idx1] * self.vecs[idx2].transpose())
 
-  def neighbors(self, query):
-    """Returns the nearest neighbors to the query (a word or vector)."""
-    if isinstance(query, basestring):
-      idx = self.word_to_idx.get(query)
-      if idx is None:
-        return None
+  def neighbors(self, query, k=None):
+    """Returns the nearest neighbors to the query (a word or vector).
+
+    The neighbors are returned as (word, similarity) pairs, best first.  If k is
+    given, only the k nearest neighbors are returned.
+    """
+    res = self.neighbors_many([query], k)
+    return res[0]
+
+  def neighbors_many(self, queries, k=None):
+    """Returns the nearest neighbors for each of a batch of queries.
+
+    Each query is either a word or a vector.  The result for a word that is not
+    in the vocabulary is None.
+    """
+    if k is None:
+      k = len(self.vocab)
+
+    vecs, found = [], []
+    for query in queries:
+      if isinstance(query, basestring):
+        idx = self.word_to_idx.get(query)
+        if idx is None:
+          found.append(False)
+          continue
+
+        query = self.vecs[idx]
 
-      query = self.vecs[idx]
+      vecs.append(np.asarray(query, dtype=np.float32).reshape(-1))
+      found.append(True)
 
-    neighbors = self.vecs * query.transpose()
+    res = []
+    if vecs:
+      idxs, scores = self.index.search(np.vstack(vecs), k)
+      res = [
+          [(self.vocab[idx], float(score)) for idx, score in zip(*row)]
+          for row in zip(idxs, scores)]
 
-    return sorted(
-      zip(self.vocab, neighbors.flat),
-      key=lambda kv: kv[1], reverse=True)
+    res = iter(res)
+    return [next(res) if ok else None for ok in found]
 
   def lookup(self, word):
     """Returns the embedding for a token, or None if no embedding exists."""
@@ -16,7 +16,10 @@
 """Batch reader to seq2seq attention model, with bucketing support."""
 
 from collections import namedtuple
+import multiprocessing
+import random
 from random import shuffle
+from threading import Lock
 from threading import Thread
 import time
 
@@ -33,6 +36,27 @@ ModelInput = namedtuple('ModelInput',
 
 BUCKET_CACHE_BATCH = 100
 QUEUE_NUM_BATCH = 100
+NUM_INPUT_THREADS = 16
+WORKER_CHECK_SECS = 10
+
+
+def _QueueSize(q):
+  """Returns the approximate size of a queue, or None if not available."""
+  try:
+    return q.qsize()
+  except NotImplementedError:
+    # multiprocessing.Queue.qsize() is not implemented on macOS.
+    return None
+
+
+def _PadRows(rows, lens, length, pad_id):
+  """Packs variable-length rows of ids into a padded int32 array."""
+  lens = np.asarray(lens)
+  padded = np.empty((len(rows), length), dtype=np.int32)
+  padded.fill(pad_id)
+  padded[np.arange(length) < lens[:, np.newaxis]] = np.concatenate(
+      [row[:n] for row, n in zip(rows, lens)] + [[]])
+  return padded
 
 
 class Batcher(object):
@@ -40,7 +64,8 @@ class Batcher(object):
 
   def __init__(self, data_path, vocab, hps,
                article_key, abstract_key, max_article_sentences,
-               max_abstract_sentences, bucketing=True, truncate_input=False):
+               max_abstract_sentences, bucketing=True, truncate_input=False,
+               num_processes=0):
     """Batcher constructor.
 
     Args:
@@ -54,6 +79,9 @@ class Batcher(object):
       bucketing: Whether bucket articles of similar length into the same batch.
       truncate_input: Whether to truncate input that is too long. Alternative is
         to discard such examples.
+      num_processes: If > 0, tokenize and batch the input in this many worker
+        processes, which write the batches into shared memory, instead of in
+        threads of this process.
     """
     self._data_path = data_path
     self._vocab = vocab
@@ -64,23 +92,95 @@ class Batcher(object):
     self._max_abstract_sentences = max_abstract_sentences
     self._bucketing = bucketing
     self._truncate_input = truncate_input
-    self._input_queue = Queue.Queue(QUEUE_NUM_BATCH * self._hps.batch_size)
-    self._bucket_input_queue = Queue.Queue(QUEUE_NUM_BATCH)
+    self._num_processes = num_processes
+
+    # Statistics on the batches returned by NextBatch.
+    self._stats_lock = Lock()
+    self._num_batches = 0
+    self._wait_secs = 0.0
+    self._start_time = time.time()
+
+    # The input workers share one store, and each reads its own shard of every
+    # epoch, so that no example is read twice per epoch.
+    self._example_store = data.ExampleStore(self._data_path)
+    self._example_seed = random.randint(0, 2**31 - 1)
+
     self._input_threads = []
-    for _ in xrange(16):
-      self._input_threads.append(Thread(target=self._FillInputQueue))
-      self._input_threads[-1].daemon = True
-      self._input_threads[-1].start()
     self._bucketing_threads = []
-    for _ in xrange(4):
-      self._bucketing_threads.append(Thread(target=self._FillBucketInputQueue))
-      self._bucketing_threads[-1].daemon = True
-      self._bucketing_threads[-1].start()
+    self._input_processes = []
+    if num_processes > 0:
+      self._StartProcesses()
+    else:
+      self._input_queue = Queue.Queue(QUEUE_NUM_BATCH * self._hps.batch_size)
+      self._bucket_input_queue = Queue.Queue(QUEUE_NUM_BATCH)
+      for i in xrange(NUM_INPUT_THREADS):
+        self._input_threads.append(
+            Thread(target=self._FillInputQueue, args=(i,)))
+        self._input_threads[-1].daemon = True
+        self._input_threads[-1].start()
+      for _ in xrange(4):
+        self._bucketing_threads.append(
+            Thread(target=self._FillBucketInputQueue))
+        self._bucketing_threads[-1].daemon = True
+        self._bucketing_threads[-1].start()
 
     self._watch_thread = Thread(target=self._WatchThreads)
     self._watch_thread.daemon = True
     self._watch_thread.start()
 
+  def _StartProcesses(self):
+    """Allocates the shared batch slots and starts the worker processes."""
+    hps = self._hps
+
+    def _SharedArray(dtype, shape):
+      dtype = np.dtype(dtype)
+      raw = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+      return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+    # Each of the QUEUE_NUM_BATCH slots holds one padded batch. Workers take
+    # free slots, fill them, and pass them to NextBatch through _full_slots,
+    # along with the original texts.
+    slots = QUEUE_NUM_BATCH
+    self._shared_enc = _SharedArray(
+        np.int32, (slots, hps.batch_size, hps.enc_timesteps))
+    self._shared_dec = _SharedArray(
+        np.int32, (slots, hps.batch_size, hps.dec_timesteps))
+    self._shared_target = _SharedArray(
+        np.int32, (slots, hps.batch_size, hps.dec_timesteps))
+    self._shared_enc_len = _SharedArray(np.int32, (slots, hps.batch_size))
+    self._shared_dec_len = _SharedArray(np.int32, (slots, hps.batch_size))
+
+    self._free_slots = multiprocessing.Queue()
+    self._full_slots = multiprocessing.Queue()
+    for slot in xrange(slots):
+      self._free_slots.put(slot)
+    self._num_produced = multiprocessing.Value('l', 0)
+
+    for i in xrange(self._num_processes):
+      self._input_processes.append(self._StartProcess(i))
+
+  def _StartProcess(self, shard_index):
+    process = multiprocessing.Process(
+        target=self._FillSharedBatches, args=(shard_index,))
+    process.daemon = True
+    process.start()
+    return process
+
+  def _CheckProcesses(self):
+    """Raises an error if an input worker process has died.
+
+    Dead workers are not restarted: forking once the TensorFlow session has
+    started its threads is unsafe, and the batch slot a worker held when it
+    died cannot be reclaimed.
+
+    Raises:
+      RuntimeError: If an input worker process is no longer alive.
+    """
+    for i, p in enumerate(self._input_processes):
+      if not p.is_alive():
+        raise RuntimeError('Input process %d died with exit code %s.' %
+                           (i, p.exitcode))
+
   def NextBatch(self):
     """Returns a batch of inputs for seq2seq attention model.
 
@@ -94,44 +194,74 @@ class Batcher(object):
       origin_articles: original article words.
       origin_abstracts: original abstract words.
     """
-    enc_batch = np.zeros(
-        (self._hps.batch_size, self._hps.enc_timesteps), dtype=np.int32)
-    enc_input_lens = np.zeros(
-        (self._hps.batch_size), dtype=np.int32)
-    dec_batch = np.zeros(
-        (self._hps.batch_size, self._hps.dec_timesteps), dtype=np.int32)
-    dec_output_lens = np.zeros(
-        (self._hps.batch_size), dtype=np.int32)
-    target_batch = np.zeros(
-        (self._hps.batch_size, self._hps.dec_timesteps), dtype=np.int32)
-    loss_weights = np.zeros(
-        (self._hps.batch_size, self._hps.dec_timesteps), dtype=np.float32)
-    origin_articles = ['None'] * self._hps.batch_size
-    origin_abstracts = ['None'] * self._hps.batch_size
-
-    buckets = self._bucket_input_queue.get()
-    for i in xrange(self._hps.batch_size):
-      (enc_inputs, dec_inputs, targets, enc_input_len, dec_output_len,
-       article, abstract) = buckets[i]
-
-      origin_articles[i] = article
-      origin_abstracts[i] = abstract
-      enc_input_lens[i] = enc_input_len
-      dec_output_lens[i] = dec_output_len
-      enc_batch[i, :] = enc_inputs[:]
-      dec_batch[i, :] = dec_inputs[:]
-      target_batch[i, :] = targets[:]
-      for j in xrange(dec_output_len):
-        loss_weights[i][j] = 1
+    start = time.time()
+    if self._num_processes > 0:
+      while True:
+        try:
+          slot, origin_articles, origin_abstracts = self._full_slots.get(
+              timeout=WORKER_CHECK_SECS)
+          break
+        except Queue.Empty:
+          self._CheckProcesses()
+      enc_batch = self._shared_enc[slot].copy()
+      dec_batch = self._shared_dec[slot].copy()
+      target_batch = self._shared_target[slot].copy()
+      enc_input_lens = self._shared_enc_len[slot].copy()
+      dec_output_lens = self._shared_dec_len[slot].copy()
+      self._free_slots.put(slot)
+    else:
+      (enc_batch, dec_batch, target_batch, enc_input_lens, dec_output_lens,
+       origin_articles, origin_abstracts) = self._bucket_input_queue.get()
+
+    with self._stats_lock:
+      self._num_batches += 1
+      self._wait_secs += time.time() - start
+
+    loss_weights = (np.arange(self._hps.dec_timesteps) <
+                    dec_output_lens[:, np.newaxis]).astype(np.float32)
     return (enc_batch, dec_batch, target_batch, enc_input_lens, dec_output_lens,
             loss_weights, origin_articles, origin_abstracts)
 
-  def _FillInputQueue(self):
-    """Fill input queue with ModelInput."""
+  def Stats(self):
+    """Returns statistics on the input pipeline.
+
+    Returns:
+      A dict with the number of batches ready to be returned by NextBatch
+      ('queue_depth'), the rate at which NextBatch has returned batches
+      ('batches_per_sec'), and the fraction of that time spent waiting for
+      input ('wait_fraction'). If the wait fraction is high, the consumer is
+      starved for input. With worker processes, it also has the rate at which
+      they have produced batches ('produced_per_sec'). The queue depth is None
+      where the platform cannot report it.
+    """
+    with self._stats_lock:
+      elapsed = max(time.time() - self._start_time, 1e-6)
+      stats = {
+          'batches_per_sec': self._num_batches / elapsed,
+          'wait_fraction': self._wait_secs / elapsed,
+      }
+    if self._num_processes > 0:
+      stats['queue_depth'] = _QueueSize(self._full_slots)
+      stats['produced_per_sec'] = self._num_produced.value / elapsed
+    else:
+      stats['queue_depth'] = _QueueSize(self._bucket_input_queue)
+    return stats
+
+  def _InputGen(self, shard_index, num_shards):
+    """Generates unpadded ModelInputs from one shard of the data.
+
+    Args:
+      shard_index: Which shard of each epoch to read.
+      num_shards: Number of shards each epoch is split into.
+
+    Yields:
+      ModelInput, with unpadded id lists.
+    """
     start_id = self._vocab.WordToId(data.SENTENCE_START)
     end_id = self._vocab.WordToId(data.SENTENCE_END)
-    pad_id = self._vocab.WordToId(data.PAD_TOKEN)
-    input_gen = self._TextGenerator(data.ExampleGen(self._data_path))
+    input_gen = self._TextGenerator(data.IndexedExampleGen(
+        self._example_store, shard_index=shard_index,
+        num_shards=num_shards, seed=self._example_seed))
     while True:
       (article, abstract) = input_gen.next()
       article_sentences = [sent.strip() for sent in
@@ -179,49 +309,110 @@ class Batcher(object):
       # Now len(enc_inputs) should be <= enc_timesteps, and
       # len(targets) = len(dec_inputs) should be <= dec_timesteps
 
-      enc_input_len = len(enc_inputs)
-      dec_output_len = len(targets)
+      yield ModelInput(enc_inputs, dec_inputs, targets, len(enc_inputs),
+                       len(targets), ' '.join(article_sentences),
+                       ' '.join(abstract_sentences))
 
-      # Pad if necessary
-      while len(enc_inputs) < self._hps.enc_timesteps:
-        enc_inputs.append(pad_id)
-      while len(dec_inputs) < self._hps.dec_timesteps:
-        dec_inputs.append(end_id)
-      while len(targets) < self._hps.dec_timesteps:
-        targets.append(end_id)
+  def _FillInputQueue(self, shard_index):
+    """Fill input queue with unpadded ModelInput.
 
-      element = ModelInput(enc_inputs, dec_inputs, targets, enc_input_len,
-                           dec_output_len, ' '.join(article_sentences),
-                           ' '.join(abstract_sentences))
-      self._input_queue.put(element)
+    Args:
+      shard_index: Which of the NUM_INPUT_THREADS shards of each epoch to read.
+    """
+    for inp in self._InputGen(shard_index, NUM_INPUT_THREADS):
+      self._input_queue.put(inp)
+
+  def _Bucket(self, inputs):
+    """Groups inputs into shuffled batches, by length if bucketing."""
+    if self._bucketing:
+      inputs = sorted(inputs, key=lambda inp: inp.enc_len)
+
+    batches = []
+    for i in xrange(0, len(inputs), self._hps.batch_size):
+      batches.append(inputs[i:i+self._hps.batch_size])
+    shuffle(batches)
+    return batches
+
+  def _PadBatch(self, inputs):
+    """Pads a batch of ModelInput into arrays.
+
+    Returns:
+      A tuple of the padded encoder inputs, decoder inputs and targets, and of
+      the encoder and decoder lengths, as int32 arrays.
+    """
+    hps = self._hps
+    end_id = self._vocab.WordToId(data.SENTENCE_END)
+    pad_id = self._vocab.WordToId(data.PAD_TOKEN)
+    enc_lens = np.array([inp.enc_len for inp in inputs], dtype=np.int32)
+    dec_lens = np.array([inp.dec_len for inp in inputs], dtype=np.int32)
+    return (
+        _PadRows([inp.enc_input for inp in inputs], enc_lens,
+                 hps.enc_timesteps, pad_id),
+        _PadRows([inp.dec_input for inp in inputs], dec_lens,
+                 hps.dec_timesteps, end_id),
+        _PadRows([inp.target for inp in inputs], dec_lens,
+                 hps.dec_timesteps, end_id),
+        enc_lens, dec_lens)
 
   def _FillBucketInputQueue(self):
-    """Fill bucketed batches into the bucket_input_queue."""
+    """Fill padded, bucketed batches into the bucket_input_queue."""
     while True:
       inputs = []
       for _ in xrange(self._hps.batch_size * BUCKET_CACHE_BATCH):
         inputs.append(self._input_queue.get())
-      if self._bucketing:
-        inputs = sorted(inputs, key=lambda inp: inp.enc_len)
+      for b in self._Bucket(inputs):
+        self._bucket_input_queue.put(
+            self._PadBatch(b) + ([inp.origin_article for inp in b],
+                                 [inp.origin_abstract for inp in b]))
 
-      batches = []
-      for i in xrange(0, len(inputs), self._hps.batch_size):
-        batches.append(inputs[i:i+self._hps.batch_size])
-      shuffle(batches)
-      for b in batches:
-        self._bucket_input_queue.put(b)
+  def _FillSharedBatches(self, shard_index):
+    """Fill shared-memory batch slots; runs in a worker process.
+
+    Args:
+      shard_index: Which of the num_processes shards of each epoch to read.
+    """
+    input_gen = self._InputGen(shard_index, self._num_processes)
+    while True:
+      inputs = [input_gen.next()
+                for _ in xrange(self._hps.batch_size * BUCKET_CACHE_BATCH)]
+      for b in self._Bucket(inputs):
+        slot = self._free_slots.get()
+        (self._shared_enc[slot], self._shared_dec[slot],
+         self._shared_target[slot], self._shared_enc_len[slot],
+         self._shared_dec_len[slot]) = self._PadBatch(b)
+        self._full_slots.put((slot,
+                              [inp.origin_article for inp in b],
+                              [inp.origin_abstract for inp in b]))
+
+        with self._num_produced.get_lock():
+          self._num_produced.value += 1
 
   def _WatchThreads(self):
-    """Watch the daemon input threads and restart if dead."""
+    """Watch the daemon input threads and restart if dead.
+
+    Dead input processes are only logged here; NextBatch raises an error once
+    the batches they produced run out.
+    """
     while True:
       time.sleep(60)
+      stats = self.Stats()
+      tf.logging.info('input: %.2f batches/sec, %s batches queued, '
+                      '%.1f%% of time waiting for input',
+                      stats['batches_per_sec'], stats['queue_depth'],
+                      100.0 * stats['wait_fraction'])
+
+      for i, p in enumerate(self._input_processes):
+        if not p.is_alive():
+          tf.logging.error('Found input process %d dead, exit code %s.',
+                           i, p.exitcode)
+
       input_threads = []
-      for t in self._input_threads:
+      for i, t in enumerate(self._input_threads):
         if t.is_alive():
           input_threads.append(t)
         else:
           tf.logging.error('Found input thread dead.')
-          new_t = Thread(target=self._FillInputQueue)
+          new_t = Thread(target=self._FillInputQueue, args=(i,))
           input_threads.append(new_t)
           input_threads[-1].daemon = True
           input_threads[-1].start()
@@ -21,6 +21,7 @@ K*K results, and start over again until certain number of results are fully
 decoded.
 """
 
+import numpy as np
 from six.moves import xrange
 import tensorflow as tf
 
@@ -154,3 +155,129 @@ class BeamSearch(object):
       return sorted(hyps, key=lambda h: h.log_prob/len(h.tokens), reverse=True)
     else:
       return sorted(hyps, key=lambda h: h.log_prob, reverse=True)
+
+
+class BatchBeamSearch(BeamSearch):
+  """Beam search over a batch of articles at once.
+
+  Finds the same hypotheses as BeamSearch does for each article, but encodes
+  the whole batch with one encode_top_state call and advances every beam with
+  one decode_topk call per step. The model must be built with a batch size of
+  beam_size times the number of articles.
+
+  The beams are kept in preallocated arrays: tokens[t, b, k] is the token that
+  slot k of article b holds after step t, and parents[t, b, k] is the slot at
+  step t - 1 that it extends. Hypothesis objects are only built for results.
+  """
+
+  def BeamSearch(self, sess, enc_inputs, enc_seqlen):
+    """Performs beam search for decoding a batch of articles.
+
+    Args:
+      sess: tf.Session, session
+      enc_inputs: ndarray of shape (num_articles, enc_length), the document ids
+          to encode
+      enc_seqlen: ndarray of shape (num_articles), the length of the sequences
+
+    Returns:
+      hyps: for each article, a list of Hypothesis, the best hypotheses found
+          by beam search, ordered by score
+    """
+    num_articles = len(enc_inputs)
+    beam_size = self._beam_size
+    num_cands = beam_size * 2
+
+    # Run the encoder with each article replicated once per beam slot.
+    enc_top_states, states = self._model.encode_top_state(
+        sess, np.repeat(enc_inputs, beam_size, axis=0),
+        np.repeat(enc_seqlen, beam_size), all_rows=True)
+
+    tokens = np.zeros(
+        [self._max_steps + 1, num_articles, beam_size], dtype=np.int64)
+    parents = np.zeros_like(tokens)
+    tokens[0] = self._start_token
+
+    # All the slots start with the same hypothesis, so the first step only
+    # extends the first slot.
+    log_probs = np.zeros([num_articles, beam_size])
+    log_probs[:, 1:] = -np.inf
+
+    results = [[] for _ in xrange(num_articles)]
+    num_hyps = np.zeros(num_articles, dtype=np.int64)
+    done = np.zeros(num_articles, dtype=bool)
+    done_steps = np.zeros(num_articles, dtype=np.int64)
+    articles = np.arange(num_articles)[:, np.newaxis]
+
+    steps = 0
+    while steps < self._max_steps and not done.all():
+      topk_ids, topk_log_probs, new_states = self._model.decode_topk(
+          sess, tokens[steps].ravel(), enc_top_states, states)
+      new_states = np.array(new_states)
+
+      # Score the 2K extensions of each of the K slots of every article.
+      cand_ids = topk_ids[:, :num_cands].reshape(num_articles, -1)
+      cand_log_probs = (
+          log_probs[:, :, np.newaxis] +
+          topk_log_probs[:, :num_cands].reshape(num_articles, beam_size, -1))
+      cand_log_probs = cand_log_probs.reshape(num_articles, -1)
+
+      # Taking candidates in order, either K hypotheses continue or K end within
+      # the best 2K, so only those need to be considered.
+      best = np.argsort(-cand_log_probs, axis=1, kind='mergesort')
+      best = best[:, :num_cands]
+      best_ids = cand_ids[articles, best]
+      best_log_probs = cand_log_probs[articles, best]
+      best_parents = best // num_cands
+      is_end = best_ids == self._end_token
+
+      # Take candidates until there are K hypotheses or K results.
+      num_results = np.array([[len(r)] for r in results])
+      stop = ((np.cumsum(~is_end, axis=1) == beam_size) |
+              (num_results + np.cumsum(is_end, axis=1) >= beam_size))
+      taken = np.arange(num_cands) <= np.argmax(stop, axis=1)[:, np.newaxis]
+      taken &= ~done[:, np.newaxis]
+
+      # Pull the hypotheses that reached the end token off the beam.
+      for b, c in zip(*np.nonzero(taken & is_end)):
+        parent = best_parents[b, c]
+        results[b].append(Hypothesis(
+            self._Trace(tokens, parents, steps, b, parent) + [self._end_token],
+            best_log_probs[b, c], new_states[b * beam_size + parent]))
+
+      # Move the remaining hypotheses into the slots for the next step.
+      cont = taken & ~is_end
+      b_idx, c_idx = np.nonzero(cont)
+      slots = np.cumsum(cont, axis=1)[b_idx, c_idx] - 1
+      tokens[steps + 1] = tokens[steps]
+      tokens[steps + 1, b_idx, slots] = best_ids[b_idx, c_idx]
+      parents[steps + 1, b_idx, slots] = best_parents[b_idx, c_idx]
+      log_probs[b_idx, slots] = best_log_probs[b_idx, c_idx]
+      states = np.array(states)
+      states[b_idx * beam_size + slots] = new_states[
+          b_idx * beam_size + best_parents[b_idx, c_idx]]
+      num_hyps[~done] = cont.sum(axis=1)[~done]
+
+      steps += 1
+      newly_done = ~done & np.array([len(r) >= beam_size for r in results])
+      done_steps[newly_done] = steps
+      done |= newly_done
+
+    done_steps[~done] = steps
+
+    # As in BeamSearch, fall back to the partial hypotheses of the articles
+    # that were still being decoded at the last step.
+    for b in np.flatnonzero(done_steps == self._max_steps):
+      for slot in xrange(num_hyps[b]):
+        results[b].append(Hypothesis(
+            self._Trace(tokens, parents, self._max_steps, b, slot),
+            log_probs[b, slot], states[b * beam_size + slot]))
+
+    return [self._BestHyps(r) for r in results]
+
+  def _Trace(self, tokens, parents, step, article, slot):
+    """Follows the back-pointers to recover the tokens of a hypothesis."""
+    trace = []
+    for t in xrange(step, -1, -1):
+      trace.append(int(tokens[t, article, slot]))
+      slot = parents[t, article, slot]
+    return trace[::-1]
@@ -16,10 +16,13 @@
 """Data batchers for data described in ..//data_prep/README.md."""
 
 import glob
+import mmap
+import os
 import random
 import struct
 import sys
 
+import numpy as np
 from tensorflow.core.example import example_pb2
 
 
@@ -75,6 +78,11 @@ class Vocab(object):
     return self._count
 
 
+def DataFiles(data_path):
+  """Returns the data files matching a path, excluding their offset indexes."""
+  return [f for f in glob.glob(data_path) if '.index.npy' not in f]
+
+
 def ExampleGen(data_path, num_epochs=None):
   """Generates tf.Examples from path of data files.
 
@@ -95,7 +103,7 @@ def ExampleGen(data_path, num_epochs=None):
   while True:
     if num_epochs is not None and epoch >= num_epochs:
       break
-    filelist = glob.glob(data_path)
+    filelist = DataFiles(data_path)
     assert filelist, 'Empty filelist.'
     random.shuffle(filelist)
     for f in filelist:
@@ -110,6 +118,121 @@ def ExampleGen(data_path, num_epochs=None):
     epoch += 1
 
 
+def IndexFilename(data_file):
+  """Returns the name of the offset index for a data file."""
+  return data_file + '.index.npy'
+
+
+def BuildIndex(data_file):
+  """Builds the offset index for a data file in the <length><blob> format.
+
+  The index is an int64 array with the byte offset of each record, saved with
+  np.save next to the data file. Only the record headers are read.
+
+  Args:
+    data_file: path to a tf.Example data file.
+
+  Returns:
+    The array of record offsets.
+  """
+  offsets = []
+  size = os.path.getsize(data_file)
+  with open(data_file, 'rb') as reader:
+    offset = 0
+    while offset < size:
+      offsets.append(offset)
+      reader.seek(offset)
+      str_len = struct.unpack('q', reader.read(8))[0]
+      offset += 8 + str_len
+
+  offsets = np.array(offsets, dtype=np.int64)
+
+  # Write to a temporary file and rename it, so that concurrent readers never
+  # see a partially written index.
+  index_file = IndexFilename(data_file)
+  tmp_file = '%s.tmp.%d' % (index_file, os.getpid())
+  with open(tmp_file, 'wb') as writer:
+    np.save(writer, offsets)
+  os.rename(tmp_file, index_file)
+  return offsets
+
+
+class ExampleStore(object):
+  """Random access to the tf.Examples of a set of data files.
+
+  Each data file is memory mapped, and its records are located through an
+  offset index that is built on first use (or when it is older than the data
+  file) and stored next to it. Records are numbered consecutively across the
+  files, in sorted filename order.
+  """
+
+  def __init__(self, data_path):
+    """ExampleStore constructor.
+
+    Args:
+      data_path: path to tf.Example data files.
+    """
+    self._filelist = sorted(DataFiles(data_path))
+    assert self._filelist, 'Empty filelist.'
+
+    self._maps = []
+    self._offsets = []
+    for f in self._filelist:
+      index_file = IndexFilename(f)
+      if (os.path.exists(index_file) and
+          os.path.getmtime(index_file) >= os.path.getmtime(f)):
+        self._offsets.append(np.load(index_file))
+      else:
+        self._offsets.append(BuildIndex(f))
+
+      with open(f, 'rb') as reader:
+        self._maps.append(
+            mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.path.getsize(f) else '')
+
+    self._starts = np.cumsum([0] + [len(o) for o in self._offsets])
+
+  def __len__(self):
+    return int(self._starts[-1])
+
+  def __getitem__(self, i):
+    """Returns the i-th deserialized tf.Example."""
+    f = int(np.searchsorted(self._starts, i, side='right')) - 1
+    offset = int(self._offsets[f][i - self._starts[f]])
+    str_len = struct.unpack_from('q', self._maps[f], offset)[0]
+    return example_pb2.Example.FromString(
+        self._maps[f][offset + 8:offset + 8 + str_len])
+
+
+def IndexedExampleGen(store, num_epochs=None, shard_index=0, num_shards=1,
+                      seed=0):
+  """Generates tf.Examples from an ExampleStore in a shuffled order.
+
+  Every epoch visits the records in a new random order that depends only on
+  the seed and the epoch, so several workers that use the same seed and
+  different shard_index values read disjoint shards of each epoch.
+
+  Args:
+    store: ExampleStore.
+    num_epochs: Number of times to go through the data. None means infinite.
+    shard_index: Which shard of each epoch to read.
+    num_shards: Number of shards each epoch is split into.
+    seed: Seed for the per-epoch orders.
+
+  Yields:
+    Deserialized tf.Example.
+  """
+  epoch = 0
+  while True:
+    if num_epochs is not None and epoch >= num_epochs:
+      break
+    order = np.random.RandomState([seed, epoch]).permutation(len(store))
+    for i in order[shard_index::num_shards]:
+      yield store[i]
+
+    epoch += 1
+
+
 def Pad(ids, pad_id, length):
   """Pad or trim list to len length.
 
@@ -54,6 +54,9 @@ tf.app.flags.DEFINE_integer('max_abstract_sentences', 100,
                             'abstract')
 tf.app.flags.DEFINE_integer('beam_size', 4,
                             'beam size for beam search decoding.')
+tf.app.flags.DEFINE_integer('decode_batch_size', 4,
+                            'Number of articles decoded together in decode '
+                            'mode.')
 tf.app.flags.DEFINE_integer('eval_interval_secs', 60, 'How often to run eval.')
 tf.app.flags.DEFINE_integer('checkpoint_secs', 60, 'How often to checkpoint.')
 tf.app.flags.DEFINE_bool('use_bucketing', False,
@@ -62,6 +65,9 @@ tf.app.flags.DEFINE_bool('truncate_input', False,
                          'Truncate inputs that are too long. If False, '
                          'examples that are too long are discarded.')
 tf.app.flags.DEFINE_integer('num_gpus', 0, 'Number of gpus used.')
+tf.app.flags.DEFINE_integer('input_processes', 0,
+                            'Number of processes that tokenize and batch the '
+                            'input. If 0, use threads in this process.')
 tf.app.flags.DEFINE_integer('random_seed', 111, 'A seed value for randomness.')
 
 
@@ -167,7 +173,7 @@ def main(unused_argv):
 
   batch_size = 4
   if FLAGS.mode == 'decode':
-    batch_size = FLAGS.beam_size
+    batch_size = FLAGS.decode_batch_size
 
   hps = seq2seq_attention_model.HParams(
       mode=FLAGS.mode,  # train, eval, decode
@@ -187,7 +193,8 @@ def main(unused_argv):
       FLAGS.data_path, vocab, hps, FLAGS.article_key,
       FLAGS.abstract_key, FLAGS.max_article_sentences,
       FLAGS.max_abstract_sentences, bucketing=FLAGS.use_bucketing,
-      truncate_input=FLAGS.truncate_input)
+      truncate_input=FLAGS.truncate_input,
+      num_processes=FLAGS.input_processes)
   tf.set_random_seed(FLAGS.random_seed)
 
   if hps.mode == 'train':
@@ -201,10 +208,13 @@ def main(unused_argv):
   elif hps.mode == 'decode':
     decode_mdl_hps = hps
     # Only need to restore the 1st step and reuse it since
-    # we keep and feed in state for each step's output.
-    decode_mdl_hps = hps._replace(dec_timesteps=1)
+    # we keep and feed in state for each step's output. Every article of a
+    # batch gets one row per beam slot.
+    decode_mdl_hps = hps._replace(
+        dec_timesteps=1, batch_size=hps.batch_size * FLAGS.beam_size)
     model = seq2seq_attention_model.Seq2SeqAttentionModel(
-        decode_mdl_hps, vocab, num_gpus=FLAGS.num_gpus)
+        decode_mdl_hps, vocab, num_gpus=FLAGS.num_gpus,
+        beam_size=FLAGS.beam_size)
     decoder = seq2seq_attention_decode.BSDecoder(model, batcher, hps, vocab)
     decoder.DecodeLoop()
 
@@ -124,22 +124,19 @@ class BSDecoder(object):
     saver.restore(sess, ckpt_path)
 
     self._decode_io.ResetFiles()
+    bs = beam_search.BatchBeamSearch(
+        self._model, FLAGS.beam_size,
+        self._vocab.WordToId(data.SENTENCE_START),
+        self._vocab.WordToId(data.SENTENCE_END),
+        self._hps.dec_timesteps)
     for _ in xrange(FLAGS.decode_batches_per_ckpt):
       (article_batch, _, _, article_lens, _, _, origin_articles,
        origin_abstracts) = self._batch_reader.NextBatch()
+
+      # Decode all the articles of the batch together.
+      best_beams = bs.BeamSearch(sess, article_batch, article_lens)
       for i in xrange(self._hps.batch_size):
-        bs = beam_search.BeamSearch(
-            self._model, self._hps.batch_size,
-            self._vocab.WordToId(data.SENTENCE_START),
-            self._vocab.WordToId(data.SENTENCE_END),
-            self._hps.dec_timesteps)
-
-        article_batch_cp = article_batch.copy()
-        article_batch_cp[:] = article_batch[i:i+1]
-        article_lens_cp = article_lens.copy()
-        article_lens_cp[:] = article_lens[i:i+1]
-        best_beam = bs.BeamSearch(sess, article_batch_cp, article_lens_cp)[0]
-        decode_output = [int(t) for t in best_beam.tokens[1:]]
+        decode_output = [int(t) for t in best_beams[i][0].tokens[1:]]
         self._DecodeBatch(
             origin_articles[i], origin_abstracts[i], decode_output)
     return True
@@ -61,10 +61,21 @@ def _extract_argmax_and_embed(embedding, output_projection=None,
 class Seq2SeqAttentionModel(object):
   """Wrapper for Tensorflow model graph for text sum vectors."""
 
-  def __init__(self, hps, vocab, num_gpus=0):
+  def __init__(self, hps, vocab, num_gpus=0, beam_size=None):
+    """Model constructor.
+
+    Args:
+      hps: HParams.
+      vocab: Vocabulary.
+      num_gpus: Number of gpus used.
+      beam_size: In decode mode, decode_topk returns the 2*beam_size best
+        tokens for each row. Defaults to the batch size, which is the beam size
+        when a single article is decoded at a time.
+    """
     self._hps = hps
     self._vocab = vocab
     self._num_gpus = num_gpus
+    self._beam_size = beam_size or hps.batch_size
     self._cur_gpu = 0
 
   def run_train_step(self, sess, article_batch, abstract_batch, targets,
@@ -221,7 +232,7 @@ class Seq2SeqAttentionModel(object):
               axis=1, values=[tf.reshape(x, [hps.batch_size, 1]) for x in best_outputs])
 
           self._topk_log_probs, self._topk_ids = tf.nn.top_k(
-              tf.log(tf.nn.softmax(model_outputs[-1])), hps.batch_size*2)
+              tf.log(tf.nn.softmax(model_outputs[-1])), self._beam_size*2)
 
       with tf.variable_scope('loss'), tf.device(self._next_device()):
         def sampled_loss_func(inputs, labels):
@@ -257,13 +268,15 @@ class Seq2SeqAttentionModel(object):
     self._train_op = optimizer.apply_gradients(
         zip(grads, tvars), global_step=self.global_step, name='train_step')
 
-  def encode_top_state(self, sess, enc_inputs, enc_len):
+  def encode_top_state(self, sess, enc_inputs, enc_len, all_rows=False):
     """Return the top states from encoder for decoder.
 
     Args:
       sess: tensorflow session.
       enc_inputs: encoder inputs of shape [batch_size, enc_timesteps].
       enc_len: encoder input length of shape [batch_size]
+      all_rows: If True, return the decoder initial state of every row rather
+        than just the first one.
     Returns:
       enc_top_states: The top level encoder states.
       dec_in_state: The decoder layer initial state.
@@ -271,6 +284,8 @@ class Seq2SeqAttentionModel(object):
     results = sess.run([self._enc_top_states, self._dec_in_state],
                        feed_dict={self._articles: enc_inputs,
                                   self._article_lens: enc_len})
+    if all_rows:
+      return results[0], results[1]
     return results[0], results[1][0]
 
   def decode_topk(self, sess, latest_tokens, enc_top_states, dec_init_states):